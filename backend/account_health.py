@@ -0,0 +1,33 @@
+"""Concurrent health checks of many sending accounts."""
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+
+def check_accounts(accounts, check, timeout=10, max_workers=32):
+    """Run check(account) for all accounts in parallel, within `timeout` seconds overall
+
+    Returns (healthy accounts in their original order, {account_id: error}).
+    A check still running when the timeout expires counts as failed.
+    """
+    if not accounts:
+        return [], {}
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(accounts)))
+    futures = [(executor.submit(check, account), account) for account in accounts]
+    done, _ = wait([future for future, _ in futures], timeout=timeout)
+    # Don't wait for checks that hang; their sockets time out on their own
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    healthy = []
+    failures = {}
+    for future, account in futures:
+        if future not in done:
+            failures[account['id']] = f"No response within {timeout} seconds"
+        elif future.exception() is not None:
+            failures[account['id']] = str(future.exception())
+        else:
+            healthy.append(account)
+    for account_id, error in failures.items():
+        logger.warning(f"Account {account_id} failed its health check: {error}")
+    return healthy, failures
@@ -0,0 +1,209 @@
+"""Campaign-wide selection of the sending account for each message."""
+import threading
+import time
+from retry import CONNECTION, THROTTLED, TRANSIENT
+
+# Weight of the latest result in the moving error rate
+ERROR_RATE_DECAY = 0.1
+
+# Adaptive (AIMD) limits: grow slowly while sends succeed, halve on throttling
+CONGESTION_ERRORS = (THROTTLED, TRANSIENT, CONNECTION)
+BACKOFF_FACTOR = 0.5
+BACKOFF_COOLDOWN = 1.0      # seconds; one burst of failures only backs off once
+MIN_RATE_FACTOR = 0.05
+RATE_INCREASE_STEP = 0.02
+LATENCY_FAST_DECAY = 0.3
+LATENCY_SLOW_DECAY = 0.05
+LATENCY_SPIKE = 2.0         # a send this much slower than usual is a congestion hint
+
+
+class NoAccountAvailable(Exception):
+    """Raised when every account in the campaign has used up its quota"""
+
+
+class AccountState:
+    """Load, health and adaptive limits of one account within a campaign"""
+
+    def __init__(self, account, weight=1.0, quota=None, max_concurrency=5,
+                 initial_concurrency=2, rate_ceiling=None):
+        self.account = account
+        self.weight = max(float(weight), 0.01)
+        self.quota = int(quota) if quota else None
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.error_rate = 0.0
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.concurrency = float(min(initial_concurrency, self.max_concurrency))
+        self.rate_ceiling = rate_ceiling
+        self.rate_factor = 1.0
+        self.latency = None
+        self.baseline_latency = None
+        self.last_backoff = 0.0
+        self.backoffs = 0
+
+    @property
+    def quota_left(self):
+        if self.quota is None:
+            return None
+        return self.quota - self.sent - self.in_flight
+
+    @property
+    def rate(self):
+        if self.rate_ceiling is None:
+            return None
+        return self.rate_ceiling * self.rate_factor
+
+    def has_capacity(self):
+        return self.in_flight < int(self.concurrency)
+
+    def load(self):
+        """Lower is better: in-flight work per unit of weight, inflated by errors"""
+        load = (self.in_flight + 1) / self.weight * (1 + 4 * self.error_rate)
+        if self.quota:
+            load *= 1 + (self.quota - self.quota_left) / self.quota
+        return load
+
+    def on_success(self, latency):
+        """Additive increase, as long as latency stays near its usual level"""
+        if latency is not None:
+            if self.latency is None:
+                self.latency = self.baseline_latency = latency
+            else:
+                self.latency += LATENCY_FAST_DECAY * (latency - self.latency)
+                self.baseline_latency += LATENCY_SLOW_DECAY * (latency - self.baseline_latency)
+            if self.latency > LATENCY_SPIKE * self.baseline_latency:
+                return
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+        self.rate_factor = min(1.0, self.rate_factor + RATE_INCREASE_STEP)
+
+    def on_congestion(self, now):
+        """Multiplicative decrease, at most once per cooldown"""
+        if now - self.last_backoff < BACKOFF_COOLDOWN:
+            return False
+        self.last_backoff = now
+        self.backoffs += 1
+        self.concurrency = max(1.0, self.concurrency * BACKOFF_FACTOR)
+        self.rate_factor = max(MIN_RATE_FACTOR, self.rate_factor * BACKOFF_FACTOR)
+        return True
+
+    def stats(self):
+        return {
+            'id': self.account['id'],
+            'email': self.account['email'],
+            'weight': self.weight,
+            'inFlight': self.in_flight,
+            'sent': self.sent,
+            'failed': self.failed,
+            'errorRate': round(self.error_rate, 3),
+            'quotaLeft': self.quota_left,
+            'concurrencyLimit': int(self.concurrency),
+            'rateLimit': round(self.rate, 3) if self.rate is not None else None,
+            'latencyMs': round(self.latency * 1000) if self.latency is not None else None,
+            'backoffs': self.backoffs
+        }
+
+
+class AccountScheduler:
+    """Picks the least-loaded account for each send, shared by all workers
+
+    Accounts are ranked by in-flight sends relative to their weight, their
+    recent error rate and the share of their quota already used, so load is
+    spread evenly from the first message on. Each account also adapts its
+    own concurrency and rate to the responses it gets (AIMD); accounts that
+    are at either limit are skipped until they have capacity again.
+    """
+
+    def __init__(self, accounts, rate_limiter, weights=None, quotas=None,
+                 max_concurrency=5, initial_concurrency=2):
+        weights = weights or {}
+        quotas = quotas or {}
+        self.rate_limiter = rate_limiter
+        self.states = {}
+        for account in accounts:
+            self.states[account['id']] = AccountState(
+                account,
+                weight=weights.get(account['id'], account.get('weight', 1)),
+                quota=quotas.get(account['id'], account.get('quota')),
+                max_concurrency=max_concurrency,
+                initial_concurrency=initial_concurrency,
+                rate_ceiling=rate_limiter.limit(account['id'])
+            )
+        self._cond = threading.Condition()
+        self._listeners = []
+
+    def _rank(self, state):
+        # Tie-break on messages sent per weight so idle accounts get used evenly
+        return (state.load(), state.sent / state.weight)
+
+    def _candidates(self, avoid):
+        candidates = [s for s in self.states.values() if s.quota_left is None or s.quota_left > 0]
+        candidates.sort(key=self._rank)
+        if avoid and len(candidates) > 1:
+            # Retries go through a different account than the one that failed
+            candidates.sort(key=lambda s: s.account['id'] == avoid)
+        return candidates
+
+    def _try_acquire(self, avoid):
+        candidates = self._candidates(avoid)
+        if not candidates:
+            raise NoAccountAvailable("All selected accounts have used up their quota")
+        waits = []
+        for state in candidates:
+            if not state.has_capacity():
+                continue
+            wait = self.rate_limiter.try_acquire(state.account['id'])
+            if not wait:
+                state.in_flight += 1
+                return state.account, 0.0
+            waits.append(wait)
+        # Either the seconds until a token is due, or None if only a finished send helps
+        return None, (min(waits) if waits else None)
+
+    def try_acquire(self, avoid=None):
+        """Non-blocking acquire: (account, 0) or (None, seconds to wait)"""
+        with self._cond:
+            return self._try_acquire(avoid)
+
+    def acquire(self, avoid=None):
+        """Reserve a send on the best account that has capacity right now"""
+        with self._cond:
+            while True:
+                account, wait = self._try_acquire(avoid)
+                if account is not None:
+                    return account
+                # Sleep until a token is due or another send finishes
+                self._cond.wait(wait if wait is not None else 1.0)
+
+    def release(self, account, success, error_class=None, latency=None):
+        """Record the outcome of a send reserved with acquire()"""
+        with self._cond:
+            state = self.states[account['id']]
+            state.in_flight -= 1
+            if success:
+                state.sent += 1
+                state.on_success(latency)
+            else:
+                state.failed += 1
+                if error_class in CONGESTION_ERRORS:
+                    state.on_congestion(time.monotonic())
+            state.error_rate += ERROR_RATE_DECAY * ((0.0 if success else 1.0) - state.error_rate)
+            if state.rate is not None:
+                self.rate_limiter.set_rate(account['id'], state.rate)
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def add_listener(self, callback):
+        """Call `callback()` from the releasing thread whenever a send is released"""
+        with self._cond:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._cond:
+            self._listeners.remove(callback)
+
+    def stats(self):
+        with self._cond:
+            return [state.stats() for state in self.states.values()]
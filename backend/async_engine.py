@@ -0,0 +1,382 @@
+"""Single-threaded asyncio send engine for high-concurrency SMTP campaigns.
+
+Runs many SMTP sessions as coroutines on one event loop instead of one OS
+thread per connection. Job selection, retries, status and errors all go
+through the same Campaign object as the threaded workers, so both engines
+behave the same; only the socket I/O differs. Gmail API sends are blocking
+calls and run on the loop's default thread pool.
+"""
+import asyncio
+import base64
+import collections
+import contextlib
+import logging
+import smtplib
+import ssl
+import threading
+import time
+from message_builder import CRLF, WireMessage, quote_data
+
+logger = logging.getLogger(__name__)
+
+
+_ssl_context = None
+
+
+def default_ssl_context():
+    """One shared client SSL context; loading the CA bundle is expensive"""
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+class AsyncSMTPClient:
+    """Minimal SMTP client on asyncio streams (EHLO, STARTTLS/SSL, AUTH, send)"""
+
+    def __init__(self, host, port, timeout=30):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        # The pre-TLS writer, kept with the connection where streams are rebuilt after STARTTLS
+        self._plain_writer = None
+        self.features = {}
+
+    async def _read_reply(self):
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                return int(line[:3]), b'\n'.join(lines)
+
+    async def command(self, line, expect=None):
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected("Not connected")
+        self.writer.write(line.encode('ascii') + CRLF)
+        await self.writer.drain()
+        code, reply = await self._read_reply()
+        if expect is not None and code not in expect:
+            raise smtplib.SMTPResponseException(code, reply)
+        return code, reply
+
+    async def ehlo(self):
+        code, reply = await self.command('EHLO localhost', expect=(250,))
+        self.features = {}
+        for line in reply.decode('latin-1').split('\n')[1:]:
+            keyword, _, params = line.partition(' ')
+            self.features[keyword.lower()] = params
+
+    async def connect(self, use_ssl=False, starttls=True):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=default_ssl_context() if use_ssl else None),
+            self.timeout)
+        code, reply = await self._read_reply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, reply)
+        await self.ehlo()
+        if not use_ssl and starttls:
+            await self.command('STARTTLS', expect=(220,))
+            await self._start_tls()
+            await self.ehlo()
+
+    async def _start_tls(self):
+        """Upgrade the connection to TLS in place"""
+        if hasattr(self.writer, 'start_tls'):
+            await self.writer.start_tls(default_ssl_context(), server_hostname=self.host)
+            return
+        # StreamWriter.start_tls is new in Python 3.11; before that, wrap the
+        # upgraded transport in new streams
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport = await asyncio.wait_for(
+            loop.start_tls(self.writer.transport, protocol, default_ssl_context(), server_hostname=self.host),
+            self.timeout)
+        protocol.connection_made(transport)
+        # Collecting the old writer would close the socket under the TLS transport
+        self._plain_writer = self.writer
+        self.reader = reader
+        self.writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+
+    async def login(self, username, password):
+        mechanisms = self.features.get('auth', '').upper().split()
+        try:
+            if 'PLAIN' in mechanisms or not mechanisms:
+                token = base64.b64encode(f'\0{username}\0{password}'.encode()).decode('ascii')
+                await self.command(f'AUTH PLAIN {token}', expect=(235,))
+            else:
+                await self.command('AUTH LOGIN', expect=(334,))
+                await self.command(base64.b64encode(username.encode()).decode('ascii'), expect=(334,))
+                await self.command(base64.b64encode(password.encode()).decode('ascii'), expect=(235,))
+        except smtplib.SMTPResponseException as e:
+            raise smtplib.SMTPAuthenticationError(e.smtp_code, e.smtp_error)
+
+    async def sendmail(self, from_addr, to_addr, data):
+        code, reply = await self.command(f'MAIL FROM:<{from_addr}>')
+        if code != 250:
+            await self.rset()
+            raise smtplib.SMTPSenderRefused(code, reply, from_addr)
+        code, reply = await self.command(f'RCPT TO:<{to_addr}>')
+        if code not in (250, 251):
+            await self.rset()
+            raise smtplib.SMTPRecipientsRefused({to_addr: (code, reply)})
+        code, reply = await self.command('DATA')
+        if code != 354:
+            # End the transaction so the session can take the next message
+            await self.rset()
+            raise smtplib.SMTPDataError(code, reply)
+        if isinstance(data, WireMessage):
+            # Shared attachment segments go to the transport as they are, without copies
+            self.writer.write(quote_data(data.head))
+            for segment in data.segments:
+                self.writer.write(segment)
+        else:
+            self.writer.write(quote_data(data))
+        self.writer.write(b'.' + CRLF)
+        await self.writer.drain()
+        code, reply = await self._read_reply()
+        if code != 250:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, reply)
+
+    async def noop(self):
+        return (await self.command('NOOP'))[0]
+
+    async def rset(self):
+        return (await self.command('RSET'))[0]
+
+    async def quit(self):
+        try:
+            await self.command('QUIT')
+        except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            pass
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self._plain_writer = None
+
+
+class AsyncSMTPPool:
+    """asyncio counterpart of smtp_pool.SMTPConnectionPool for one account"""
+
+    def __init__(self, account, max_sessions=100, max_messages=100, max_idle=60, timeout=30):
+        self.account = account
+        self.max_sessions = max(1, int(max_sessions))
+        self.max_messages = max(1, int(max_messages))
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = []
+        # QUITs of retired sessions, kept until they finish
+        self._closing = set()
+        self._slots = asyncio.Semaphore(self.max_sessions)
+
+    async def _connect(self):
+        client = AsyncSMTPClient(self.account['host'], self.account['port'], self.timeout)
+        try:
+            await client.connect(use_ssl=self.account.get('use_ssl', False),
+                                 starttls=self.account.get('starttls', True))
+            await client.login(self.account['username'], self.account['password'])
+        except Exception:
+            client.close()
+            raise
+        client.messages_sent = 0
+        client.last_used = time.monotonic()
+        return client
+
+    async def _acquire(self):
+        while self._idle:
+            client = self._idle.pop()
+            fresh = time.monotonic() - client.last_used <= self.max_idle
+            try:
+                if fresh and await client.noop() == 250:
+                    return client
+            except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+                pass
+            await client.quit()
+        return await self._connect()
+
+    def _release(self, client, discard):
+        client.last_used = time.monotonic()
+        if discard or client.messages_sent >= self.max_messages:
+            task = asyncio.ensure_future(client.quit())
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+        else:
+            self._idle.append(client)
+
+    async def _send_once(self, from_addr, to_addr, data):
+        client = await self._acquire()
+        discard = False
+        try:
+            await client.sendmail(from_addr, to_addr, data)
+            client.messages_sent += 1
+        except smtplib.SMTPResponseException as e:
+            discard = e.smtp_code == 421
+            raise
+        except smtplib.SMTPRecipientsRefused:
+            raise
+        except Exception:
+            discard = True
+            raise
+        finally:
+            self._release(client, discard)
+
+    async def sendmail(self, from_addr, to_addr, data):
+        async with self._slots:
+            try:
+                await self._send_once(from_addr, to_addr, data)
+            except smtplib.SMTPServerDisconnected:
+                logger.info(f"SMTP session for {self.account['email']} dropped, reconnecting")
+                await self._send_once(from_addr, to_addr, data)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(client.quit() for client in idle), *self._closing)
+
+
+class AsyncCampaignRunner:
+    """Drives a Campaign with `concurrency` coroutines on one event loop"""
+
+    def __init__(self, campaign, concurrency, pool_options=None):
+        self.campaign = campaign
+        self.concurrency = max(1, int(concurrency))
+        self.pool_options = pool_options or {}
+        self.pools = {}
+        # Futures of senders waiting for an account, oldest first
+        self._waiters = collections.deque()
+
+    def _pool(self, account):
+        pool = self.pools.get(account['id'])
+        if pool is None:
+            pool = AsyncSMTPPool(account, max_sessions=self.concurrency, **self.pool_options)
+            self.pools[account['id']] = pool
+        return pool
+
+    def _wake(self, everyone=False):
+        """Wake the longest-waiting sender, or all of them"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                if not everyone:
+                    return
+
+    def _time_out(self, waiter):
+        if not waiter.done():
+            self._waiters.remove(waiter)
+            waiter.set_result(None)
+
+    async def _acquire_account(self, avoid):
+        while True:
+            account, wait = self.campaign.account_scheduler.try_acquire(avoid)
+            if account is not None:
+                return account
+            # Sleep until a token is due or another send finishes
+            loop = asyncio.get_running_loop()
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            timer = loop.call_later(wait if wait is not None else 1.0, self._time_out, waiter)
+            try:
+                await waiter
+            finally:
+                timer.cancel()
+
+    async def _deliver(self, account, email, content):
+        if account['type'] == 'gmail':
+            payload = self.campaign.gmail_payload(account, email, content)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.campaign.send_gmail, account, payload)
+            logger.info(f'Email sent to {email} via Gmail API using account {account["email"]}')
+        else:
+            if isinstance(content, tuple):
+                data = self.campaign.build_message(account, email, *content)
+            else:
+                data = content.with_sender(account['username'])
+            await self._pool(account).sendmail(account['username'], email, data)
+            logger.info(f'Email sent to {email} via SMTP using account {account["email"]}')
+
+    async def _process(self, job):
+        account = None
+        try:
+            content = self.campaign.render(job)
+            account = await self._acquire_account(job[4])
+            if self.campaign.journal:
+                # The dispatch record must be on disk before the message leaves
+                await asyncio.wrap_future(self.campaign.journal.dispatched(job[0]))
+            if account['type'] == 'gmail' and self.campaign.gmail_batcher:
+                # The coroutine moves on while the message waits for its batch
+                self.campaign.submit_gmail(job, account, content)
+                return
+            started = time.monotonic()
+            await self._deliver(account, job[0], content)
+        except Exception as e:
+            self.campaign.finish(job, account, error=e)
+            return
+        self.campaign.finish(job, account, latency=time.monotonic() - started)
+
+    async def _worker(self, index):
+        while True:
+            if not self.campaign.has_slot(index):
+                # Parked: beyond the campaign's share of the connection budget
+                if self.campaign.is_drained():
+                    return
+                await asyncio.sleep(0.05)
+                continue
+            job = self.campaign.take_job()
+            if job is None:
+                if self.campaign.is_drained():
+                    return
+                due = self.campaign.retry_queue.next_due()
+                await asyncio.sleep(min(due, 0.5) if due is not None else 0.01)
+                continue
+            await self._process(job)
+
+    @contextlib.contextmanager
+    def _watch_capacity(self):
+        """Wake a waiting sender for each released send, and all of them when a rate limit changes"""
+        scheduler = self.campaign.account_scheduler
+        loop = asyncio.get_running_loop()
+        loop_thread = threading.get_ident()
+
+        # Sends are released on the loop; limits change on request threads
+        def released():
+            if threading.get_ident() == loop_thread:
+                self._wake()
+            else:
+                loop.call_soon_threadsafe(self._wake)
+
+        def limit_changed():
+            loop.call_soon_threadsafe(self._wake, True)
+
+        scheduler.add_listener(released)
+        scheduler.rate_limiter.add_listener(limit_changed)
+        try:
+            yield
+        finally:
+            scheduler.remove_listener(released)
+            scheduler.rate_limiter.remove_listener(limit_changed)
+
+    async def run(self):
+        try:
+            with self._watch_capacity():
+                await asyncio.gather(*(self._worker(index) for index in range(self.concurrency)))
+        finally:
+            await asyncio.gather(*(pool.close() for pool in self.pools.values()))
+        self.campaign.check_completed()
+
+    def start(self):
+        """Run the campaign's event loop on a single background thread"""
+        thread = threading.Thread(target=asyncio.run, args=(self.run(),))
+        thread.daemon = True
+        thread.start()
+        return thread
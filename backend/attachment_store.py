@@ -0,0 +1,233 @@
+"""Uploaded attachments, stored once per distinct content."""
+import base64
+import hashlib
+import json
+import logging
+import mimetypes
+import mmap
+import os
+import tempfile
+import threading
+import time
+from attachments import AttachmentSnapshot, EncodedAttachment
+
+logger = logging.getLogger(__name__)
+
+# A multiple of the 57 bytes base64 puts on each 76-character line, so chunks encode to whole lines
+CHUNK_SIZE = 57 * 16384
+MANIFEST = 'manifest.json'
+ENCODED_SUFFIX = '.b64'
+
+
+def encode_chunk(chunk):
+    """Base64 of a chunk in CRLF-terminated lines, as attachment payloads are sent"""
+    return base64.encodebytes(chunk).replace(b'\n', b'\r\n')
+
+
+def attachment_name(filename):
+    """The file name part of an uploaded file's name, without any directories"""
+    return os.path.basename((filename or '').replace('\\', '/')).strip()
+
+
+class AttachmentStore:
+    """Attachments by name, with their content stored under its SHA-256
+
+    Uploads are streamed to disk and hashed in chunks; a file with the same
+    content as one already stored only adds a name to the manifest. The
+    manifest maps each name to the content's hash, size and MIME type.
+    Next to each file a sidecar holds its base64 encoding exactly as it is
+    sent, written once during the upload. Campaigns map sidecars read-only
+    and send straight from the mapping, so every process sending the same
+    attachment shares one copy in the page cache.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        # Sidecar mappings by hash, opened once per process
+        self._mapped = {}
+        manifest_path = os.path.join(folder, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        else:
+            self._entries = {}
+
+    def _path(self, digest):
+        return os.path.join(self.folder, digest)
+
+    def _encoded_path(self, digest):
+        return os.path.join(self.folder, digest + ENCODED_SUFFIX)
+
+    def _write_manifest(self):
+        """Replace the manifest file in one step (lock held)"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, os.path.join(self.folder, MANIFEST))
+
+    def _referenced(self, digest):
+        return any(entry['hash'] == digest for entry in self._entries.values())
+
+    def save(self, filename, stream, mime_type=None):
+        """Store a file-like object's content under a name, replacing any attachment of that name"""
+        name = attachment_name(filename)
+        if not name or name == MANIFEST:
+            raise ValueError(f"Invalid attachment name: {filename}")
+        digest = hashlib.sha256()
+        size = 0
+        encoded_size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        encoded_fd, encoded_tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            # Hash, store and encode in one pass over the upload
+            with os.fdopen(fd, 'wb') as f, os.fdopen(encoded_fd, 'wb') as encoded_file:
+                pending = b''
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+                    pending += chunk
+                    if len(pending) >= CHUNK_SIZE:
+                        whole = len(pending) - len(pending) % CHUNK_SIZE
+                        encoded_size += encoded_file.write(encode_chunk(pending[:whole]))
+                        pending = pending[whole:]
+                encoded_size += encoded_file.write(encode_chunk(pending))
+            digest = digest.hexdigest()
+            with self._lock:
+                if os.path.exists(self._path(digest)):
+                    os.remove(tmp_path)
+                    os.remove(encoded_tmp_path)
+                else:
+                    # The sidecar first: stored content always has one
+                    os.replace(encoded_tmp_path, self._encoded_path(digest))
+                    os.replace(tmp_path, self._path(digest))
+                previous = self._entries.get(name)
+                entry = {
+                    "hash": digest,
+                    "size": size,
+                    "encodedSize": encoded_size,
+                    "mimeType": mimetypes.guess_type(name)[0] or mime_type or 'application/octet-stream',
+                    "uploadedAt": time.time()
+                }
+                self._entries[name] = entry
+                self._write_manifest()
+                if previous and not self._referenced(previous['hash']):
+                    self._discard(previous['hash'])
+        except BaseException:
+            for path in (tmp_path, encoded_tmp_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        return {"filename": name, **entry}
+
+    def _discard(self, digest):
+        """Delete content no name refers to any more (lock held)
+
+        Campaigns still sending it keep their mapping; the pages go once they finish.
+        """
+        os.remove(self._path(digest))
+        if os.path.exists(self._encoded_path(digest)):
+            os.remove(self._encoded_path(digest))
+        self._mapped.pop(digest, None)
+
+    def delete(self, filename):
+        """Remove an attachment by name; False if there is none"""
+        with self._lock:
+            entry = self._entries.pop(filename, None)
+            if entry is None:
+                return False
+            self._write_manifest()
+            if not self._referenced(entry['hash']):
+                self._discard(entry['hash'])
+        return True
+
+    def list(self):
+        with self._lock:
+            return [{"filename": name, **entry} for name, entry in sorted(self._entries.items())]
+
+    def __contains__(self, filename):
+        return filename in self._entries
+
+    def _write_encoded(self, digest):
+        """Create a missing sidecar from the stored content (lock held)"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with open(self._path(digest), 'rb') as f, os.fdopen(fd, 'wb') as encoded_file:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    encoded_file.write(encode_chunk(chunk))
+            os.replace(tmp_path, self._encoded_path(digest))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def encoded(self, digest):
+        """Read-only view of the sent form of stored content, mapped from its sidecar"""
+        with self._lock:
+            view = self._mapped.get(digest)
+            if view is None:
+                if not os.path.exists(self._encoded_path(digest)):
+                    # Stored before sidecars were written at upload
+                    self._write_encoded(digest)
+                with open(self._encoded_path(digest), 'rb') as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        view = b''  # An empty file can't be mapped
+                    else:
+                        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                self._mapped[digest] = view
+            return view
+
+    def snapshot(self, templates, default_template):
+        """The attachments each template sends, frozen for one campaign
+
+        A template lists the names it sends under `attachments`; one without
+        that key sends every stored attachment, as before attachments could
+        be chosen per template. Contacts whose template isn't found get the
+        default template's attachments.
+        """
+        with self._lock:
+            entries = dict(self._entries)
+        loaded = {}
+
+        def load(name):
+            if name not in loaded:
+                entry = entries[name]
+                loaded[name] = EncodedAttachment(name, self.encoded(entry['hash']), entry['size'], entry['mimeType'])
+            return loaded[name]
+
+        sets = {}
+        for template_id, template in templates.items():
+            names = template.get('attachments')
+            if names is None:
+                names = sorted(entries)
+            missing = [name for name in names if name not in entries]
+            if missing:
+                raise ValueError(f"Template {template.get('name', template_id)} uses missing attachments: "
+                                 f"{', '.join(missing)}")
+            sets[template_id] = tuple(load(name) for name in names)
+        snapshot = AttachmentSnapshot(sets, default=sets.get(default_template.get('id'), ()) if default_template else ())
+        logger.info(f"Attachment snapshot: {len(loaded)} files, {snapshot.total_size} bytes")
+        return snapshot
+
+    def import_folder(self, folder, exclude=('contacts.csv',)):
+        """Move the files of an earlier version's data/ folder into the store"""
+        imported = 0
+        for filename in sorted(os.listdir(folder)):
+            path = os.path.join(folder, filename)
+            if filename in exclude or not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                self.save(filename, f)
+            os.remove(path)
+            imported += 1
+        if imported:
+            logger.info(f"Imported {imported} attachments from {folder}")
+        return imported
@@ -0,0 +1,64 @@
+"""Campaign attachments, read and base64-encoded once per campaign."""
+import logging
+from email.mime.base import MIMEBase
+
+logger = logging.getLogger(__name__)
+
+
+class EncodedAttachment:
+    """An attachment whose base64 payload has already been computed
+
+    `encoded` is the payload as sent: base64 in CRLF-terminated lines of 76
+    characters, usually a memoryview of the attachment's pre-encoded file.
+    """
+
+    __slots__ = ('filename', 'size', 'encoded', 'mime_type')
+
+    def __init__(self, filename, encoded, size, mime_type='application/octet-stream'):
+        self.filename = filename
+        self.size = size
+        self.encoded = encoded
+        self.mime_type = mime_type
+
+    def mime_part(self):
+        """Build a MIME part around the pre-encoded payload"""
+        part = MIMEBase(*self.mime_type.split('/', 1))
+        part.set_payload(bytes(self.encoded).replace(b'\r\n', b'\n').decode('ascii'))
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header('Content-Disposition', f'attachment; filename={self.filename}')
+        return part
+
+
+class AttachmentSnapshot:
+    """The attachments of one campaign, frozen when the campaign starts
+
+    `sets` maps each template id to the attachments its messages carry;
+    any other template id gets `default`.
+    """
+
+    def __init__(self, sets=None, default=()):
+        self.sets = {template_id: tuple(attachments) for template_id, attachments in (sets or {}).items()}
+        self.default = tuple(default)
+
+    def for_template(self, template_id):
+        return self.sets.get(template_id, self.default)
+
+    def outline(self):
+        """The same sets without payloads, to tell worker processes which templates have attachments"""
+        def strip(attachments):
+            return tuple(EncodedAttachment(a.filename, b'', a.size, a.mime_type) for a in attachments)
+        return AttachmentSnapshot({template_id: strip(attachments) for template_id, attachments in self.sets.items()},
+                                  strip(self.default))
+
+    @property
+    def total_size(self):
+        # Each distinct attachment once, however many templates carry it
+        distinct = {id(a): a for attachments in [self.default, *self.sets.values()] for a in attachments}
+        return sum(a.size for a in distinct.values())
+
+    def attach_to(self, message, template_id=None):
+        for attachment in self.for_template(template_id):
+            message.attach(attachment.mime_part())
+
+    def __len__(self):
+        return len({id(a) for attachments in [self.default, *self.sets.values()] for a in attachments})
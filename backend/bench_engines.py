@@ -0,0 +1,161 @@
+"""Benchmark the threaded and asyncio campaign engines against a local SMTP sink.
+
+Starts an asyncio SMTP sink in its own process, then runs the same campaign
+through each engine in a fresh interpreter and reports messages per second
+and peak RSS. Only the standard library is needed:
+
+    python bench_engines.py --messages 5000 --concurrency 200 --latency 0.02
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+
+class SinkServer:
+    """Accepts any SMTP conversation and discards the messages"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    async def handle(self, reader, writer):
+        writer.write(b'220 sink ready\r\n')
+        in_data = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if in_data:
+                    if line == b'.\r\n':
+                        in_data = False
+                        if self.latency:
+                            await asyncio.sleep(self.latency)
+                        writer.write(b'250 queued\r\n')
+                    continue
+                command = line[:4].upper()
+                if command == b'EHLO':
+                    writer.write(b'250-sink\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n')
+                elif command == b'AUTH':
+                    writer.write(b'235 authenticated\r\n')
+                elif command == b'DATA':
+                    in_data = True
+                    writer.write(b'354 go ahead\r\n')
+                elif command == b'QUIT':
+                    writer.write(b'221 bye\r\n')
+                    break
+                else:
+                    writer.write(b'250 ok\r\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port, ready):
+        server = await asyncio.start_server(self.handle, '127.0.0.1', port, backlog=1024)
+        ready.value = server.sockets[0].getsockname()[1]
+        async with server:
+            await server.serve_forever()
+
+
+def run_sink(latency, ready):
+    asyncio.run(SinkServer(latency).serve(0, ready))
+
+
+def run_engine(engine, port, messages, concurrency, accounts):
+    """Send `messages` through one engine and return its measurements"""
+    from account_scheduler import AccountScheduler
+    from async_engine import AsyncCampaignRunner
+    from attachments import AttachmentSnapshot
+    from campaign import Campaign
+    from contact_source import ContactProducer
+    from rate_limit import AccountRateLimiter
+    from smtp_pool import SMTPPoolManager
+    from templating import TemplateCache
+
+    logging.disable(logging.INFO)
+    sending_accounts = [{
+        'id': f'bench-{i}', 'type': 'smtp', 'email': f'bench{i}@localhost',
+        'host': '127.0.0.1', 'port': port, 'username': f'bench{i}@localhost',
+        'password': 'bench', 'starttls': False
+    } for i in range(accounts)]
+    template = {'subject': 'Benchmark', 'content': 'Hello [NAME],\n\nThis is a benchmark message.'}
+    status = {'is_running': True, 'remaining': 0, 'total': 0, 'errors': [], 'completed': False}
+    status_lock = threading.Lock()
+    contacts = ContactProducer(((f'user{i}@example.com', {'name': f'User {i}'}, 'bench') for i in range(messages)),
+                               status, status_lock)
+    per_account = max(1, concurrency // accounts)
+    # Same scheduler settings as a campaign started with max_connections=concurrency
+    scheduler = AccountScheduler(sending_accounts, AccountRateLimiter(), max_concurrency=concurrency)
+    pools = SMTPPoolManager(max_sessions=per_account, max_messages=1000)
+    campaign = Campaign(contacts, TemplateCache(lambda template_id: template).get, AttachmentSnapshot(), scheduler,
+                        1, status, status_lock, pools, None)
+
+    started = time.monotonic()
+    contacts.start()
+    if engine == 'async':
+        asyncio.run(AsyncCampaignRunner(campaign, concurrency, {'max_messages': 1000}).run())
+    else:
+        for thread in campaign.start_threads(concurrency):
+            thread.join()
+    elapsed = time.monotonic() - started
+    pools.close_all()
+
+    return {
+        'engine': engine,
+        'messages': status['total'] - status['remaining'],
+        'errors': len(status['errors']),
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(messages / elapsed, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--accounts', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.02, help="sink delay per message, seconds")
+    parser.add_argument('--engines', default='threads,async')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_engine(args.run, args.port, args.messages, args.concurrency, args.accounts)))
+        return
+
+    ready = multiprocessing.Value('i', 0)
+    sink = multiprocessing.Process(target=run_sink, args=(args.latency, ready), daemon=True)
+    sink.start()
+    while not ready.value:
+        time.sleep(0.01)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        for engine in args.engines.split(','):
+            # A fresh interpreter per engine keeps the RSS figures independent
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run', engine, '--port', str(ready.value),
+                 '--messages', str(args.messages), '--concurrency', str(args.concurrency),
+                 '--accounts', str(args.accounts)],
+                cwd=here, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{result['engine']:>8}: {result['messages_per_second']:>8} msg/s  "
+                  f"{result['peak_rss_mb']:>7} MB peak RSS  "
+                  f"({result['messages']} sent, {result['errors']} errors in {result['seconds']} s)")
+    finally:
+        sink.terminate()
+
+
+if __name__ == '__main__':
+    main()
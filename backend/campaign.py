@@ -0,0 +1,332 @@
+"""Campaign send engine shared by the threaded and asyncio workers."""
+import base64
+import collections
+import logging
+import queue
+import threading
+import time
+from message_builder import MessageBuilder
+from retry import DEFAULT_POLICIES, DelayQueue, classify_error, error_details, recipient_rejected
+
+logger = logging.getLogger(__name__)
+
+# Seconds a due retry waits while its recipient's domain is at its concurrency or rate cap
+DOMAIN_DEFER_DELAY = 0.05
+
+
+class Campaign:
+    """State and per-message logic of one running campaign
+
+    Contacts come from a ContactProducer, or a RenderStage that adds the
+    pre-rendered message. A job is a tuple
+    (email, fields, template_id, attempt, failed_account_id, rendered), where
+    fields holds the contact's CSV columns. resolve_template returns the
+    CompiledTemplate for a template id.
+    Workers take jobs with next_job() (threads) or take_job() (coroutines),
+    and report every outcome through finish(), which owns the retry, status
+    and error bookkeeping for both engines. With a ConnectionBudget, worker
+    `index` only sends while it is within the campaign's allowance. With a
+    DomainScheduler as the contact source, pass it as `domains` too so
+    retries and finished sends count against the recipient domain's caps.
+    Addresses that hard-bounce are added to the `suppression` list, and
+    every final failure is recorded in `dead_letters` for a later re-drive.
+    """
+
+    def __init__(self, contacts, resolve_template, attachments, account_scheduler, retries,
+                 status, status_lock, smtp_pools, gmail_services, journal=None,
+                 campaign_id=None, budget=None, gmail_batcher=None, domains=None,
+                 suppression=None, dead_letters=None):
+        self.contacts = contacts
+        self.resolve_template = resolve_template
+        self.attachments = attachments
+        self.message_builder = MessageBuilder(attachments)
+        self.account_scheduler = account_scheduler
+        self.retries = retries
+        self.status = status
+        self.status_lock = status_lock
+        self.smtp_pools = smtp_pools
+        self.gmail_services = gmail_services
+        self.gmail_batcher = gmail_batcher
+        # Failed sends wait here for their backoff instead of blocking a worker
+        self.retry_queue = DelayQueue()
+        self.in_flight = 0
+        self.journal = journal
+        self.campaign_id = campaign_id
+        self.budget = budget
+        self.domains = domains
+        self.suppression = suppression
+        self.dead_letters = dead_letters
+        self.failure_counts = collections.Counter()
+        self._draining = False
+        self._completed = False
+        self._stopped = threading.Event()
+
+    def _start(self, job):
+        with self.status_lock:
+            # Checked under the lock so a stopped campaign never gains in-flight work
+            if self._stopped.is_set():
+                return None
+            self.in_flight += 1
+        return job
+
+    def _new_job(self, contact):
+        rendered = contact[3] if len(contact) > 3 else None
+        return self._start((contact[0], contact[1], contact[2], 0, None, rendered))
+
+    def take_job(self):
+        """A retry that has come due, else a fresh contact, else None"""
+        while True:
+            job = self.retry_queue.pop_due()
+            if job is None:
+                break
+            if self.domains and not self.domains.try_start(job[0]):
+                # The recipient's domain is at its cap; look again shortly and send other work meanwhile
+                self.retry_queue.put(job, DOMAIN_DEFER_DELAY)
+                continue
+            started = self._start(job)
+            if started is None and self.domains:
+                self.domains.release(job[0], success=False)
+            return started
+        try:
+            contact = self.contacts.get_nowait()
+        except queue.Empty:
+            return None
+        return self._new_job(contact)
+
+    def is_drained(self):
+        """True once there are no contacts, pending retries or sends in flight"""
+        if self._stopped.is_set():
+            return True
+        with self.status_lock:
+            if self.contacts.exhausted() and not len(self.retry_queue) and self.in_flight == 0:
+                # Nothing can add work from here on, so requeue() stops accepting any
+                self._draining = True
+            return self._draining
+
+    def next_job(self):
+        """Blocking take_job() for worker threads; None once the campaign is drained"""
+        while True:
+            job = self.take_job()
+            if job is not None:
+                return job
+            if self.is_drained():
+                return None
+            # Wait for the producer to read more contacts or for a retry to come due
+            due = self.retry_queue.next_due()
+            contact = self.contacts.get(timeout=min(due, 0.5) if due is not None else 0.5)
+            if contact is not None:
+                return self._new_job(contact)
+
+    def render(self, job):
+        """The job's pre-rendered message, else a (subject, body, template_id) tuple"""
+        email, fields, template_id, _, _, rendered = job
+        if isinstance(rendered, Exception):
+            raise rendered  # Rendering failed in a worker process
+        if rendered is not None:
+            return rendered
+        template = self.resolve_template(template_id)
+        if not template:
+            raise ValueError(f"No template found for ID {template_id}")
+        # The id of the template actually used, which picks the attachments
+        return (*template.render(fields), template.template_id)
+
+    def build_message(self, account, email, subject, email_body, template_id=None):
+        """WireMessage of a message sent through the given account"""
+        sender = None if account['type'] == 'gmail' else account['username']
+        return self.message_builder.build(email, subject, email_body, sender, template_id)
+
+    def send_gmail(self, account, encoded_message):
+        # Send the message on a cached client for this account
+        with self.gmail_services.service(account) as service:
+            service.users().messages().send(userId="me", body={'raw': encoded_message}).execute()
+
+    def gmail_payload(self, account, email, content):
+        if isinstance(content, tuple):
+            return base64.urlsafe_b64encode(bytes(self.build_message(account, email, *content))).decode()
+        return content.gmail_payload()
+
+    def submit_gmail(self, job, account, content):
+        """Queue a message for the account's Gmail batch; finish() runs once the batch has been sent"""
+        email = job[0]
+        started = time.monotonic()
+        future = self.gmail_batcher.submit(account, self.gmail_payload(account, email, content))
+
+        def sent(future):
+            error = future.exception()
+            if error is not None:
+                self.finish(job, account, error=error)
+                return
+            logger.info(f'Email sent to {email} via Gmail API batch using account {account["email"]}')
+            self.finish(job, account, latency=time.monotonic() - started)
+
+        future.add_done_callback(sent)
+
+    def deliver(self, account, email, content):
+        """Send one message, as returned by render(), through the given account"""
+        if account['type'] == 'gmail':
+            self.send_gmail(account, self.gmail_payload(account, email, content))
+            logger.info(f'Email sent to {email} via Gmail API using account {account["email"]}')
+        else:
+            # Reuse an authenticated session from the account's pool
+            if isinstance(content, tuple):
+                data = self.build_message(account, email, *content)
+            else:
+                data = content.with_sender(account['username'])
+            self.smtp_pools.get(account).sendmail(account['username'], [email], data)
+            logger.info(f'Email sent to {email} via SMTP using account {account["email"]}')
+
+    def record_failure(self, job, account, error, error_class):
+        """Count a final failure and keep a structured record of it"""
+        email, fields, template_id, attempt, _, _ = job
+        with self.status_lock:
+            self.failure_counts[error_class] += 1
+        if self.journal:
+            self.journal.failed(email)
+        if self.dead_letters is not None:
+            code, reason = error_details(error)
+            self.dead_letters.add({
+                'campaignId': self.campaign_id,
+                'email': email,
+                'templateId': template_id,
+                'fields': fields,
+                'accountId': account['id'] if account else None,
+                'accountEmail': account['email'] if account else None,
+                'code': code,
+                'reason': reason[:500] if reason else reason,
+                'errorClass': error_class,
+                'retryable': DEFAULT_POLICIES[error_class].retryable,
+                'attempts': attempt + 1,
+                'failedAt': time.time()
+            })
+
+    def finish(self, job, account, error=None, latency=None):
+        """Record the outcome of a job: success, scheduled retry or final failure"""
+        email, fields, template_id, attempt, _, rendered = job
+        finished = True
+        if error is None:
+            self.account_scheduler.release(account, success=True, latency=latency)
+            if self.journal:
+                self.journal.succeeded(email)
+        elif account is None:
+            # Failed before an account was chosen (missing template, no quota left)
+            logger.error(f"Worker error: {error}")
+            self.status['errors'].append(str(error))
+            self.record_failure(job, None, error, classify_error(error))
+        else:
+            error_class = classify_error(error)
+            self.account_scheduler.release(account, success=False, error_class=error_class)
+            logger.error(f'Error sending to {email} using account {account["email"]}: {error}')
+            policy = DEFAULT_POLICIES[error_class]
+            if policy.retryable and attempt < self.retries:
+                # Schedule the retry and move on to other recipients meanwhile
+                self.retry_queue.put((email, fields, template_id, attempt + 1, account['id'], rendered),
+                                     policy.delay(attempt + 1))
+                finished = False
+                if self.journal:
+                    self.journal.retrying(email)
+            else:
+                self.status['errors'].append(f"Failed to send to {email}: {str(error)}")
+                logger.error(f"Failed to send email to {email} after {attempt + 1} attempts")
+                self.record_failure(job, account, error, error_class)
+                if self.suppression is not None and recipient_rejected(error):
+                    # Never send to this address again, from any campaign
+                    self.suppression.add([email], reason=f"bounce: {str(error)[:200]}")
+
+        if self.domains:
+            self.domains.release(email, success=error is None)
+        with self.status_lock:
+            self.in_flight -= 1
+            if finished:
+                self.status['remaining'] -= 1
+
+    def requeue(self, contacts):
+        """Add (email, fields, template_id) contacts to this running campaign; False once it is winding down"""
+        with self.status_lock:
+            if self._stopped.is_set() or self._draining:
+                return False
+            self.status['total'] += len(contacts)
+            self.status['remaining'] += len(contacts)
+            # Queued under the lock so is_drained() can't see the campaign empty in between
+            for email, fields, template_id in contacts:
+                if self.journal:
+                    # Not skipped if the campaign is resumed before they are sent
+                    self.journal.retrying(email)
+                self.retry_queue.put((email, fields, template_id, 0, None, None), 0)
+        return True
+
+    def has_slot(self, index):
+        """True if worker `index` is within this campaign's share of the connection budget"""
+        return self.budget is None or index < self.budget.allowance(self.campaign_id)
+
+    def stop(self):
+        """Stop taking new jobs; sends already in flight still finish"""
+        self._stopped.set()
+        self.contacts.stop()
+
+    def check_completed(self):
+        # Check if all emails are sent, or if a stopped campaign has wound down
+        with self.status_lock:
+            stopped = self._stopped.is_set()
+            if self._completed:
+                return
+            if stopped:
+                if self.in_flight > 0:
+                    return
+            elif self.status['remaining'] > 0:
+                return
+            self._completed = True
+        if self.budget:
+            self.budget.unregister(self.campaign_id)
+        self.status['is_running'] = False
+        if stopped:
+            # The journal stays unfinished so the campaign can be resumed
+            if self.journal:
+                self.journal.close()
+            logger.info(f"Campaign {self.campaign_id} stopped")
+            return
+        self.status['completed'] = True
+        if self.journal:
+            self.journal.complete()
+        logger.info(f"Campaign {self.campaign_id} completed!")
+
+    def process(self, job):
+        account = None
+        try:
+            content = self.render(job)
+            account = self.account_scheduler.acquire(avoid=job[4])
+            if self.journal:
+                # The dispatch record must be on disk before the message leaves
+                self.journal.dispatched(job[0]).result()
+            if account['type'] == 'gmail' and self.gmail_batcher:
+                # The worker moves on while the message waits for its batch
+                self.submit_gmail(job, account, content)
+                return
+            started = time.monotonic()
+            self.deliver(account, job[0], content)
+        except Exception as e:
+            self.finish(job, account, error=e)
+            return
+        self.finish(job, account, latency=time.monotonic() - started)
+
+    def worker(self, index=0):
+        while True:
+            # Park while this worker is beyond the campaign's share of the budget
+            if self.budget and not self.budget.wait_for_slot(self.campaign_id, index):
+                if self.is_drained():
+                    break
+                continue
+            job = self.next_job()
+            if job is None:
+                break
+            self.process(job)
+        self.check_completed()
+
+    def start_threads(self, max_connections):
+        """Run the campaign on max_connections worker threads"""
+        threads = []
+        for index in range(max_connections):
+            thread = threading.Thread(target=self.worker, args=(index,))
+            thread.daemon = True  # Make thread daemon so it exits when main thread exits
+            thread.start()
+            threads.append(thread)
+        return threads
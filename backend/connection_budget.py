@@ -0,0 +1,86 @@
+"""Global connection budget shared by concurrently running campaigns."""
+import threading
+
+
+def split_budget(total, campaigns):
+    """Allocate `total` connections to campaigns given as {id: (demand, weight, priority)}
+
+    Higher priorities are served first. Within a priority the connections
+    are split in proportion to weight, no campaign gets more than it asked
+    for, and what one campaign cannot use goes to the others.
+    """
+    allocation = {campaign_id: 0 for campaign_id in campaigns}
+    remaining = total
+    for priority in sorted({c[2] for c in campaigns.values()}, reverse=True):
+        band = {cid: c for cid, c in campaigns.items() if c[2] == priority}
+        while band and remaining > 0:
+            total_weight = sum(c[1] for c in band.values())
+            shares = {cid: remaining * c[1] / total_weight for cid, c in band.items()}
+            capped = [cid for cid, c in band.items() if c[0] <= shares[cid]]
+            if capped:
+                # Fully serve campaigns that want less than their share, then split the rest again
+                for cid in capped:
+                    allocation[cid] = band.pop(cid)[0]
+                    remaining -= allocation[cid]
+                continue
+            # Whole shares first, then the leftover by largest fraction (earliest campaign on ties)
+            for cid in band:
+                allocation[cid] = int(shares[cid])
+            leftover = remaining - sum(allocation[cid] for cid in band)
+            for cid in sorted(band, key=lambda cid: allocation[cid] - shares[cid])[:leftover]:
+                allocation[cid] += 1
+            remaining = 0
+    return allocation
+
+
+class ConnectionBudget:
+    """Caps concurrent sends across all campaigns and splits them fairly
+
+    Each campaign registers the number of workers it wants, a weight and a
+    priority. Allowances are recomputed whenever a campaign starts or ends;
+    a campaign's worker `index` may only send while it is below the
+    campaign's allowance, otherwise it stays parked.
+    """
+
+    def __init__(self, total):
+        self.total = max(1, int(total))
+        self._campaigns = {}
+        self._allowances = {}
+        self._cond = threading.Condition()
+
+    def _rebalance(self):
+        self._allowances = split_budget(self.total, self._campaigns)
+        self._cond.notify_all()
+
+    def register(self, campaign_id, demand, weight=1, priority=0):
+        with self._cond:
+            self._campaigns[campaign_id] = (max(1, int(demand)), max(float(weight), 0.01), int(priority))
+            self._rebalance()
+
+    def unregister(self, campaign_id):
+        with self._cond:
+            if self._campaigns.pop(campaign_id, None) is not None:
+                self._allowances.pop(campaign_id, None)
+                self._rebalance()
+
+    def allowance(self, campaign_id):
+        with self._cond:
+            return self._allowances.get(campaign_id, 0)
+
+    def wait_for_slot(self, campaign_id, index, timeout=0.5):
+        """Wait up to `timeout` seconds for worker `index` to be within the allowance"""
+        with self._cond:
+            return self._cond.wait_for(lambda: index < self._allowances.get(campaign_id, 0), timeout)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'total': self.total,
+                'campaigns': [{
+                    'campaignId': campaign_id,
+                    'demand': demand,
+                    'weight': weight,
+                    'priority': priority,
+                    'connections': self._allowances.get(campaign_id, 0)
+                } for campaign_id, (demand, weight, priority) in self._campaigns.items()]
+            }
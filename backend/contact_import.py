@@ -0,0 +1,134 @@
+"""Normalization, validation and de-duplication of imported contacts."""
+import re
+from array import array
+
+# Practical address syntax: dot-atom local part, dotted hostname with an alphabetic or IDNA top-level label
+EMAIL = re.compile(r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+                   r"@(?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+(?:[A-Za-z]{2,63}|xn--[A-Za-z0-9-]{1,59})")
+MAX_EMAIL_LENGTH = 254
+MAX_LOCAL_LENGTH = 64
+MAX_INVALID_SAMPLES = 10
+
+
+def normalize_email(email):
+    """Canonical form of an address (trimmed, lowercased), or None if it isn't valid"""
+    email = email.strip().strip('<>').strip().lower()
+    if len(email) > MAX_EMAIL_LENGTH or not EMAIL.fullmatch(email):
+        return None
+    if email.index('@') > MAX_LOCAL_LENGTH:
+        return None
+    return email
+
+
+class HashIndex:
+    """Set of strings kept in an open-addressing table of 64-bit hashes
+
+    The strings themselves are appended, UTF-8 encoded, to one bytearray
+    that each slot points into, and a hash match is confirmed against
+    them, so two addresses with the same hash are still told apart. That
+    takes 16 bytes per slot, 27 to 53 per entry depending on load, plus
+    the address, instead of the ~100 a set of strings needs, so tens of
+    millions of addresses fit in memory. Strings must not contain a newline.
+    """
+
+    MAX_LOAD = 0.6
+
+    def __init__(self, capacity=1 << 16):
+        self._slots = array('Q', bytes(8 * capacity))
+        # Offset in _data of the string in each occupied slot
+        self._offsets = array('Q', bytes(8 * capacity))
+        self._data = bytearray()
+        self._mask = capacity - 1
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _hash(value):
+        # Zero marks an empty slot
+        return hash(value) & 0xFFFFFFFFFFFFFFFF or 1
+
+    def _grow(self):
+        old_slots = self._slots
+        old_offsets = self._offsets
+        capacity = len(old_slots) * 2
+        self._slots = slots = array('Q', bytes(8 * capacity))
+        self._offsets = offsets = array('Q', bytes(8 * capacity))
+        self._mask = mask = capacity - 1
+        for h, offset in zip(old_slots, old_offsets):
+            if h:
+                index = h & mask
+                while slots[index]:
+                    index = (index + 1) & mask
+                slots[index] = h
+                offsets[index] = offset
+
+    def _stored(self, offset, encoded):
+        return self._data[offset:offset + len(encoded) + 1] == encoded + b'\n'
+
+    def add(self, value):
+        """Add a string; False if it was already present"""
+        h = self._hash(value)
+        encoded = value.encode()
+        slots = self._slots
+        mask = self._mask
+        index = h & mask
+        while True:
+            current = slots[index]
+            if current == h and self._stored(self._offsets[index], encoded):
+                return False
+            if not current:
+                break
+            index = (index + 1) & mask
+        slots[index] = h
+        self._offsets[index] = len(self._data)
+        self._data += encoded + b'\n'
+        self._size += 1
+        if self._size > self.MAX_LOAD * (mask + 1):
+            self._grow()
+        return True
+
+
+class ContactImport:
+    """Normalizes, validates and de-duplicates a stream of contact rows, counting each outcome
+
+    Rows are (email, name, template_id, fields) as the contact store takes
+    them; filter() yields the accepted ones with their canonical address.
+    Addresses in `suppressed` (e.g. the SuppressionList) are dropped.
+    """
+
+    def __init__(self, suppressed=None):
+        self.suppressed = suppressed
+        self.accepted = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.suppressed_count = 0
+        self.invalid_samples = []
+        self._seen = HashIndex()
+
+    def filter(self, rows):
+        for email, name, template_id, fields in rows:
+            normalized = normalize_email(email)
+            if normalized is None:
+                self.invalid += 1
+                if len(self.invalid_samples) < MAX_INVALID_SAMPLES:
+                    self.invalid_samples.append(email)
+                continue
+            if not self._seen.add(normalized):
+                self.duplicates += 1
+                continue
+            if self.suppressed is not None and normalized in self.suppressed:
+                self.suppressed_count += 1
+                continue
+            self.accepted += 1
+            yield normalized, name.strip() if name else '', template_id, fields
+
+    def counts(self):
+        return {
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "invalid": self.invalid,
+            "suppressed": self.suppressed_count,
+            "invalidSamples": self.invalid_samples
+        }
@@ -0,0 +1,77 @@
+"""Streams campaign contacts into a bounded queue as they are read."""
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ContactProducer:
+    """Feeds contacts from an iterator into a bounded queue on a background thread
+
+    Workers can start sending as soon as the first rows are parsed, and the
+    queue bound applies backpressure so only `maxsize` contacts are held in
+    memory however long the list is. `total` and `remaining` in the campaign
+    status grow as rows are read.
+    """
+
+    def __init__(self, contacts, status, status_lock, maxsize=10000):
+        self._contacts = iter(contacts)
+        self.status = status
+        self.status_lock = status_lock
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.count = 0
+        self.done = threading.Event()
+        self._stopped = threading.Event()
+
+    def _put(self, contact):
+        with self.status_lock:
+            self.status['total'] += 1
+            self.status['remaining'] += 1
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(contact, timeout=0.5)
+                self.count += 1
+                return
+            except queue.Full:
+                continue
+        # Stopped while waiting for room; this contact will never be sent
+        with self.status_lock:
+            self.status['total'] -= 1
+            self.status['remaining'] -= 1
+
+    def run(self):
+        try:
+            for contact in self._contacts:
+                if self._stopped.is_set():
+                    break
+                self._put(contact)
+        except Exception as e:
+            logger.error(f"Error reading contacts: {e}")
+            self.status['errors'].append(f"Error reading contacts: {str(e)}")
+        finally:
+            self.done.set()
+            logger.info(f"Contact producer finished after {self.count} contacts")
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+
+    def get_nowait(self):
+        return self.queue.get_nowait()
+
+    def get(self, timeout):
+        """Wait up to `timeout` seconds for a contact; None if none arrived"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def exhausted(self):
+        """True once every contact has been read and handed out"""
+        return self.done.is_set() and self.queue.empty()
@@ -0,0 +1,247 @@
+"""Contacts kept in an embedded SQLite database."""
+import contextlib
+import csv
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+from templating import field_key
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS contacts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,  -- never reused, so ids stay valid handles
+    email TEXT NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    template_id TEXT NOT NULL DEFAULT '',
+    fields TEXT  -- JSON object of any further CSV columns
+)
+"""
+INDEXES = {
+    'contacts_email': 'CREATE INDEX IF NOT EXISTS contacts_email ON contacts (email)',
+    'contacts_template_id': 'CREATE INDEX IF NOT EXISTS contacts_template_id ON contacts (template_id)'
+}
+
+# Columns that can be changed through update(), by their API names
+EDITABLE = {'email': 'email', 'name': 'name', 'templateId': 'template_id'}
+
+
+def text(value):
+    """A contact value as stored: templates render text, so null becomes '' and numbers their digits"""
+    return '' if value is None else str(value)
+
+
+def encode_fields(fields):
+    """JSON column for a contact's fields, with every value as text; None for no fields"""
+    if not fields:
+        return None
+    if not isinstance(fields, dict):
+        raise ValueError("Contact fields must be an object")
+    return json.dumps({key: text(value) for key, value in fields.items()})
+
+
+def read_csv(lines, process_contact):
+    """Lazily yield (email, name, template_id, fields) for every usable row of a contacts CSV
+
+    `fields` holds the columns after the first three, keyed by their
+    normalized header, for use as template placeholders.
+    """
+    reader = csv.reader(lines)
+    extra_columns = [field_key(column) for column in next(reader, [])][3:]
+    for row in reader:
+        email, name, template_id = process_contact(row)
+        if email:  # Only include if email exists
+            yield email, name, template_id, dict(zip(extra_columns, row[3:]))
+
+
+def read_lines(lines, template_id):
+    """Lazily yield contacts from a text file with one email address per line"""
+    for line in lines:
+        email = line.strip()
+        if email:  # Skip empty lines
+            yield email, '', template_id, None
+
+
+def filter_clause(filters):
+    """SQL conditions and parameters for contact filters
+
+    `q` matches email or name, `email` and `name` match part of that column
+    (case-insensitively) and `templateId` matches exactly.
+    """
+    conditions = []
+    params = []
+    for key, value in (filters or {}).items():
+        if key == 'templateId':
+            conditions.append('template_id = ?')
+            params.append(value)
+            continue
+        pattern = '%' + value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        if key == 'q':
+            conditions.append("(email LIKE ? ESCAPE '\\' OR name LIKE ? ESCAPE '\\')")
+            params += [pattern, pattern]
+        elif key in ('email', 'name'):
+            conditions.append(f"{key} LIKE ? ESCAPE '\\'")
+            params.append(pattern)
+        else:
+            raise ValueError(f"Unknown contact filter: {key}")
+    return ''.join(f' AND {condition}' for condition in conditions), params
+
+
+def contact_dict(row):
+    contact_id, email, name, template_id, fields = row
+    return {
+        "id": contact_id,
+        "email": email,
+        "name": name,
+        "templateId": template_id,
+        "fields": json.loads(fields) if fields else {}
+    }
+
+
+class ContactStore:
+    """Contact list in a SQLite file, indexed by email and template id
+
+    Each thread gets its own connection. The database runs in WAL mode, so
+    campaigns and listings keep reading while an import or edit is written,
+    and writers are serialized by a lock rather than SQLite's busy timeout.
+    Rows are (email, name, template_id, fields) with fields a dict or None.
+    """
+
+    def __init__(self, path, batch_size=5000):
+        self.path = path
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        with self._write() as conn:
+            conn.execute(SCHEMA)
+            for statement in INDEXES.values():
+                conn.execute(statement)
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _write(self):
+        """A write transaction; committed on success, rolled back on error"""
+        with self._write_lock:
+            conn = self._conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _insert(self, conn, rows):
+        """Insert rows in batches with executemany; returns the number inserted"""
+        count = 0
+        rows = ((email, text(name), text(template_id), encode_fields(fields))
+                for email, name, template_id, fields in rows)
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                return count
+            conn.executemany('INSERT INTO contacts (email, name, template_id, fields) VALUES (?, ?, ?, ?)', batch)
+            count += len(batch)
+
+    def replace(self, rows):
+        """Replace the whole list in one transaction; returns the new count"""
+        with self._write() as conn:
+            # Loading without indexes and building them afterwards is much faster for large lists
+            for index in INDEXES:
+                conn.execute(f'DROP INDEX IF EXISTS {index}')
+            conn.execute('DELETE FROM contacts')
+            count = self._insert(conn, rows)
+            for statement in INDEXES.values():
+                conn.execute(statement)
+        logger.info(f"Contact store replaced with {count} contacts")
+        return count
+
+    def add(self, rows):
+        """Append contacts; returns their ids"""
+        with self._write() as conn:
+            return [conn.execute('INSERT INTO contacts (email, name, template_id, fields) VALUES (?, ?, ?, ?)',
+                                 (email, text(name), text(template_id), encode_fields(fields))
+                                 ).lastrowid
+                    for email, name, template_id, fields in rows]
+
+    def update(self, contact_id, changes):
+        """Change a contact's email, name, templateId or fields; False if there is no such contact"""
+        assignments = [(EDITABLE[key], text(value)) for key, value in changes.items() if key in EDITABLE]
+        if 'fields' in changes:
+            assignments.append(('fields', encode_fields(changes['fields'])))
+        if not assignments:
+            return self.get(contact_id) is not None
+        columns = ', '.join(f'{column} = ?' for column, _ in assignments)
+        with self._write() as conn:
+            cursor = conn.execute(f'UPDATE contacts SET {columns} WHERE id = ?',
+                                  [value for _, value in assignments] + [contact_id])
+            return cursor.rowcount > 0
+
+    def delete(self, contact_ids):
+        """Delete contacts by id; returns how many existed"""
+        with self._write() as conn:
+            return sum(conn.execute('DELETE FROM contacts WHERE id = ?', (contact_id,)).rowcount
+                       for contact_id in contact_ids)
+
+    def get(self, contact_id):
+        row = self._conn.execute('SELECT id, email, name, template_id, fields FROM contacts WHERE id = ?',
+                                 (contact_id,)).fetchone()
+        return contact_dict(row) if row else None
+
+    def existing_emails(self, emails, chunk_size=500):
+        """The subset of `emails` already in the store"""
+        emails = list(emails)
+        found = set()
+        for start in range(0, len(emails), chunk_size):
+            chunk = emails[start:start + chunk_size]
+            placeholders = ','.join('?' * len(chunk))
+            found.update(row[0] for row in self._conn.execute(
+                f'SELECT email FROM contacts WHERE email IN ({placeholders})', chunk))
+        return found
+
+    def count(self, filters=None):
+        where, params = filter_clause(filters)
+        return self._conn.execute(f'SELECT COUNT(*) FROM contacts WHERE 1{where}', params).fetchone()[0]
+
+    def iter_rows(self, batch_size=1000, filters=None, after_id=0, offset=0, limit=None):
+        """Lazily yield (id, email, name, template_id, fields) in id order
+
+        Reads in short keyset-paginated queries so no read transaction stays
+        open, and stops at the contacts that existed when iteration began.
+        Starts after contact `after_id`, skipping `offset` further matches,
+        and yields at most `limit` rows.
+        """
+        where, params = filter_clause(filters)
+        last_id = self._conn.execute('SELECT COALESCE(MAX(id), 0) FROM contacts').fetchone()[0]
+        while limit is None or limit > 0:
+            size = batch_size if limit is None else min(batch_size, limit)
+            # The connection of the thread resuming the generator; campaigns start it on another one
+            rows = self._conn.execute('SELECT id, email, name, template_id, fields FROM contacts '
+                                      f'WHERE id > ? AND id <= ?{where} ORDER BY id LIMIT ? OFFSET ?',
+                                      [after_id, last_id] + params + [size, offset]).fetchall()
+            yield from rows
+            if len(rows) < size:
+                return
+            after_id = rows[-1][0]
+            offset = 0
+            if limit is not None:
+                limit -= len(rows)
+
+    def campaign_contacts(self):
+        """Lazily yield (email, fields, template_id) for a campaign, with name and email among the fields"""
+        for _, email, name, template_id, fields in self.iter_rows():
+            fields = json.loads(fields) if fields else {}
+            fields['email'] = email
+            fields['name'] = name
+            yield email, fields, template_id
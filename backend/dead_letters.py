@@ -0,0 +1,173 @@
+"""Structured records of failed sends, kept for inspection and re-drive."""
+import contextlib
+import json
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS failures (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        campaign_id TEXT,
+        email TEXT NOT NULL,
+        template_id TEXT,
+        fields TEXT,
+        account_id TEXT,
+        account_email TEXT,
+        code INTEGER,
+        reason TEXT,
+        error_class TEXT,
+        retryable INTEGER NOT NULL,
+        attempts INTEGER,
+        failed_at REAL,
+        redriven_to TEXT  -- campaign the failure was handed to for another try
+    )""",
+    'CREATE INDEX IF NOT EXISTS failures_campaign ON failures (campaign_id)',
+    'CREATE INDEX IF NOT EXISTS failures_redriven ON failures (redriven_to)'
+]
+COLUMNS = ('id', 'campaign_id', 'email', 'template_id', 'fields', 'account_id', 'account_email',
+           'code', 'reason', 'error_class', 'retryable', 'attempts', 'failed_at', 'redriven_to')
+
+
+def failure_dict(row):
+    record = dict(zip(COLUMNS, row))
+    return {
+        "id": record['id'],
+        "campaignId": record['campaign_id'],
+        "email": record['email'],
+        "templateId": record['template_id'],
+        "accountId": record['account_id'],
+        "accountEmail": record['account_email'],
+        "code": record['code'],
+        "reason": record['reason'],
+        "errorClass": record['error_class'],
+        "retryable": bool(record['retryable']),
+        "attempts": record['attempts'],
+        "failedAt": record['failed_at'],
+        "redrivenTo": record['redriven_to']
+    }
+
+
+def filter_clause(filters):
+    """SQL conditions and parameters for campaignId, errorClass and retryable filters"""
+    conditions = []
+    params = []
+    if filters.get('campaignId'):
+        conditions.append('campaign_id = ?')
+        params.append(filters['campaignId'])
+    if filters.get('errorClasses'):
+        conditions.append(f"error_class IN ({','.join('?' * len(filters['errorClasses']))})")
+        params += list(filters['errorClasses'])
+    if filters.get('retryable') is not None:
+        conditions.append('retryable = ?')
+        params.append(int(bool(filters['retryable'])))
+    if filters.get('ids'):
+        conditions.append(f"id IN ({','.join('?' * len(filters['ids']))})")
+        params += [int(record_id) for record_id in filters['ids']]
+    return ''.join(f' AND {condition}' for condition in conditions), params
+
+
+class DeadLetterStore:
+    """Failed sends with their contact, account, error code and classification
+
+    Holds at most `max_records` failures; the oldest are dropped first.
+    Retryable failures can be claimed by a campaign (claim()), which then
+    reads them back as contacts with redrive_contacts().
+    """
+
+    def __init__(self, path, max_records=100000, prune_every=1000):
+        self.path = path
+        self.max_records = max_records
+        self.prune_every = prune_every
+        self._added = 0
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        with self._write() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self._prune(conn)
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _write(self):
+        """A write transaction; committed on success, rolled back on error"""
+        with self._write_lock:
+            conn = self._conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _prune(self, conn):
+        conn.execute('DELETE FROM failures WHERE id <= (SELECT MAX(id) FROM failures) - ?', (self.max_records,))
+
+    def add(self, record):
+        """Store one failure, given as a dict with the keys of failure_dict()"""
+        with self._write() as conn:
+            conn.execute('INSERT INTO failures (campaign_id, email, template_id, fields, account_id, account_email, '
+                         'code, reason, error_class, retryable, attempts, failed_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (record.get('campaignId'), record['email'], record.get('templateId'),
+                          json.dumps(record['fields']) if record.get('fields') else None,
+                          record.get('accountId'), record.get('accountEmail'), record.get('code'),
+                          record.get('reason'), record.get('errorClass'), int(bool(record.get('retryable'))),
+                          record.get('attempts'), record.get('failedAt')))
+            self._added += 1
+            if self._added % self.prune_every == 0:
+                self._prune(conn)
+
+    def list(self, filters, after_id=0, limit=100):
+        """Failures matching the filters, oldest first, after record `after_id`"""
+        where, params = filter_clause(filters)
+        rows = self._conn.execute(f'SELECT {", ".join(COLUMNS)} FROM failures WHERE id > ?{where} '
+                                  'ORDER BY id LIMIT ?', [after_id] + params + [limit]).fetchall()
+        return [failure_dict(row) for row in rows]
+
+    def counts(self, filters):
+        """Number of failures per error class, and how many can still be re-driven"""
+        where, params = filter_clause(filters)
+        by_class = dict(self._conn.execute(f'SELECT error_class, COUNT(*) FROM failures WHERE 1{where} '
+                                           'GROUP BY error_class', params).fetchall())
+        redrivable = self._conn.execute(f'SELECT COUNT(*) FROM failures WHERE retryable = 1 '
+                                        f'AND redriven_to IS NULL{where}', params).fetchone()[0]
+        return {"byClass": by_class, "redrivable": redrivable}
+
+    def claim(self, campaign_id, filters, limit=None):
+        """Hand the matching retryable failures that weren't re-driven yet to a campaign; returns how many"""
+        where, params = filter_clause(filters)
+        with self._write() as conn:
+            return conn.execute(f'UPDATE failures SET redriven_to = ? WHERE id IN (SELECT id FROM failures '
+                                f'WHERE retryable = 1 AND redriven_to IS NULL{where} ORDER BY id LIMIT ?)',
+                                [campaign_id] + params + [limit if limit is not None else -1]).rowcount
+
+    def release(self, campaign_id):
+        """Undo a claim, e.g. when the campaign couldn't start"""
+        with self._write() as conn:
+            conn.execute('UPDATE failures SET redriven_to = NULL WHERE redriven_to = ?', (campaign_id,))
+
+    def redrive_contacts(self, campaign_id, batch_size=1000):
+        """Lazily yield (email, fields, template_id) for the failures claimed by a campaign, once per address"""
+        after_id = 0
+        while True:
+            rows = self._conn.execute('SELECT id, email, fields, template_id FROM failures WHERE id IN '
+                                      '(SELECT MAX(id) FROM failures WHERE redriven_to = ? GROUP BY email) '
+                                      'AND id > ? ORDER BY id LIMIT ?', (campaign_id, after_id, batch_size)).fetchall()
+            for _, email, fields, template_id in rows:
+                yield email, json.loads(fields) if fields else {'email': email}, template_id
+            if len(rows) < batch_size:
+                return
+            after_id = rows[-1][0]
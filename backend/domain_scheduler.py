@@ -0,0 +1,165 @@
+"""Per-recipient-domain queues and limits for campaign contacts."""
+import collections
+import queue
+import threading
+import time
+from rate_limit import TokenBucket
+
+
+def recipient_domain(email):
+    return email.rpartition('@')[2].strip().lower()
+
+
+class _DomainQueue:
+    """Buffered contacts, sends in flight and limits of one receiving domain"""
+
+    def __init__(self, concurrency=None, rate=None, burst=1):
+        self.contacts = collections.deque()
+        self.in_flight = 0
+        self.sent = 0
+        self.concurrency = concurrency or float('inf')
+        self.bucket = TokenBucket(rate, burst) if rate else None
+
+    def can_send(self):
+        if self.in_flight >= self.concurrency:
+            return False
+        return self.bucket is None or not self.bucket.try_acquire()
+
+
+class DomainScheduler:
+    """Groups a campaign's contacts by recipient domain and interleaves them
+
+    Wraps the campaign's contact source (ContactProducer or RenderStage)
+    with the same interface. Up to `buffer` contacts are read ahead into
+    per-domain queues, and each get serves the next domain in round-robin
+    order that is under its concurrency cap and has a rate token, so a
+    list sorted by domain doesn't hit one receiver in a burst and workers
+    keep finding sendable work. `overrides` maps a domain to its own
+    {'concurrency', 'rate', 'burst'}; rates are messages per second. The
+    campaign reports every finished send through release().
+    """
+
+    def __init__(self, source, concurrency=None, rate=None, burst=1, overrides=None, buffer=10000):
+        self.source = source
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.overrides = {domain.lower(): limits for domain, limits in (overrides or {}).items()}
+        self.buffer = max(1, int(buffer))
+        self._domains = {}
+        self._ring = collections.deque()  # domains with buffered contacts, in serving order
+        self._buffered = 0
+        self._cond = threading.Condition()
+
+    @property
+    def done(self):
+        return self.source.done
+
+    def _domain(self, domain):
+        state = self._domains.get(domain)
+        if state is None:
+            limits = self.overrides.get(domain, {})
+            state = _DomainQueue(limits.get('concurrency', self.concurrency),
+                                 limits.get('rate', self.rate),
+                                 limits.get('burst', self.burst))
+            self._domains[domain] = state
+        return state
+
+    def _add(self, contact):
+        """Buffer a contact in its domain's queue (lock held)"""
+        domain = recipient_domain(contact[0])
+        state = self._domain(domain)
+        if not state.contacts:
+            self._ring.append(domain)
+        state.contacts.append(contact)
+        self._buffered += 1
+
+    def _fill(self):
+        while self._buffered < self.buffer:
+            try:
+                self._add(self.source.get_nowait())
+            except queue.Empty:
+                return
+
+    def get_nowait(self):
+        with self._cond:
+            self._fill()
+            for _ in range(len(self._ring)):
+                domain = self._ring[0]
+                self._ring.rotate(-1)
+                state = self._domains[domain]
+                if not state.can_send():
+                    continue
+                contact = state.contacts.popleft()
+                self._buffered -= 1
+                if not state.contacts:
+                    self._ring.pop()  # rotated to the end above
+                state.in_flight += 1
+                return contact
+        raise queue.Empty
+
+    def get(self, timeout):
+        """Wait up to `timeout` seconds for a sendable contact; None if none came up"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.get_nowait()
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.exhausted():
+                return None
+            if self._buffered == 0:
+                # Nothing buffered: block on the source instead of polling
+                contact = self.source.get(timeout=min(remaining, 0.5))
+                if contact is not None:
+                    with self._cond:
+                        self._add(contact)
+                continue
+            # Everything buffered is capped; wait for a release or a rate token
+            with self._cond:
+                self._cond.wait(min(remaining, 0.05))
+
+    def try_start(self, email):
+        """Count a send that didn't come through get(), such as a retry, if its domain is under its caps"""
+        with self._cond:
+            state = self._domain(recipient_domain(email))
+            if not state.can_send():
+                return False
+            state.in_flight += 1
+            return True
+
+    def release(self, email, success=True):
+        with self._cond:
+            state = self._domain(recipient_domain(email))
+            state.in_flight -= 1
+            if success:
+                state.sent += 1
+            self._cond.notify_all()
+
+    def exhausted(self):
+        return self._buffered == 0 and self.source.exhausted()
+
+    def start(self):
+        return self.source.start()
+
+    def stop(self):
+        self.source.stop()
+
+    def stats(self, limit=20):
+        """Queue depths of the busiest domains"""
+        with self._cond:
+            busiest = sorted(self._domains.items(),
+                             key=lambda item: (len(item[1].contacts), item[1].in_flight), reverse=True)
+            return {
+                'domains': len(self._domains),
+                'queued': self._buffered,
+                'busiest': [{
+                    'domain': domain,
+                    'queued': len(state.contacts),
+                    'inFlight': state.in_flight,
+                    'sent': state.sent,
+                    'concurrencyLimit': state.concurrency if state.concurrency != float('inf') else None,
+                    'rateLimit': round(state.bucket.rate, 3) if state.bucket else None
+                } for domain, state in busiest[:limit]]
+            }
@@ -0,0 +1,284 @@
+"""Cached Gmail API clients and shared credentials per account."""
+import datetime
+import queue
+import threading
+import time
+import logging
+from concurrent import futures
+from contextlib import contextmanager
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from googleapiclient.http import BatchHttpRequest
+
+logger = logging.getLogger(__name__)
+
+# Gmail's batch endpoint; it accepts at most 100 calls per batch
+GMAIL_BATCH_URI = 'https://gmail.googleapis.com/batch/gmail/v1'
+MAX_GMAIL_BATCH = 100
+
+
+def credentials_from_info(info):
+    """Build a Credentials object from the dict stored on an account"""
+    credentials = Credentials(
+        token=info['token'],
+        refresh_token=info['refresh_token'],
+        token_uri=info['token_uri'],
+        client_id=info['client_id'],
+        client_secret=info['client_secret'],
+        scopes=info['scopes']
+    )
+    if info.get('expiry'):
+        credentials.expiry = datetime.datetime.fromisoformat(info['expiry'])
+    return credentials
+
+
+def credentials_to_info(credentials):
+    """The dict stored on an account for a Credentials object"""
+    return {
+        'token': credentials.token,
+        'refresh_token': credentials.refresh_token,
+        'token_uri': credentials.token_uri,
+        'client_id': credentials.client_id,
+        'client_secret': credentials.client_secret,
+        'scopes': credentials.scopes,
+        'expiry': credentials.expiry.isoformat() if credentials.expiry else None
+    }
+
+
+def _utcnow():
+    # google-auth keeps expiry as a naive UTC datetime
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class _AccountClients:
+    """One shared credential and a free list of built clients for an account"""
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.refresh_lock = threading.Lock()
+        self.idle = []
+
+
+class GmailServiceCache:
+    """Hands out Gmail API clients that are built once and reused across messages
+
+    Clients are not thread-safe (each one owns an HTTP connection), so every
+    client is checked out by a single thread at a time. All clients of an
+    account share one Credentials object that is refreshed in place, one
+    refresh at a time. With start_refresher() tokens are refreshed in the
+    background `refresh_margin` seconds before they expire, so senders find
+    a valid token; `on_refresh(account_id, credentials)` is called after
+    every refresh so the new token can be stored.
+    """
+
+    def __init__(self, build_service, max_idle_clients=16, on_refresh=None, refresh_margin=600):
+        self.build_service = build_service
+        self.max_idle_clients = max_idle_clients
+        self.on_refresh = on_refresh
+        self.refresh_margin = datetime.timedelta(seconds=refresh_margin)
+        self._accounts = {}
+        self._lock = threading.Lock()
+        self._stop_refresher = threading.Event()
+        self.builds = 0
+        self.reuses = 0
+        self.refreshes = 0
+
+    def _entry(self, account, credentials=None):
+        with self._lock:
+            entry = self._accounts.get(account['id'])
+            if entry is None:
+                if credentials is None:
+                    credentials = credentials_from_info(account['credentials'])
+                entry = _AccountClients(credentials)
+                self._accounts[account['id']] = entry
+            return entry
+
+    def _refresh(self, account_id, entry, needed):
+        """Single-flight refresh: only one thread refreshes while the others wait"""
+        with entry.refresh_lock:
+            # Another thread may have refreshed while we waited
+            if not needed(entry.credentials):
+                return
+            entry.credentials.refresh(Request())
+            with self._lock:
+                self.refreshes += 1
+            logger.debug(f"Refreshed Gmail token for account {account_id}")
+        if self.on_refresh:
+            self.on_refresh(account_id, entry.credentials)
+
+    def _expiring(self, credentials):
+        if not credentials.refresh_token:
+            return False
+        # An unknown expiry (e.g. a stored token) is refreshed once to learn it
+        return credentials.expiry is None or credentials.expiry - _utcnow() < self.refresh_margin
+
+    def credentials(self, account, credentials=None):
+        """Get the account's shared credential, refreshing it if it has expired"""
+        entry = self._entry(account, credentials)
+        if not entry.credentials.valid:
+            # Only when the background refresh fell behind (or isn't running)
+            self._refresh(account['id'], entry, lambda c: not c.valid)
+        return entry.credentials
+
+    def refresh_expiring(self):
+        """Refresh every cached credential that is close to expiry"""
+        with self._lock:
+            entries = list(self._accounts.items())
+        for account_id, entry in entries:
+            if self._expiring(entry.credentials):
+                try:
+                    self._refresh(account_id, entry, self._expiring)
+                except Exception as e:
+                    logger.error(f"Error refreshing Gmail token for account {account_id}: {str(e)}")
+
+    def start_refresher(self, interval=60):
+        """Check for expiring tokens every `interval` seconds on a background thread"""
+        def run():
+            while not self._stop_refresher.wait(interval):
+                self.refresh_expiring()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop_refresher(self):
+        self._stop_refresher.set()
+
+    @contextmanager
+    def service(self, account, credentials=None):
+        """Check out a Gmail API client for the account"""
+        entry = self._entry(account, credentials)
+        creds = self.credentials(account)
+        with self._lock:
+            client = entry.idle.pop() if entry.idle else None
+            if client is not None:
+                self.reuses += 1
+        if client is None:
+            client = self.build_service(creds)
+            with self._lock:
+                self.builds += 1
+        try:
+            yield client
+        finally:
+            with self._lock:
+                # Drop the client if the account was invalidated meanwhile
+                if self._accounts.get(account['id']) is entry and len(entry.idle) < self.max_idle_clients:
+                    entry.idle.append(client)
+
+    def invalidate(self, account_id):
+        """Forget the cached credential and clients for an account"""
+        with self._lock:
+            self._accounts.pop(account_id, None)
+
+    def stats(self):
+        """Clients built and reused and tokens refreshed since startup"""
+        with self._lock:
+            return {
+                'accounts': len(self._accounts),
+                'idleClients': sum(len(entry.idle) for entry in self._accounts.values()),
+                'builds': self.builds,
+                'reuses': self.reuses,
+                'refreshes': self.refreshes
+            }
+
+
+class GmailBatchSender:
+    """Sends an account's Gmail messages in batch HTTP requests from one dispatcher thread
+
+    submit() queues a message and returns at once with a Future for that
+    message's response, or its own error, so callers still account for
+    (and retry) every recipient separately. Each account has a dispatcher
+    that takes every message waiting for it, up to `max_batch`, and sends
+    them as one batch; messages queued while a batch is out go in the next
+    one. A batch that isn't full waits until its oldest message has waited
+    `linger` seconds. A dispatcher exits after `idle_timeout` seconds
+    without messages and is started again by the next submit().
+    """
+
+    def __init__(self, gmail_services, max_batch=50, linger=0.05, batch_uri=GMAIL_BATCH_URI, idle_timeout=5.0):
+        self.gmail_services = gmail_services
+        self.max_batch = max(1, min(int(max_batch), MAX_GMAIL_BATCH))
+        self.linger = linger
+        self.batch_uri = batch_uri
+        self.idle_timeout = idle_timeout
+        # Queue of (encoded_message, future, queued_at) per account with a running dispatcher
+        self._queues = {}
+        self._lock = threading.Lock()
+        self.batches = 0
+
+    def submit(self, account, encoded_message):
+        """Queue a message for the account's next batch; returns a Future of its response"""
+        future = futures.Future()
+        with self._lock:
+            pending = self._queues.get(account['id'])
+            if pending is None:
+                pending = self._queues[account['id']] = queue.Queue()
+                thread = threading.Thread(target=self._dispatch, args=(account, pending))
+                thread.daemon = True
+                thread.start()
+            # Queued under the lock so an idle dispatcher can't exit with it
+            pending.put((encoded_message, future, time.monotonic()))
+        return future
+
+    def _next_batch(self, account, pending):
+        """The messages waiting for the account, up to max_batch; None once the dispatcher is idle"""
+        try:
+            batch = [pending.get(timeout=self.idle_timeout)]
+        except queue.Empty:
+            with self._lock:
+                if pending.empty():
+                    del self._queues[account['id']]
+                    return None
+            return []
+        deadline = batch[0][2] + self.linger
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(pending.get_nowait())
+            except queue.Empty:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    break
+                try:
+                    batch.append(pending.get(timeout=wait))
+                except queue.Empty:
+                    break
+        return batch
+
+    def _dispatch(self, account, pending):
+        while True:
+            batch = self._next_batch(account, pending)
+            if batch is None:
+                return
+            if batch:
+                self._execute(account, batch)
+
+    def _execute(self, account, batch):
+        def callback(request_id, response, exception):
+            future = batch[int(request_id)][1]
+            if future.done():
+                return
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(response)
+
+        try:
+            with self.gmail_services.service(account) as service:
+                request = BatchHttpRequest(callback=callback, batch_uri=self.batch_uri)
+                for index, (encoded_message, _, _) in enumerate(batch):
+                    request.add(service.users().messages().send(userId="me", body={'raw': encoded_message}),
+                                request_id=str(index))
+                request.execute()
+            with self._lock:
+                self.batches += 1
+            logger.debug(f"Sent Gmail batch of {len(batch)} for account {account['id']}")
+        except Exception as e:
+            # The whole batch request failed; every message in it gets the error
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, future, _ in batch:
+            if not future.done():
+                future.set_exception(RuntimeError("No response for message in Gmail batch"))
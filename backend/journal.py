@@ -0,0 +1,172 @@
+"""Append-only campaign journal for crash-safe resume without duplicate sends.
+
+Each line is one record: a JSON header when the campaign starts, then
+"<kind>\t<email>" for every state change of a recipient and a final "E"
+when the campaign completes. A recipient is journaled as dispatched before
+its message is handed to the network, and that record is on disk before
+the send goes out, so a crash can never lose track of a sent message.
+Records are written by a background thread and fsynced in batches; callers
+that need durability wait on the batch's future instead of fsyncing
+themselves, so one fsync covers every worker's records for that interval.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'B'
+DISPATCHED = 'D'    # handed to a relay or the Gmail API; outcome not yet known
+SUCCEEDED = 'S'
+RETRYING = 'R'      # an attempt failed and a retry is scheduled
+FAILED = 'F'        # failed for good
+END = 'E'
+
+
+def recipient_key(email):
+    return email.strip().lower()
+
+
+class CampaignJournal:
+    """Group-committing writer for one campaign's journal file"""
+
+    def __init__(self, path, flush_interval=0.005):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._file = open(path, 'ab')
+        self._pending = []
+        self._batch = Future()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._writer = threading.Thread(target=self._run)
+        self._writer.daemon = True
+        self._writer.start()
+
+    @classmethod
+    def create(cls, folder, campaign_id, header, **options):
+        os.makedirs(folder, exist_ok=True)
+        journal = cls(os.path.join(folder, f'{campaign_id}.journal'), **options)
+        journal._append(HEADER + '\t' + json.dumps(header)).result()
+        return journal
+
+    def _append(self, line):
+        """Queue a record; the returned future resolves once it is on disk"""
+        with self._cond:
+            if self._closed:
+                raise ValueError("Journal is closed")
+            self._pending.append(line.encode('utf-8') + b'\n')
+            self._cond.notify()
+            return self._batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending and self._closed:
+                    return
+            # Let records from other workers join this batch
+            time.sleep(self.flush_interval)
+            with self._cond:
+                lines, self._pending = self._pending, []
+                batch, self._batch = self._batch, Future()
+            try:
+                self._file.write(b''.join(lines))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                batch.set_result(len(lines))
+            except Exception as e:
+                logger.error(f"Error writing campaign journal {self.path}: {e}")
+                batch.set_exception(e)
+
+    def dispatched(self, email):
+        """Record a send about to go out; wait on the future before sending"""
+        return self._append(f'{DISPATCHED}\t{email}')
+
+    def succeeded(self, email):
+        self._append(f'{SUCCEEDED}\t{email}')
+
+    def retrying(self, email):
+        self._append(f'{RETRYING}\t{email}')
+
+    def failed(self, email):
+        self._append(f'{FAILED}\t{email}')
+
+    def complete(self):
+        self._append(END)
+        self.close()
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._writer.join()
+        self._file.close()
+
+
+class JournalState:
+    """What a journal says about a campaign, for deciding where to resume"""
+
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.completed = False
+        self.recipients = {}
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # torn write at the moment of the crash
+                kind, _, value = line.rstrip('\n').partition('\t')
+                if kind == HEADER:
+                    self.header = json.loads(value)
+                elif kind == END:
+                    self.completed = True
+                elif value:
+                    self.recipients[recipient_key(value)] = kind
+
+    @property
+    def campaign_id(self):
+        return os.path.splitext(os.path.basename(self.path))[0]
+
+    def counts(self):
+        counts = {SUCCEEDED: 0, FAILED: 0, DISPATCHED: 0, RETRYING: 0}
+        for kind in self.recipients.values():
+            counts[kind] = counts.get(kind, 0) + 1
+        return {
+            'succeeded': counts[SUCCEEDED],
+            'failed': counts[FAILED],
+            'inDoubt': counts[DISPATCHED],
+            'retrying': counts[RETRYING]
+        }
+
+    def should_skip(self, email, resend_in_doubt=False):
+        """True if resuming must not send to this recipient again"""
+        kind = self.recipients.get(recipient_key(email))
+        if kind in (SUCCEEDED, FAILED):
+            return True
+        # Dispatched with no outcome: it may have been delivered just before the crash
+        return kind == DISPATCHED and not resend_in_doubt
+
+    @classmethod
+    def unfinished(cls, folder):
+        """States of all journals in `folder` whose campaign never completed"""
+        if not os.path.isdir(folder):
+            return []
+        states = []
+        for filename in sorted(os.listdir(folder)):
+            if filename.endswith('.journal'):
+                path = os.path.join(folder, filename)
+                # Completed journals end with the END record; skip them without parsing
+                with open(path, 'rb') as f:
+                    f.seek(max(0, os.path.getsize(path) - 2))
+                    if f.read() == END.encode() + b'\n':
+                        continue
+                state = cls(path)
+                if not state.completed and state.header is not None:
+                    states.append(state)
+        return states
@@ -0,0 +1,115 @@
+"""Token-bucket rate limiting shared by campaign workers."""
+import threading
+import time
+
+RATE_PERIODS = {
+    'second': 1.0,
+    'minute': 60.0,
+    'hour': 3600.0
+}
+
+
+def parse_rate(limit, period='minute'):
+    """Convert "limit messages per period" into messages per second"""
+    if limit in (None, ''):
+        return None
+    limit = float(limit)
+    if limit <= 0:
+        return None
+    if period not in RATE_PERIODS:
+        raise ValueError(f"Unknown rate period: {period}")
+    return limit / RATE_PERIODS[period]
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, with bursts of up to `burst`"""
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.clock = clock
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def set_rate(self, rate, burst=None):
+        """Change the refill rate (and burst), keeping the tokens accrued at the old rate"""
+        with self._lock:
+            self._refill(self.clock())
+            self.rate = float(rate)
+            if burst is not None:
+                self.burst = max(1.0, float(burst))
+                self._tokens = min(self._tokens, self.burst)
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if available; otherwise return the seconds until they will be"""
+        with self._lock:
+            self._refill(self.clock())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+
+
+class AccountRateLimiter:
+    """One token bucket per sending account, shared by every campaign sending from it
+
+    limit() is the configured rate; the bucket's own rate may be lower
+    while an account scheduler backs off after throttling.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._limits = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def set_limit(self, account_id, rate, burst=1):
+        """Configure an account's rate; a bucket already in use keeps its tokens"""
+        with self._lock:
+            if rate:
+                self._limits[account_id] = rate
+                bucket = self._buckets.get(account_id)
+                if bucket is None:
+                    self._buckets[account_id] = TokenBucket(rate, burst)
+                else:
+                    bucket.set_rate(rate, burst)
+            else:
+                self._buckets.pop(account_id, None)
+                self._limits.pop(account_id, None)
+            listeners = list(self._listeners)
+        # Senders waiting for a token may be able to go now
+        for listener in listeners:
+            listener()
+
+    def add_listener(self, callback):
+        """Call `callback()` from the configuring thread whenever a limit changes"""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            self._listeners.remove(callback)
+
+    def limit(self, account_id):
+        return self._limits.get(account_id)
+
+    def set_rate(self, account_id, rate):
+        """Adjust the rate of an account that already has a limit"""
+        bucket = self._buckets.get(account_id)
+        if bucket:
+            bucket.set_rate(rate)
+
+    def try_acquire(self, account_id):
+        """Take a send slot on the account, or return the seconds until one frees up"""
+        bucket = self._buckets.get(account_id)
+        if bucket is None:
+            return 0.0
+        return bucket.try_acquire()
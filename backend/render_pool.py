@@ -0,0 +1,238 @@
+"""Renders campaign messages to wire format in worker processes.
+
+Template substitution, MIME construction and serialization are CPU-bound
+and hold the GIL, so with many senders they slow the threads doing network
+I/O. RenderStage sits between the ContactProducer and the senders: it hands
+batches of contacts to a process pool and queues the finished message bytes
+in a bounded buffer, so senders only move ready bytes onto sockets.
+"""
+import base64
+import collections
+import logging
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from message_builder import MessageBuilder, WireMessage, header_line
+from templating import TemplateCache
+
+logger = logging.getLogger(__name__)
+
+# Set in each worker process by _init_worker
+_worker_state = None
+
+
+class RenderedMessage:
+    """A serialized message without a From header, ready to be sent by any account
+
+    Workers render only the head; the stage splices the template's shared
+    attachment segments back in once the message is in the sending process,
+    so attachment payloads never go through the pool's pipes.
+    """
+
+    __slots__ = ('head', 'template_id', 'segments', 'gmail_raw')
+
+    def __init__(self, head, template_id=None, encode_gmail=False):
+        self.head = head
+        # Template whose attachment segments follow the head; None for a message without attachments
+        self.template_id = template_id
+        self.segments = ()
+        # Gmail API payload, computed in the worker when the campaign has Gmail accounts
+        # and the message is complete without attachments
+        self.gmail_raw = base64.urlsafe_b64encode(head).decode() if encode_gmail and template_id is None else None
+
+    def with_sender(self, sender):
+        """WireMessage for SMTP, with the sending account's From header prepended"""
+        return WireMessage(header_line('From', sender) + self.head, self.segments)
+
+    def gmail_payload(self):
+        # Gmail fills in From for the authenticated account
+        return self.gmail_raw or base64.urlsafe_b64encode(b''.join((self.head, *self.segments))).decode()
+
+
+def _init_worker(templates, default_template, attachments, boundary, encode_gmail):
+    global _worker_state
+    template_cache = TemplateCache(lambda template_id: templates.get(template_id) or default_template)
+    _worker_state = (template_cache, MessageBuilder(attachments, boundary), encode_gmail)
+
+
+def render_batch(contacts):
+    """Runs in a worker: a RenderedMessage, the exception raised or None (render when sending), per contact"""
+    template_cache, message_builder, encode_gmail = _worker_state
+    rendered = [None] * len(contacts)
+
+    # Render each template's contacts in one call
+    by_template = {}
+    for index, (email, fields, template_id) in enumerate(contacts):
+        by_template.setdefault(template_id, []).append(index)
+    for template_id, indexes in by_template.items():
+        try:
+            template = template_cache.get(template_id)
+            if not template:
+                raise ValueError(f"No template found for ID {template_id}")
+            texts = template.render_batch([contacts[index][1] for index in indexes])
+        except Exception as e:
+            for index in indexes:
+                rendered[index] = e
+            continue
+        # Worker builders only know which templates have attachments, not their payloads
+        attached = bool(message_builder.attachments.for_template(template.template_id))
+        for index, (subject, email_body) in zip(indexes, texts):
+            if attached and message_builder.boundary in email_body:
+                continue  # Needs another boundary; the sender builds it with the payloads at hand
+            try:
+                head = message_builder.head(contacts[index][0], subject, email_body, multipart=attached)
+                rendered[index] = RenderedMessage(head, template.template_id if attached else None, encode_gmail)
+            except Exception as e:
+                rendered[index] = e
+    return rendered
+
+
+def _mp_context():
+    # Forked workers start without re-importing the server module
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+class RenderStage:
+    """Pre-renders contacts from a ContactProducer on a process pool
+
+    Drop-in replacement for the producer as a Campaign's contact source:
+    it yields (email, fields, template_id, rendered) where rendered is a
+    RenderedMessage, or the exception raised while rendering that contact.
+    Templates and attachments are frozen when the stage is created. At most
+    `max_pending` batches are in the pool and `maxsize` messages wait in the
+    buffer, so rendering never runs far ahead of sending.
+    """
+
+    def __init__(self, contacts, templates, default_template, attachments, processes,
+                 batch_size=50, max_pending=None, maxsize=2000, encode_gmail=False):
+        self.contacts = contacts
+        self.batch_size = max(1, int(batch_size))
+        self.max_pending = max_pending or processes * 2
+        self.queue = queue.Queue(maxsize=maxsize)
+        # Splices attachment segments into the heads the workers render with its boundary
+        self.message_builder = MessageBuilder(attachments)
+        self.executor = ProcessPoolExecutor(
+            processes, mp_context=_mp_context(), initializer=_init_worker,
+            initargs=(dict(templates), default_template, attachments.outline(), self.message_builder.boundary,
+                      encode_gmail))
+        self.count = 0
+        self.done = threading.Event()
+        self._stopped = threading.Event()
+
+    def _next_batch(self):
+        """Up to batch_size contacts; a short lull in the input ends the batch early"""
+        batch = []
+        while len(batch) < self.batch_size and not self._stopped.is_set():
+            contact = self.contacts.get(timeout=0.05)
+            if contact is None:
+                break
+            batch.append(contact)
+        return batch
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                self.count += 1
+                return
+            except queue.Full:
+                continue
+
+    def _collect(self, batch, future):
+        """Queue a finished batch; contacts whose message isn't usable are queued unrendered"""
+        try:
+            rendered = future.result()
+            for message in rendered:
+                if isinstance(message, RenderedMessage) and message.template_id is not None:
+                    message.segments = self.message_builder.attachment_segments(message.template_id)
+        except Exception as e:
+            # The pool itself failed (e.g. a worker died); render these inline instead
+            logger.error(f"Render worker failed, sending batch unrendered: {e}")
+            rendered = [None] * len(batch)
+        for contact, message in zip(batch, rendered):
+            self._put(contact if message is None else (*contact, message))
+
+    def _pass_through(self, batch):
+        for contact in batch:
+            self._put(contact)
+
+    def _pass_through_rest(self):
+        """Hand every contact left in the producer to the senders, who render them inline"""
+        while not self._stopped.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._pass_through(batch)
+            elif self.contacts.exhausted():
+                return
+
+    def _render(self, pending):
+        input_done = False
+        while not self._stopped.is_set():
+            # Deliver finished batches in order; wait for the oldest when the pool is full
+            if pending and (pending[0][1].done() or len(pending) >= self.max_pending or input_done):
+                # Dropped from pending only once queued, so a failure here can't lose the batch
+                self._collect(*pending[0])
+                pending.popleft()
+                continue
+            if input_done:
+                return
+            batch = self._next_batch()
+            if batch:
+                try:
+                    future = self.executor.submit(render_batch, batch)
+                except Exception as e:
+                    # The pool is broken (e.g. a worker died) or gone
+                    logger.error(f"Render pool unavailable, sending remaining contacts unrendered: {e}")
+                    while pending:
+                        self._collect(*pending.popleft())
+                    self._pass_through(batch)
+                    self._pass_through_rest()
+                    return
+                pending.append((batch, future))
+            elif self.contacts.exhausted():
+                input_done = True
+
+    def run(self):
+        pending = collections.deque()
+        try:
+            self._render(pending)
+        except Exception as e:
+            # Contacts read from the producer count as remaining, so every one must still reach the senders
+            logger.error(f"Error rendering messages, sending remaining contacts unrendered: {e}")
+            while pending:
+                batch, future = pending.popleft()
+                future.cancel()
+                self._pass_through(batch)
+            self._pass_through_rest()
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.done.set()
+            logger.info(f"Render stage finished after {self.count} messages")
+
+    def start(self):
+        self.contacts.start()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+        self.contacts.stop()
+
+    def get_nowait(self):
+        return self.queue.get_nowait()
+
+    def get(self, timeout):
+        """Wait up to `timeout` seconds for a message; None if none arrived"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def exhausted(self):
+        """True once every contact has been rendered and handed out"""
+        return self.done.is_set() and self.queue.empty()
@@ -0,0 +1,167 @@
+"""Failed-send classification, backoff policies and the retry delay queue."""
+import heapq
+import itertools
+import random
+import smtplib
+import threading
+import time
+
+# Error classes a failed send can fall into
+CONNECTION = 'connection'   # socket errors, dropped sessions, timeouts
+THROTTLED = 'throttled'     # the server or API asked us to slow down
+TRANSIENT = 'transient'     # temporary failure, try again later
+AUTH = 'auth'               # the sending account itself is not usable
+PERMANENT = 'permanent'     # the message will never be accepted
+UNKNOWN = 'unknown'
+
+THROTTLE_SMTP_CODES = (421, 450, 451, 452)
+THROTTLE_GMAIL_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+
+
+def _http_status(exc):
+    """Status code of a googleapiclient HttpError, without importing it"""
+    resp = getattr(exc, 'resp', None)
+    status = getattr(resp, 'status', None)
+    return int(status) if status is not None else None
+
+
+def classify_error(exc):
+    """Map an exception from a send attempt to one of the error classes"""
+    if isinstance(exc, smtplib.SMTPAuthenticationError):
+        return AUTH
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return CONNECTION
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        if codes and all(code >= 500 for code in codes):
+            return PERMANENT
+        if codes and all(code in THROTTLE_SMTP_CODES for code in codes):
+            return THROTTLED
+        return TRANSIENT
+    if isinstance(exc, smtplib.SMTPResponseException):
+        if exc.smtp_code in THROTTLE_SMTP_CODES:
+            return THROTTLED
+        if 400 <= exc.smtp_code < 500:
+            return TRANSIENT
+        if exc.smtp_code >= 500:
+            return PERMANENT
+        return UNKNOWN
+    status = _http_status(exc)
+    if status is not None:
+        if status == 429 or any(reason in str(exc) for reason in THROTTLE_GMAIL_REASONS):
+            return THROTTLED
+        if status in (401, 403):
+            return AUTH
+        if status >= 500:
+            return TRANSIENT
+        return PERMANENT
+    if isinstance(exc, (TimeoutError, ConnectionError, OSError)):
+        return CONNECTION
+    return UNKNOWN
+
+
+def _text(message):
+    return message.decode('utf-8', 'replace') if isinstance(message, bytes) else str(message)
+
+
+def error_details(exc):
+    """(code, reason) of a failed send: the SMTP reply, or the Gmail API status and reason"""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        code, message = next(iter(exc.recipients.values()), (None, b''))
+        return code, _text(message)
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code, _text(exc.smtp_error)
+    status = _http_status(exc)
+    if status is not None:
+        details = getattr(exc, 'error_details', None)
+        if isinstance(details, list) and details and isinstance(details[0], dict) and details[0].get('reason'):
+            return status, details[0]['reason']
+        return status, getattr(exc, 'reason', None) or str(exc)
+    return None, str(exc)
+
+
+def recipient_rejected(exc):
+    """True if the error says the recipient address can't receive mail (a hard bounce)
+
+    Only rejections of the address itself count, not permanent failures of
+    the sender, the message content or the account.
+    """
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        return bool(codes) and all(code >= 500 for code in codes)
+    return _http_status(exc) == 400 and 'Invalid To header' in str(exc)
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter for one error class"""
+
+    def __init__(self, base_delay, max_delay, multiplier=2.0, jitter=0.5, retryable=True):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.retryable = retryable
+
+    def delay(self, attempt):
+        """Seconds to wait before retry number `attempt` (1-based)"""
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (attempt - 1))
+        # Spread retries out so workers don't hit a struggling relay in lockstep
+        return delay * (1 - self.jitter * random.random())
+
+
+DEFAULT_POLICIES = {
+    CONNECTION: RetryPolicy(base_delay=1, max_delay=30),
+    THROTTLED: RetryPolicy(base_delay=15, max_delay=300),
+    TRANSIENT: RetryPolicy(base_delay=2, max_delay=60),
+    AUTH: RetryPolicy(base_delay=1, max_delay=10),
+    PERMANENT: RetryPolicy(base_delay=0, max_delay=0, retryable=False),
+    UNKNOWN: RetryPolicy(base_delay=2, max_delay=60)
+}
+
+
+class DelayQueue:
+    """Thread-safe queue whose items only become available after their delay"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def put(self, item, delay):
+        with self._cond:
+            heapq.heappush(self._heap, (self.clock() + delay, next(self._counter), item))
+            self._cond.notify()
+
+    def pop_due(self):
+        """Return the next item whose delay has passed, or None"""
+        with self._cond:
+            if self._heap and self._heap[0][0] <= self.clock():
+                return heapq.heappop(self._heap)[2]
+            return None
+
+    def get(self, timeout):
+        """Wait up to `timeout` seconds for an item to come due"""
+        deadline = self.clock() + timeout
+        with self._cond:
+            while True:
+                now = self.clock()
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)[2]
+                if now >= deadline:
+                    return None
+                wait = deadline - now
+                if self._heap:
+                    wait = min(wait, self._heap[0][0] - now)
+                self._cond.wait(wait)
+
+    def next_due(self):
+        """Seconds until the next item comes due (0 if one is due), or None if empty"""
+        with self._cond:
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - self.clock())
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
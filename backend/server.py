@@ -1,27 +1,43 @@
-from flask import Flask, request, jsonify, redirect, session
+from flask import Flask, Response, request, jsonify, redirect, session
 from flask_cors import CORS
-from email import encoders
-from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-import smtplib
 import os
 import csv
+import io
 import time
 import threading
-import queue
+import itertools
 import json
 import base64
 import secrets
 import logging
 import uuid
+import collections
 from datetime import timedelta
 from dotenv import load_dotenv
 import google.oauth2.credentials
 import google_auth_oauthlib.flow
 from googleapiclient.discovery import build
 from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+from smtp_pool import SMTPPoolManager
+from gmail_service import GMAIL_BATCH_URI, GmailBatchSender, GmailServiceCache, credentials_to_info
+from attachment_store import AttachmentStore
+from rate_limit import AccountRateLimiter, parse_rate
+from account_scheduler import AccountScheduler
+from campaign import Campaign
+from contact_source import ContactProducer
+from contact_store import ContactStore, contact_dict, read_csv, read_lines
+from contact_import import ContactImport, normalize_email
+from suppression import SuppressionList
+from dead_letters import DeadLetterStore
+from journal import CampaignJournal, JournalState
+from connection_budget import ConnectionBudget
+from account_health import check_accounts
+from render_pool import RenderStage
+from domain_scheduler import DomainScheduler
+from templating import CompiledTemplate, TemplateCache, TemplateError
+from async_engine import AsyncCampaignRunner
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG, 
@@ -61,10 +77,24 @@ SCOPES = [
 API_SERVICE_NAME = 'gmail'
 API_VERSION = 'v1'
 
+# Contacts held in memory per campaign while the CSV is streamed in
+CONTACT_QUEUE_SIZE = int(os.getenv('CONTACT_QUEUE_SIZE', 10000))
+
+# Largest page /get-contacts returns; use format=ndjson to stream more
+MAX_CONTACTS_PAGE = int(os.getenv('MAX_CONTACTS_PAGE', 1000))
+
+# Worker processes that pre-render messages for each campaign (0 renders on the sending threads)
+RENDER_PROCESSES = int(os.getenv('RENDER_PROCESSES', 0))
+RENDER_BATCH_SIZE = int(os.getenv('RENDER_BATCH_SIZE', 50))
+
+# Default caps per recipient domain (0 or unset means no cap); rates are per DOMAIN_RATE_PERIOD
+DOMAIN_CONCURRENCY = int(os.getenv('DOMAIN_CONCURRENCY', 0))
+DOMAIN_RATE_LIMIT = os.getenv('DOMAIN_RATE_LIMIT')
+DOMAIN_RATE_PERIOD = os.getenv('DOMAIN_RATE_PERIOD', 'minute')
+
 # Global Variables
-contact_queue = queue.Queue()
-send_lock = threading.Lock()
-campaign_status = {
+# Status shown before any campaign has been started
+idle_status = {
     'is_running': False,
     'remaining': 0,
     'total': 0,
@@ -72,9 +102,57 @@ campaign_status = {
     'completed': False
 }
 
+# Recent errors kept per campaign for /campaign-status; every failure is also in the dead-letter store
+MAX_STATUS_ERRORS = int(os.getenv('MAX_STATUS_ERRORS', 100))
+MAX_DEAD_LETTERS_PAGE = int(os.getenv('MAX_DEAD_LETTERS_PAGE', 1000))
+
+# Campaigns by id, each with its own status, contacts and workers
+campaigns = {}
+campaigns_lock = threading.Lock()
+latest_campaign_id = None
+MAX_FINISHED_CAMPAIGNS = int(os.getenv('MAX_FINISHED_CAMPAIGNS', 20))
+
+# Connections shared by all running campaigns, split by priority and weight
+connection_budget = ConnectionBudget(int(os.getenv('MAX_TOTAL_CONNECTIONS', 50)))
+
 # Store email accounts (both Gmail OAuth and SMTP)
 email_accounts = {}
 
+# Authenticated SMTP sessions kept open across messages, one pool per account
+smtp_pools = SMTPPoolManager(
+    max_sessions=int(os.getenv('SMTP_POOL_MAX_SESSIONS', 5)),
+    max_messages=int(os.getenv('SMTP_POOL_MAX_MESSAGES', 100)),
+    max_idle=float(os.getenv('SMTP_POOL_MAX_IDLE', 60)),
+    timeout=float(os.getenv('SMTP_TIMEOUT', 30))
+)
+
+# Send rate buckets, one per account and shared by every campaign sending from it
+rate_limiter = AccountRateLimiter()
+
+def store_refreshed_token(account_id, credentials):
+    """Keep the account's stored credentials in step with refreshed tokens"""
+    account = email_accounts.get(account_id)
+    if account is not None:
+        account['credentials'] = credentials_to_info(credentials)
+
+# Gmail API clients built once per account and reused across messages; tokens
+# are refreshed in the background before they expire
+gmail_services = GmailServiceCache(
+    lambda credentials: build(API_SERVICE_NAME, API_VERSION, credentials=credentials, cache_discovery=False),
+    on_refresh=store_refreshed_token,
+    refresh_margin=float(os.getenv('GMAIL_TOKEN_REFRESH_MARGIN', 600))
+)
+gmail_services.start_refresher(interval=float(os.getenv('GMAIL_TOKEN_REFRESH_INTERVAL', 60)))
+
+# Gmail batch mode: messages per batch request (0 sends one request per message)
+GMAIL_BATCH_SIZE = int(os.getenv('GMAIL_BATCH_SIZE', 0))
+GMAIL_BATCH_LINGER = float(os.getenv('GMAIL_BATCH_LINGER', 0.05))
+# Point at a local fake endpoint to test batch mode
+GMAIL_BATCH_ENDPOINT = os.getenv('GMAIL_BATCH_URI', GMAIL_BATCH_URI)
+
+# Seconds allowed for connecting to every selected account before a campaign starts
+PREWARM_TIMEOUT = float(os.getenv('PREWARM_TIMEOUT', 10))
+
 # Store templates
 templates = {}
 
@@ -88,10 +166,31 @@ default_template = {
 }
 templates[default_template['id']] = default_template
 
+# Templates compiled on first use; cleared whenever templates are saved
+template_cache = TemplateCache(lambda template_id: templates.get(template_id) or default_template)
+
 # Store uploaded files
 data_folder = 'data'
 os.makedirs(data_folder, exist_ok=True)
 
+# Attachments, stored once per distinct content and chosen per template
+attachment_store = AttachmentStore(os.getenv('ATTACHMENTS_FOLDER', os.path.join(data_folder, 'attachments')))
+
+# Contact list, in SQLite so single edits don't rewrite the whole list
+contact_store = ContactStore(os.getenv('CONTACTS_DB', 'contacts.db'))
+
+# Addresses never to be sent to again by any campaign (hard bounces, opt-outs)
+suppression_list = SuppressionList(os.getenv('SUPPRESSION_DB', 'suppression.db'))
+
+# Structured records of failed sends, for inspection and re-drive
+dead_letters = DeadLetterStore(os.getenv('DEAD_LETTER_DB', 'dead_letters.db'),
+                               max_records=int(os.getenv('DEAD_LETTER_MAX', 100000)))
+
+# Campaign journals, used to resume campaigns interrupted by a restart
+journal_folder = os.getenv('JOURNAL_FOLDER', 'journal')
+for interrupted in JournalState.unfinished(journal_folder):
+    logger.warning(f"Campaign {interrupted.campaign_id} was interrupted; POST /resume-campaign to continue it")
+
 # Save client secrets to file
 def save_client_secrets():
     client_secrets = {
@@ -238,21 +337,16 @@ def oauth2callback():
 
         # Store credentials in the session
         credentials = flow.credentials
-        session['credentials'] = {
-            'token': credentials.token,
-            'refresh_token': credentials.refresh_token,
-            'token_uri': credentials.token_uri,
-            'client_id': credentials.client_id,
-            'client_secret': credentials.client_secret,
-            'scopes': credentials.scopes
-        }
+        session['credentials'] = credentials_to_info(credentials)
         
         logger.debug(f"Credentials stored in session: {session.get('credentials')}")
 
         # Get user email
+        account_id = str(uuid.uuid4())
+        account = {'id': account_id, 'credentials': dict(session['credentials'])}
         try:
-            service = build('gmail', 'v1', credentials=credentials)
-            profile = service.users().getProfile(userId='me').execute()
+            with gmail_services.service(account, credentials=credentials) as service:
+                profile = service.users().getProfile(userId='me').execute()
             user_email = profile['emailAddress']
             logger.info(f"Successfully got user email: {user_email}")
         except Exception as profile_error:
@@ -269,25 +363,17 @@ def oauth2callback():
                 logger.info(f"Got email from ID token: {user_email}")
             except Exception as jwt_error:
                 logger.error(f"Error extracting email from ID token: {str(jwt_error)}")
+                gmail_services.invalidate(account_id)
                 return error_page(f"Could not get user email: {str(profile_error)}")
         
         # Store account in email_accounts
-        account_id = str(uuid.uuid4())
-        email_accounts[account_id] = {
-            'id': account_id,
+        account.update({
             'type': 'gmail',
             'email': user_email,
             'name': user_email.split('@')[0],
-            'isConnected': True,
-            'credentials': {
-                'token': credentials.token,
-                'refresh_token': credentials.refresh_token,
-                'token_uri': credentials.token_uri,
-                'client_id': credentials.client_id,
-                'client_secret': credentials.client_secret,
-                'scopes': credentials.scopes
-            }
-        }
+            'isConnected': True
+        })
+        email_accounts[account_id] = account
         
         logger.info(f"OAuth account stored for {user_email}")
 
@@ -421,6 +507,10 @@ def add_smtp_account():
             'username': data['username'],
             'password': data['password'],
             'use_ssl': data.get('use_ssl', False),
+            'starttls': data.get('starttls', True),  # Only plain relays should turn this off
+            'rate_limit': data.get('rate_limit'),  # Optional messages per rate_period
+            'rate_period': data.get('rate_period', 'minute'),
+            'burst': data.get('burst', 1),
             'isConnected': False  # Will be set to True after testing
         }
         
@@ -435,6 +525,9 @@ def delete_account(account_id):
     """Delete an email account"""
     if account_id in email_accounts:
         del email_accounts[account_id]
+        smtp_pools.discard(account_id)
+        gmail_services.invalidate(account_id)
+        rate_limiter.set_limit(account_id, None)
         logger.info(f"Account deleted: {account_id}")
         return jsonify({"message": "Account deleted successfully"})
     return jsonify({"error": "Account not found"}), 404
@@ -459,40 +552,30 @@ def test_account():
         if account['type'] == 'gmail':
             # Test Gmail OAuth account
             try:
-                credentials = Credentials(
-                    token=account['credentials']['token'],
-                    refresh_token=account['credentials']['refresh_token'],
-                    token_uri=account['credentials']['token_uri'],
-                    client_id=account['credentials']['client_id'],
-                    client_secret=account['credentials']['client_secret'],
-                    scopes=account['credentials']['scopes']
-                )
-                
-                service = build('gmail', 'v1', credentials=credentials)
-                
-                # Just get the profile to test the connection
-                profile = service.users().getProfile(userId='me').execute()
-                
-                # If test email is provided, send a test email
-                if test_email:
-                    message = MIMEMultipart()
-                    message['to'] = test_email
-                    message['subject'] = "Test Email from Email Automation System"
-                    
-                    body = "This is a test email to verify your Gmail account connection."
-                    message.attach(MIMEText(body, 'plain'))
-                    
-                    # Encode the message
-                    encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+                with gmail_services.service(account) as service:
+                    # Just get the profile to test the connection
+                    profile = service.users().getProfile(userId='me').execute()
                     
-                    # Create the message
-                    create_message = {
-                        'raw': encoded_message
-                    }
-                    
-                    # Send the message
-                    send_message = service.users().messages().send(
-                        userId="me", body=create_message).execute()
+                    # If test email is provided, send a test email
+                    if test_email:
+                        message = MIMEMultipart()
+                        message['to'] = test_email
+                        message['subject'] = "Test Email from Email Automation System"
+                        
+                        body = "This is a test email to verify your Gmail account connection."
+                        message.attach(MIMEText(body, 'plain'))
+                        
+                        # Encode the message
+                        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+                        
+                        # Create the message
+                        create_message = {
+                            'raw': encoded_message
+                        }
+                        
+                        # Send the message
+                        send_message = service.users().messages().send(
+                            userId="me", body=create_message).execute()
                 
                 # Update account status
                 email_accounts[account_id]['isConnected'] = True
@@ -506,44 +589,22 @@ def test_account():
         else:
             # Test SMTP account
             try:
-                host = account['host']
-                port = account['port']
-                username = account['username']
-                password = account['password']
-                use_ssl = account.get('use_ssl', False)
+                pool = smtp_pools.get(account)
                 
                 # If test email is provided, send a test email
                 if test_email:
                     msg = MIMEMultipart()
-                    msg['From'] = username
+                    msg['From'] = account['username']
                     msg['To'] = test_email
                     msg['Subject'] = "Test Email from Email Automation System"
                     
                     body = "This is a test email to verify your SMTP configuration is working correctly."
                     msg.attach(MIMEText(body, 'plain'))
                     
-                    if use_ssl:
-                        server = smtplib.SMTP_SSL(host, port)
-                    else:
-                        server = smtplib.SMTP(host, port)
-                        server.starttls()
-                        
-                    server.login(username, password)
-                    
-                    if test_email:
-                        server.send_message(msg)
-                    
-                    server.quit()
+                    pool.send_message(msg)
                 else:
                     # Just test the connection without sending an email
-                    if use_ssl:
-                        server = smtplib.SMTP_SSL(host, port)
-                    else:
-                        server = smtplib.SMTP(host, port)
-                        server.starttls()
-                        
-                    server.login(username, password)
-                    server.quit()
+                    pool.check()
                 
                 # Update account status
                 email_accounts[account_id]['isConnected'] = True
@@ -558,6 +619,44 @@ def test_account():
         logger.error(f"Error testing account: {str(e)}")
         return jsonify({"error": str(e)}), 400
 
+def check_account(account, warm_sessions=1):
+    """Connect and authenticate an account, leaving warm_sessions SMTP sessions ready"""
+    if account['type'] == 'gmail':
+        with gmail_services.service(account) as service:
+            service.users().getProfile(userId='me').execute()
+    else:
+        smtp_pools.get(account).warm(warm_sessions)
+
+@app.route('/smtp/test-bulk', methods=['POST'])
+def test_accounts():
+    """Test many account connections in parallel (all accounts by default)"""
+    try:
+        data = request.json or {}
+        account_ids = data.get('accountIds') or list(email_accounts.keys())
+        for account_id in account_ids:
+            if account_id not in email_accounts:
+                return jsonify({"error": f"Account ID {account_id} not found"}), 404
+        accounts = [email_accounts[account_id] for account_id in account_ids]
+        
+        healthy, failures = check_accounts(accounts, check_account,
+                                           timeout=float(data.get('timeout', PREWARM_TIMEOUT)))
+        results = []
+        for account in accounts:
+            error = failures.get(account['id'])
+            account['isConnected'] = error is None
+            results.append({
+                "accountId": account['id'],
+                "email": account['email'],
+                "connected": error is None,
+                "error": error
+            })
+        
+        logger.info(f"Bulk account test: {len(healthy)} connected, {len(failures)} failed")
+        return jsonify({"results": results, "connected": len(healthy), "failed": len(failures)})
+    except Exception as e:
+        logger.error(f"Error testing accounts: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
 @app.route('/gmail-status', methods=['GET'])
 def gmail_status():
     email = request.args.get('email')
@@ -575,6 +674,7 @@ def revoke_oauth():
     if account_id and account_id in email_accounts:
         # Remove the account
         account = email_accounts.pop(account_id)
+        gmail_services.invalidate(account_id)
         logger.info(f"OAuth account revoked: {account['email']}")
         return jsonify({"message": "OAuth account revoked successfully"})
     return jsonify({"error": "Account not found or not connected"}), 404
@@ -610,97 +710,277 @@ def process_contact(contact):
     
     return email, name, template_id
 
+def import_legacy_contacts():
+    """Move a contacts.csv left by earlier versions into the contact store"""
+    csv_path = os.path.join(data_folder, 'contacts.csv')
+    if not os.path.exists(csv_path):
+        return
+    if contact_store.count() == 0:
+        contact_import = ContactImport(suppression_list)
+        with open(csv_path, 'r', encoding='utf-8', newline='') as file:
+            contact_store.replace(contact_import.filter(read_csv(file, process_contact)))
+        logger.info(f"Imported contacts from {csv_path}: {contact_import.counts()}")
+    # Moved out of data/ so it isn't imported again or sent as an attachment
+    os.replace(csv_path, os.path.join(os.path.dirname(contact_store.path), 'contacts.csv.imported'))
+
+import_legacy_contacts()
+
+# Attachments uploaded to data/ by earlier versions
+attachment_store.import_folder(data_folder)
+
 @app.route('/upload-contacts', methods=['POST'])
 def upload_contacts():
+    """Replace the contact list with an uploaded CSV, or TXT with one email per line
+
+    The upload is read once, as a stream: each address is normalized and
+    validated, repeats are dropped, and accepted rows go straight into the
+    store in batches.
+    """
     try:
         file = request.files['file']
-        file_path = os.path.join(data_folder, 'contacts.csv')
-        
-        # Check if it's a CSV or TXT file
+        lines = io.TextIOWrapper(file.stream, encoding='utf-8', newline='')
         if file.filename.endswith('.txt'):
-            # Process TXT file (one email per line)
-            with open(file_path, 'w', encoding='utf-8') as csv_file:
-                csv_file.write("email,name,templateId\n")  # Updated header
-                for line in file:
-                    email = line.decode('utf-8').strip()
-                    if email:  # Skip empty lines
-                        csv_file.write(f"{email},,{default_template['id']}\n")  # Use default template
+            rows = read_lines(lines, default_template['id'])
         else:
-            # Save as CSV
-            file.save(file_path)
-        
-        # Count total contacts
-        with open(file_path, 'r') as f:
-            total = sum(1 for line in f) - 1  # Subtract 1 for header
-            if total < 0:
-                total = 0
-            campaign_status['total'] = total
+            rows = read_csv(lines, process_contact)
+        contact_import = ContactImport(suppression_list)
+        total = contact_store.replace(contact_import.filter(rows))
+        idle_status['total'] = total
             
-        logger.info(f"Contacts uploaded: {total} contacts")
+        logger.info(f"Contacts uploaded: {contact_import.counts()}")
         return jsonify({
             "message": "Contacts uploaded successfully!", 
-            "total": total
+            "total": total,
+            **contact_import.counts()
         })
     except Exception as e:
         logger.error(f"Error uploading contacts: {str(e)}")
         return jsonify({"error": str(e)}), 400
 
+def stream_contacts(rows, chunk_size=500):
+    """A {"contacts": [...]} document, serialized a chunk of contacts at a time"""
+    yield '{"contacts": ['
+    separator = ''
+    while True:
+        chunk = [json.dumps(contact_dict(row)) for row in itertools.islice(rows, chunk_size)]
+        if not chunk:
+            break
+        yield separator + ','.join(chunk)
+        separator = ','
+    yield ']}'
+
 @app.route('/get-contacts', methods=['GET'])
 def get_contacts():
+    """Contacts matching the q, email, name and templateId filters
+
+    With `limit`, returns one page and a `nextCursor` to pass as `cursor` for
+    the next page (`offset` works too, but slows down deep into a large list).
+    Without it the whole list is streamed, as JSON or with format=ndjson as
+    one contact per line, so the list is never held in memory.
+    """
     try:
-        file_path = os.path.join(data_folder, 'contacts.csv')
-        if not os.path.exists(file_path):
-            return jsonify({"contacts": []})
-            
-        contacts = []
-        with open(file_path, 'r', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            next(reader, None)  # Skip header
-            for row in reader:
-                email, name, template_id = process_contact(row)
-                if email:  # Only include if email exists
-                    contacts.append({
-                        "email": email,
-                        "name": name,
-                        "templateId": template_id
-                    })
-        
+        filters = {key: request.args[key] for key in ('q', 'email', 'name', 'templateId') if request.args.get(key)}
+        cursor = int(request.args.get('cursor', 0))
+        offset = int(request.args.get('offset', 0))
+        limit = request.args.get('limit')
+        limit = max(1, min(int(limit), MAX_CONTACTS_PAGE)) if limit else None
+        rows = contact_store.iter_rows(filters=filters, after_id=cursor, offset=offset, limit=limit)
+
+        if request.args.get('format') == 'ndjson':
+            return Response((json.dumps(contact_dict(row)) + '\n' for row in rows), mimetype='application/x-ndjson')
+        if limit is None:
+            return Response(stream_contacts(rows), mimetype='application/json')
+
+        contacts = [contact_dict(row) for row in rows]
         logger.debug(f"Retrieved {len(contacts)} contacts")
-        return jsonify({"contacts": contacts})
+        return jsonify({
+            "contacts": contacts,
+            "nextCursor": contacts[-1]['id'] if len(contacts) == limit else None,
+            "total": contact_store.count(filters)
+        })
     except Exception as e:
         logger.error(f"Error getting contacts: {str(e)}")
         return jsonify({"error": str(e)}), 400
 
+def contact_row(contact):
+    """Store row for a contact as sent by the frontend"""
+    return (contact.get('email', ''),
+            contact.get('name', ''),
+            contact.get('templateId') or default_template['id'],
+            contact.get('fields'))
+
 @app.route('/save-contacts', methods=['POST'])
 def save_contacts():
+    """Replace the whole contact list"""
     try:
         contacts = request.json.get('contacts', [])
-        file_path = os.path.join(data_folder, 'contacts.csv')
-        
-        with open(file_path, 'w', encoding='utf-8', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(['email', 'name', 'templateId'])  # Updated header
-            for contact in contacts:
-                writer.writerow([
-                    contact.get('email', ''),
-                    contact.get('name', ''),
-                    contact.get('templateId', default_template['id'])
-                ])
+        contact_import = ContactImport(suppression_list)
+        total = contact_store.replace(contact_import.filter(
+            contact_row(contact) for contact in contacts if contact.get('email')))
                 
         # Update total count
-        campaign_status['total'] = len(contacts)
+        idle_status['total'] = total
         
-        logger.info(f"Contacts saved: {len(contacts)} contacts")
+        logger.info(f"Contacts saved: {contact_import.counts()}")
         return jsonify({
             "message": "Contacts saved successfully!",
-            "total": len(contacts)
+            "total": total,
+            **contact_import.counts()
         })
     except Exception as e:
         logger.error(f"Error saving contacts: {str(e)}")
         return jsonify({"error": str(e)}), 400
 
+@app.route('/contacts', methods=['POST'])
+def add_contacts():
+    """Add one contact, or several listed under 'contacts'"""
+    try:
+        data = request.json
+        contacts = data.get('contacts', [data])
+        invalid = [contact.get('email') or '(missing)' for contact in contacts
+                   if not normalize_email(contact.get('email') or '')]
+        if invalid:
+            return jsonify({"error": f"Invalid email addresses: {', '.join(invalid[:10])}"}), 400
+
+        # Addresses already in the list, repeated in this request or suppressed are skipped
+        contact_import = ContactImport(suppression_list)
+        rows = list(contact_import.filter(contact_row(contact) for contact in contacts))
+        existing = contact_store.existing_emails(row[0] for row in rows)
+        ids = contact_store.add(row for row in rows if row[0] not in existing)
+        idle_status['total'] = contact_store.count()
+
+        logger.info(f"Contacts added: {len(ids)} contacts")
+        return jsonify({"ids": ids, "duplicates": contact_import.duplicates + len(existing),
+                        "suppressed": contact_import.suppressed_count, "total": idle_status['total']})
+    except Exception as e:
+        logger.error(f"Error adding contacts: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/contacts/<int:contact_id>', methods=['PUT'])
+def update_contact(contact_id):
+    try:
+        changes = request.json
+        if 'email' in changes:
+            email = normalize_email(changes['email'] or '')
+            if not email:
+                return jsonify({"error": f"Invalid email address: {changes['email']}"}), 400
+            changes = {**changes, 'email': email}
+        if not contact_store.update(contact_id, changes):
+            return jsonify({"error": "Contact not found"}), 404
+        return jsonify({"contact": contact_store.get(contact_id)})
+    except Exception as e:
+        logger.error(f"Error updating contact: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/contacts/<int:contact_id>', methods=['DELETE'])
+def delete_contact(contact_id):
+    try:
+        if not contact_store.delete([contact_id]):
+            return jsonify({"error": "Contact not found"}), 404
+        idle_status['total'] = contact_store.count()
+        return jsonify({"message": "Contact deleted", "total": idle_status['total']})
+    except Exception as e:
+        logger.error(f"Error deleting contact: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/contacts/delete', methods=['POST'])
+def delete_contacts():
+    """Delete the contacts whose ids are listed under 'ids'"""
+    try:
+        deleted = contact_store.delete(request.json.get('ids', []))
+        idle_status['total'] = contact_store.count()
+        logger.info(f"Contacts deleted: {deleted} contacts")
+        return jsonify({"deleted": deleted, "total": idle_status['total']})
+    except Exception as e:
+        logger.error(f"Error deleting contacts: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
+def uploaded_addresses(file):
+    """Addresses in an uploaded file: one per line, or the first column of a CSV"""
+    lines = io.TextIOWrapper(file.stream, encoding='utf-8', newline='')
+    for index, row in enumerate(csv.reader(lines)):
+        if not row or (index == 0 and '@' not in row[0]):  # Blank line or header
+            continue
+        yield row[0]
+
+def normalized_addresses(addresses, counts):
+    for address in addresses:
+        email = normalize_email(address or '')
+        if email is None:
+            counts['invalid'] += 1
+            continue
+        yield email
+
+def address_batch():
+    """Addresses and reason of a suppression request: JSON 'emails', or an uploaded file"""
+    if 'file' in request.files:
+        return uploaded_addresses(request.files['file']), request.form.get('reason', 'manual')
+    data = request.json
+    return data.get('emails', []), data.get('reason', 'manual')
+
+@app.route('/suppression', methods=['GET'])
+def get_suppression():
+    """Size of the suppression list, and with ?email= whether that address is on it"""
+    try:
+        result = {"total": len(suppression_list)}
+        if request.args.get('email'):
+            email = normalize_email(request.args['email'])
+            result["suppressed"] = email is not None and email in suppression_list
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error checking suppression list: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/suppression', methods=['POST'])
+def add_suppressions():
+    """Suppress addresses listed under 'emails' or in an uploaded file"""
+    try:
+        addresses, reason = address_batch()
+        counts = {'invalid': 0}
+        added = suppression_list.add(normalized_addresses(addresses, counts), reason=reason)
+        logger.info(f"Suppressed {added} addresses ({counts['invalid']} invalid)")
+        return jsonify({"added": added, "invalid": counts['invalid'], "total": len(suppression_list)})
+    except Exception as e:
+        logger.error(f"Error adding to suppression list: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/suppression/remove', methods=['POST'])
+def remove_suppressions():
+    """Stop suppressing addresses listed under 'emails' or in an uploaded file"""
+    try:
+        addresses, _ = address_batch()
+        counts = {'invalid': 0}
+        removed = suppression_list.remove(normalized_addresses(addresses, counts))
+        logger.info(f"Removed {removed} addresses from the suppression list")
+        return jsonify({"removed": removed, "invalid": counts['invalid'], "total": len(suppression_list)})
+    except Exception as e:
+        logger.error(f"Error removing from suppression list: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
+def stream_suppressions(chunk_size=1000):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['email', 'reason', 'addedAt'])
+    entries = suppression_list.entries()
+    while True:
+        chunk = list(itertools.islice(entries, chunk_size))
+        writer.writerows((email, reason, time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(added_at)))
+                         for email, reason, added_at in chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        if not chunk:
+            return
+
+@app.route('/suppression/export', methods=['GET'])
+def export_suppressions():
+    """The whole suppression list as a streamed CSV"""
+    return Response(stream_suppressions(), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=suppression.csv'})
+
 @app.route('/upload-attachment', methods=['POST'])
 def upload_attachment():
+    """Store an uploaded file as it streams in; a file already stored with the same content isn't kept twice"""
     try:
         if 'file' not in request.files:
             return jsonify({"error": "No file part"}), 400
@@ -709,13 +989,12 @@ def upload_attachment():
         if file.filename == '':
             return jsonify({"error": "No selected file"}), 400
             
-        file_path = os.path.join(data_folder, file.filename)
-        file.save(file_path)
+        attachment = attachment_store.save(file.filename, file.stream, getattr(file, 'mimetype', None))
         
-        logger.info(f"Attachment uploaded: {file.filename}")
+        logger.info(f"Attachment uploaded: {attachment['filename']} ({attachment['hash'][:12]})")
         return jsonify({
             "message": "Attachment uploaded successfully!",
-            "filename": file.filename
+            **attachment
         })
     except Exception as e:
         logger.error(f"Error uploading attachment: {str(e)}")
@@ -724,16 +1003,7 @@ def upload_attachment():
 @app.route('/get-attachments', methods=['GET'])
 def get_attachments():
     try:
-        attachments = []
-        for filename in os.listdir(data_folder):
-            if filename != 'contacts.csv':
-                file_path = os.path.join(data_folder, filename)
-                file_size = os.path.getsize(file_path)
-                attachments.append({
-                    "filename": filename,
-                    "size": file_size
-                })
-        
+        attachments = attachment_store.list()
         logger.debug(f"Retrieved {len(attachments)} attachments")
         return jsonify({"attachments": attachments})
     except Exception as e:
@@ -746,10 +1016,15 @@ def delete_attachment():
         filename = request.json.get('filename')
         if not filename:
             return jsonify({"error": "No filename provided"}), 400
-            
-        file_path = os.path.join(data_folder, filename)
-        if os.path.exists(file_path) and filename != 'contacts.csv':
-            os.remove(file_path)
+
+        # Campaigns refuse to start while a template names a missing attachment
+        users = [t.get('name', template_id) for template_id, t in templates.items()
+                 if filename in (t.get('attachments') or [])]
+        if users:
+            return jsonify({"error": f"Attachment {filename} is used by templates: {', '.join(users)}",
+                            "templates": users}), 409
+
+        if attachment_store.delete(filename):
             logger.info(f"Attachment deleted: {filename}")
             return jsonify({"message": f"Attachment {filename} deleted successfully"})
         else:
@@ -772,6 +1047,25 @@ def save_templates():
         default_count = sum(1 for t in data if t.get('isDefault'))
         if default_count != 1:
             return jsonify({"error": "Exactly one template must be set as default"}), 400
+
+        # Reject templates whose placeholders don't compile
+        for template_data in data:
+            try:
+                CompiledTemplate(template_data)
+            except TemplateError as e:
+                return jsonify({"error": f"Template {template_data.get('name', '')}: {str(e)}"}), 400
+
+        # Attachments are listed by name; leaving the list out sends all of them
+        for template_data in data:
+            names = template_data.get('attachments')
+            if names is None:
+                continue
+            if not isinstance(names, list):
+                return jsonify({"error": f"Template {template_data.get('name', '')}: attachments must be a list"}), 400
+            missing = [name for name in names if name not in attachment_store]
+            if missing:
+                return jsonify({"error": f"Template {template_data.get('name', '')}: "
+                                         f"attachments not found: {', '.join(missing)}"}), 400
             
         # Clear existing templates
         templates.clear()
@@ -787,6 +1081,7 @@ def save_templates():
             templates[template_id] = template_data
             if template_data.get('isDefault'):
                 default_template = template_data
+        template_cache.invalidate()
                 
         logger.info(f"Templates saved: {len(templates)} templates")
         return jsonify({"message": "Templates saved successfully"})
@@ -814,23 +1109,11 @@ def test_email():
         account = email_accounts[account_id]
         
         # Use default template for test email
-        subject = default_template['subject']
-        body = default_template['content'].replace('[NAME]', 'Test User')
+        subject, body = CompiledTemplate(default_template).render({'name': 'Test User', 'email': test_email})
         
         if account['type'] == 'gmail':
             # Send test email using Gmail API
             try:
-                credentials = Credentials(
-                    token=account['credentials']['token'],
-                    refresh_token=account['credentials']['refresh_token'],
-                    token_uri=account['credentials']['token_uri'],
-                    client_id=account['credentials']['client_id'],
-                    client_secret=account['credentials']['client_secret'],
-                    scopes=account['credentials']['scopes']
-                )
-                
-                service = build('gmail', 'v1', credentials=credentials)
-                
                 message = MIMEMultipart()
                 message['to'] = test_email
                 message['subject'] = subject
@@ -846,8 +1129,9 @@ def test_email():
                 }
                 
                 # Send the message
-                send_message = service.users().messages().send(
-                    userId="me", body=create_message).execute()
+                with gmail_services.service(account) as service:
+                    send_message = service.users().messages().send(
+                        userId="me", body=create_message).execute()
                 
                 logger.info(f"Test email sent via Gmail API to {test_email}")
                 return jsonify({"message": "Test email sent successfully via Gmail API"})
@@ -857,28 +1141,14 @@ def test_email():
         else:
             # Send test email using SMTP
             try:
-                host = account['host']
-                port = account['port']
-                username = account['username']
-                password = account['password']
-                use_ssl = account.get('use_ssl', False)
-                
                 msg = MIMEMultipart()
-                msg['From'] = username
+                msg['From'] = account['username']
                 msg['To'] = test_email
                 msg['Subject'] = subject
                 
                 msg.attach(MIMEText(body, 'plain'))
                 
-                if use_ssl:
-                    server = smtplib.SMTP_SSL(host, port)
-                else:
-                    server = smtplib.SMTP(host, port)
-                    server.starttls()
-                    
-                server.login(username, password)
-                server.send_message(msg)
-                server.quit()
+                smtp_pools.get(account).send_message(msg)
                 
                 logger.info(f"Test email sent via SMTP to {test_email}")
                 return jsonify({"message": "Test email sent successfully via SMTP"})
@@ -890,36 +1160,160 @@ def test_email():
         logger.error(f"Error sending test email: {str(e)}")
         return jsonify({"error": str(e)}), 400
 
+def find_campaign(campaign_id=None):
+    """The campaign with the given id, or the most recently started one"""
+    with campaigns_lock:
+        return campaigns.get(campaign_id or latest_campaign_id)
+
+def campaign_summary(campaign):
+    status = campaign.status
+    return {
+        "campaignId": campaign.campaign_id,
+        "isRunning": status['is_running'],
+        "remaining": status['remaining'],
+        "total": status['total'],
+        "completed": status['completed'],
+        "suppressed": status['suppressed'],
+        "status": "running" if status['is_running'] else "completed",
+        "connections": connection_budget.allowance(campaign.campaign_id)
+    }
+
 @app.route('/campaign-status', methods=['GET'])
 def get_campaign_status():
+    campaign_id = request.args.get('campaignId')
+    campaign = find_campaign(campaign_id)
+    if campaign is None:
+        if campaign_id:
+            return jsonify({"error": f"Campaign {campaign_id} not found"}), 404
+        return jsonify({
+            "isRunning": idle_status['is_running'],
+            "remaining": idle_status['remaining'],
+            "total": idle_status['total'],
+            "errors": idle_status['errors'][-5:],
+            "completed": idle_status['completed'],
+            "status": "completed",
+            "campaignId": None,
+            "accounts": [],
+            "loadingContacts": False
+        })
     return jsonify({
-        "isRunning": campaign_status['is_running'],
-        "remaining": campaign_status['remaining'],
-        "total": campaign_status['total'],
-        "errors": campaign_status['errors'][-5:],  # Return last 5 errors
-        "completed": campaign_status['completed'],
-        "status": "running" if campaign_status['is_running'] else "completed"
+        **campaign_summary(campaign),
+        "errors": list(campaign.status['errors'])[-5:],  # Return last 5 errors
+        "failures": dict(campaign.failure_counts),
+        "accounts": campaign.account_scheduler.stats(),
+        "quarantinedAccounts": campaign.status.get('quarantined', []),
+        "domains": campaign.domains.stats() if campaign.domains else None,
+        "loadingContacts": not campaign.contacts.done.is_set()
+    })
+
+@app.route('/campaigns', methods=['GET'])
+def get_campaigns():
+    """All known campaigns and how the connection budget is split between them"""
+    with campaigns_lock:
+        known = list(campaigns.values())
+    return jsonify({
+        "campaigns": [campaign_summary(campaign) for campaign in known],
+        "budget": connection_budget.stats(),
+        "gmailClients": gmail_services.stats()
     })
 
 @app.route('/reset-campaign', methods=['POST'])
 def reset_campaign():
-    global campaign_status
-    campaign_status = {
+    """Stop a campaign (by default the latest) and forget its status"""
+    global latest_campaign_id
+    data = request.get_json(silent=True) or {}
+    campaign_id = data.get('campaignId') or request.args.get('campaignId')
+    campaign = find_campaign(campaign_id)
+    if campaign is None and campaign_id:
+        return jsonify({"error": f"Campaign {campaign_id} not found"}), 404
+    if campaign is not None:
+        campaign.stop()
+        with campaigns_lock:
+            campaigns.pop(campaign.campaign_id, None)
+            if latest_campaign_id == campaign.campaign_id:
+                latest_campaign_id = None
+    idle_status.update({
         'is_running': False,
         'remaining': 0,
         'total': 0,
         'errors': [],
         'completed': False
-    }
+    })
     logger.info("Campaign status reset")
     return jsonify({"message": "Campaign status reset successfully"})
 
+def register_campaign(campaign):
+    """Make a new campaign the latest, dropping the oldest finished ones"""
+    global latest_campaign_id
+    with campaigns_lock:
+        campaigns[campaign.campaign_id] = campaign
+        latest_campaign_id = campaign.campaign_id
+        finished = [c for c in campaigns.values() if not c.status['is_running']]
+        for old in finished[:max(0, len(finished) - MAX_FINISHED_CAMPAIGNS)]:
+            del campaigns[old.campaign_id]
+
 @app.route('/send-emails', methods=['POST'])
 def send_emails():
-    global campaign_status
-    
+    return start_campaign(request.json)
+
+def unfinished_journals():
+    """Journals of interrupted campaigns, leaving out those running right now"""
+    with campaigns_lock:
+        running = {cid for cid, c in campaigns.items() if c.status['is_running']}
+    return [state for state in JournalState.unfinished(journal_folder) if state.campaign_id not in running]
+
+@app.route('/resumable-campaigns', methods=['GET'])
+def get_resumable_campaigns():
+    """List campaigns whose journal shows they were interrupted"""
+    try:
+        resumable = []
+        for state in unfinished_journals():
+            resumable.append({
+                "campaignId": state.campaign_id,
+                "startedAt": state.header.get('startedAt'),
+                **state.counts()
+            })
+        return jsonify({"campaigns": resumable})
+    except Exception as e:
+        logger.error(f"Error listing resumable campaigns: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/resume-campaign', methods=['POST'])
+def resume_campaign():
+    """Continue an interrupted campaign where its journal left off"""
+    try:
+        data = request.json or {}
+        unfinished = unfinished_journals()
+        if data.get('campaignId'):
+            unfinished = [s for s in unfinished if s.campaign_id == data['campaignId']]
+        if not unfinished:
+            return jsonify({"error": "No interrupted campaign found"}), 404
+        # Most recently started campaign first
+        state = max(unfinished, key=lambda s: s.header.get('startedAt', 0))
+        
+        # Original settings, with anything in this request (e.g. selectedAccounts) taking precedence
+        settings = dict(state.header.get('settings', {}))
+        settings.update(data)
+        return start_campaign(settings, resume=state)
+    except Exception as e:
+        logger.error(f"Error resuming campaign: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
+def skip_suppressed(rows, status):
+    """Drop suppressed recipients as the campaign reads its contacts, before anything is rendered"""
+    for row in rows:
+        if row[0] in suppression_list:
+            status['suppressed'] += 1
+            continue
+        yield row
+
+def start_campaign(data, resume=None, campaign_id=None):
+    """Validate settings and start a campaign, optionally resuming from a journal
+
+    With `redrive` set in the settings, the campaign sends to the dead-letter
+    records claimed for `campaign_id` instead of the contact list.
+    """
     try:
-        data = request.json
         selected_account_ids = data.get('selectedAccounts', [])
         
         if not selected_account_ids:
@@ -940,196 +1334,256 @@ def send_emails():
         if not valid_accounts:
             return jsonify({"error": "No valid connected accounts selected"}), 400
 
-        delay = int(data.get('pause_between_messages', 5))
+        delay = float(data.get('pause_between_messages', 5))
         retries = int(data.get('retries', 1))
         max_connections = int(data.get('max_connections', 5))
+        engine = data.get('engine', 'threads')
+        render_processes = int(data.get('render_processes', RENDER_PROCESSES))
+        gmail_batch_size = int(data.get('gmail_batch_size', GMAIL_BATCH_SIZE))
+        if engine not in ('threads', 'async'):
+            return jsonify({"error": f"Unknown engine: {engine}"}), 400
+        initial_connections = int(data.get('initial_connections', 2))
+
+        # Connect and authenticate every account in parallel; accounts that fail sit this campaign out
+        quarantined = []
+        if data.get('prewarm', True):
+            # The threaded engine sends from the shared pools, so fill them now
+            warm_sessions = initial_connections if engine == 'threads' else 1
+            selected = valid_accounts
+            valid_accounts, failures = check_accounts(selected, lambda account: check_account(account, warm_sessions),
+                                                      timeout=PREWARM_TIMEOUT)
+            quarantined = [{"id": account['id'], "email": account['email'], "error": failures[account['id']]}
+                           for account in selected if account['id'] in failures]
+            if not valid_accounts:
+                return jsonify({"error": "None of the selected accounts passed the connection check",
+                                "quarantinedAccounts": quarantined}), 400
+
+        # Per-account send rate: an explicit rate_limit, otherwise one message per pause
+        if data.get('rate_limit'):
+            rate = parse_rate(data['rate_limit'], data.get('rate_period', 'minute'))
+        else:
+            rate = 1 / delay if delay > 0 else None
+        burst = int(data.get('burst', 1))
+
+        # Campaigns sending from the same account draw from its one bucket; the latest settings apply
+        for account in valid_accounts:
+            if account.get('rate_limit'):
+                rate_limiter.set_limit(account['id'],
+                                       parse_rate(account['rate_limit'], account.get('rate_period', 'minute')),
+                                       account.get('burst', burst))
+            else:
+                rate_limiter.set_limit(account['id'], rate, burst)
+
+        # One account selector shared by every worker of this campaign
+        account_scheduler = AccountScheduler(valid_accounts, rate_limiter,
+                                             weights=data.get('accountWeights'),
+                                             quotas=data.get('accountQuotas'),
+                                             max_concurrency=max_connections,
+                                             initial_concurrency=initial_connections)
 
-        # Reset campaign status
-        campaign_status['errors'] = []
-        campaign_status['is_running'] = True
-        campaign_status['completed'] = False
-        
         # Check if templates exist
         if not templates:
             return jsonify({"error": "No templates found"}), 400
 
-        # Load contacts
-        contacts_path = os.path.join(data_folder, 'contacts.csv')
-        if not os.path.exists(contacts_path):
-            return jsonify({"error": "No contacts file found"}), 400
-
-        contacts = []
-        with open(contacts_path, mode='r', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            next(reader, None)  # Skip header
-            for row in reader:
-                email, name, template_id = process_contact(row)
-                if email:  # Only include if email exists
-                    contacts.append((email, name, template_id))
-
-        if not contacts:
-            return jsonify({"error": "No valid contacts found in file"}), 400
-
-        campaign_status['remaining'] = len(contacts)
-        campaign_status['total'] = len(contacts)
-
-        # Clear and fill queue
-        while not contact_queue.empty():
-            contact_queue.get()
-        
-        for contact in contacts:
-            contact_queue.put(contact)
-
-        def worker():
-            account_index = 0
-            while not contact_queue.empty():
-                try:
-                    email, name, template_id = contact_queue.get()
-                    
-                    # Get template with fallback to default template
-                    template = templates.get(template_id)
-                    if not template:
-                        template = default_template
-                    
-                    if not template:
-                        raise ValueError(f"No template found for ID {template_id}")
-                        
-                    email_body = template['content'].replace("[NAME]", name)
-                    subject = template['subject']
-                    
-                    # Round-robin: Get the next account
-                    current_account = valid_accounts[account_index]
-                    account_index = (account_index + 1) % len(valid_accounts)
-                    
-                    success = False
-                    for attempt in range(retries + 1):
-                        try:
-                            if current_account['type'] == 'gmail':
-                                # Send email using Gmail API
-                                credentials = Credentials(
-                                    token=current_account['credentials']['token'],
-                                    refresh_token=current_account['credentials']['refresh_token'],
-                                    token_uri=current_account['credentials']['token_uri'],
-                                    client_id=current_account['credentials']['client_id'],
-                                    client_secret=current_account['credentials']['client_secret'],
-                                    scopes=current_account['credentials']['scopes']
-                                )
-                                
-                                service = build('gmail', 'v1', credentials=credentials)
-                                
-                                message = MIMEMultipart()
-                                message['to'] = email
-                                message['subject'] = subject
-                                message.attach(MIMEText(email_body, 'plain'))
-                                
-                                # Add attachments if any
-                                for filename in os.listdir(data_folder):
-                                    if filename != 'contacts.csv':
-                                        attachment_path = os.path.join(data_folder, filename)
-                                        with open(attachment_path, 'rb') as attachment:
-                                            part = MIMEBase('application', 'octet-stream')
-                                            part.set_payload(attachment.read())
-                                            encoders.encode_base64(part)
-                                            part.add_header('Content-Disposition', f'attachment; filename={filename}')
-                                            message.attach(part)
-                                
-                                # Encode the message
-                                encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-                                
-                                # Create the message
-                                create_message = {
-                                    'raw': encoded_message
-                                }
-                                
-                                # Send the message
-                                send_message = service.users().messages().send(
-                                    userId="me", body=create_message).execute()
-                                
-                                logger.info(f'Email sent to {email} via Gmail API using account {current_account["email"]}')
-                                success = True
-                                break
-                            else:
-                                # Send email using SMTP
-                                host = current_account['host']
-                                port = current_account['port']
-                                username = current_account['username']
-                                password = current_account['password']
-                                use_ssl = current_account.get('use_ssl', False)
-                                
-                                msg = MIMEMultipart()
-                                msg['From'] = username
-                                msg['To'] = email
-                                msg['Subject'] = subject
-                                msg.attach(MIMEText(email_body, 'plain'))
-                                
-                                # Add attachments if any
-                                for filename in os.listdir(data_folder):
-                                    if filename != 'contacts.csv':
-                                        attachment_path = os.path.join(data_folder, filename)
-                                        with open(attachment_path, 'rb') as attachment:
-                                            part = MIMEBase('application', 'octet-stream')
-                                            part.set_payload(attachment.read())
-                                            encoders.encode_base64(part)
-                                            part.add_header('Content-Disposition', f'attachment; filename={filename}')
-                                            msg.attach(part)
-                                
-                                if use_ssl:
-                                    server = smtplib.SMTP_SSL(host, port)
-                                else:
-                                    server = smtplib.SMTP(host, port)
-                                    server.starttls()
-                                
-                                server.login(username, password)
-                                server.send_message(msg)
-                                server.quit()
-                                
-                                logger.info(f'Email sent to {email} via SMTP using account {current_account["email"]}')
-                                success = True
-                                break
-                        except Exception as e:
-                            logger.error(f'Error sending to {email} using account {current_account["email"]}: {e}')
-                            if attempt < retries:
-                                # Try the next account in the round-robin for the retry
-                                current_account = valid_accounts[account_index]
-                                account_index = (account_index + 1) % len(valid_accounts)
-                                time.sleep(2)
-                            else:
-                                campaign_status['errors'].append(f"Failed to send to {email}: {str(e)}")
-                    
-                    if not success:
-                        logger.error(f"Failed to send email to {email} after {retries + 1} attempts")
-                    
-                    with send_lock:
-                        campaign_status['remaining'] -= 1
-                        
-                    contact_queue.task_done()
-                    time.sleep(delay)
-                except Exception as e:
-                    logger.error(f"Worker error: {e}")
-                    campaign_status['errors'].append(str(e))
-                    with send_lock:
-                        campaign_status['remaining'] -= 1
-                    continue
-            
-            # Check if all emails are sent
-            if campaign_status['remaining'] <= 0:
-                campaign_status['is_running'] = False
-                campaign_status['completed'] = True
-                logger.info("Campaign completed!")
-
-        # Start worker threads
-        threads = []
-        for _ in range(max_connections):
-            thread = threading.Thread(target=worker)
-            thread.daemon = True  # Make thread daemon so it exits when main thread exits
-            thread.start()
-            threads.append(thread)
-
-        logger.info("Email campaign started")
-        return jsonify({"message": "Email campaign started!"})
+        # Every campaign has its own status and lock
+        status = {
+            'is_running': True,
+            'remaining': 0,
+            'total': 0,
+            'errors': collections.deque(maxlen=MAX_STATUS_ERRORS),
+            'completed': False,
+            'quarantined': quarantined,
+            'suppressed': 0
+        }
+        status_lock = threading.Lock()
+
+        if resume:
+            campaign_id = resume.campaign_id
+        elif campaign_id is None:
+            campaign_id = str(uuid.uuid4())
+
+        # Only the first contact is read here; the rest streams in from the store while sending
+        if data.get('redrive'):
+            rows = dead_letters.redrive_contacts(campaign_id)
+        else:
+            # Failures re-driven into this campaign before it was interrupted come after its own list
+            rows = itertools.chain(contact_store.campaign_contacts(),
+                                   dead_letters.redrive_contacts(campaign_id) if resume else ())
+        rows = skip_suppressed(rows, status)
+        if resume:
+            # Skip recipients the journal shows as done (or possibly sent, unless asked to resend)
+            resend_in_doubt = bool(data.get('resendInDoubt', False))
+            rows = (row for row in rows if not resume.should_skip(row[0], resend_in_doubt))
+        first_contact = next(rows, None)
+        if first_contact is None:
+            if resume:
+                CampaignJournal(resume.path).complete()
+                return jsonify({"message": "Nothing left to send; campaign marked complete",
+                                "campaignId": resume.campaign_id})
+            if status['suppressed']:
+                return jsonify({"error": f"All {status['suppressed']} contacts are suppressed"}), 400
+            return jsonify({"error": "No contacts found"}), 400
+        contacts = ContactProducer(itertools.chain([first_contact], rows), status, status_lock,
+                                   maxsize=CONTACT_QUEUE_SIZE)
+
+        # Map each template's pre-encoded attachments; later uploads and deletions don't affect this run
+        attachments = attachment_store.snapshot(templates, default_template)
+
+        if render_processes > 0:
+            # Build the message bytes on a process pool; senders only do network I/O
+            contacts = RenderStage(contacts, templates, default_template, attachments, render_processes,
+                                   batch_size=RENDER_BATCH_SIZE,
+                                   encode_gmail=any(a['type'] == 'gmail' for a in valid_accounts))
+
+        # Interleave recipient domains and keep each within its concurrency and rate caps
+        domain_rate_limit = data.get('domain_rate_limit', DOMAIN_RATE_LIMIT)
+        domain_rate_period = data.get('domain_rate_period', DOMAIN_RATE_PERIOD)
+        domain_overrides = {}
+        for domain, limits in (data.get('domainLimits') or {}).items():
+            override = {}
+            if limits.get('concurrency') is not None:
+                override['concurrency'] = int(limits['concurrency'])
+            if limits.get('rate_limit'):
+                override['rate'] = parse_rate(limits['rate_limit'], limits.get('rate_period', domain_rate_period))
+            if limits.get('burst') is not None:
+                override['burst'] = int(limits['burst'])
+            domain_overrides[domain] = override
+        contacts = DomainScheduler(contacts,
+                                   concurrency=int(data.get('domain_concurrency', DOMAIN_CONCURRENCY)),
+                                   rate=parse_rate(domain_rate_limit, domain_rate_period),
+                                   burst=int(data.get('domain_burst', 1)),
+                                   overrides=domain_overrides,
+                                   buffer=CONTACT_QUEUE_SIZE)
+
+        # Journal every recipient so the campaign can resume after a crash
+        if resume:
+            journal = CampaignJournal(resume.path)
+            logger.info(f"Resuming campaign {campaign_id}: {resume.counts()}")
+        else:
+            journal = CampaignJournal.create(journal_folder, campaign_id, {
+                'campaignId': campaign_id,
+                'startedAt': time.time(),
+                'settings': data
+            })
+
+        campaign = Campaign(
+            contacts,
+            # Compiled template with fallback to default template
+            template_cache.get,
+            attachments,
+            account_scheduler,
+            retries,
+            status,
+            status_lock,
+            smtp_pools,
+            gmail_services,
+            journal,
+            campaign_id=campaign_id,
+            budget=connection_budget,
+            domains=contacts,
+            suppression=suppression_list,
+            dead_letters=dead_letters,
+            gmail_batcher=GmailBatchSender(gmail_services, gmail_batch_size, GMAIL_BATCH_LINGER,
+                                           GMAIL_BATCH_ENDPOINT) if gmail_batch_size > 0 else None
+        )
+        register_campaign(campaign)
+
+        # Claim this campaign's share of the global connection budget
+        connection_budget.register(campaign_id, max_connections,
+                                   weight=float(data.get('weight', 1)),
+                                   priority=int(data.get('priority', 0)))
+        contacts.start()
+
+        # The asyncio engine runs every connection on one thread instead of one thread each
+        if engine == 'async':
+            AsyncCampaignRunner(campaign, max_connections, pool_options={
+                'max_messages': smtp_pools.pool_options['max_messages'],
+                'max_idle': smtp_pools.pool_options['max_idle'],
+                'timeout': smtp_pools.pool_options['timeout']
+            }).start()
+        else:
+            campaign.start_threads(max_connections)
+
+        logger.info(f"Email campaign {campaign_id} started")
+        return jsonify({"message": "Email campaign started!", "campaignId": campaign_id,
+                        "quarantinedAccounts": quarantined})
     except Exception as e:
         logger.error(f"Error starting campaign: {str(e)}")
-        campaign_status['is_running'] = False
+        return jsonify({"error": str(e)}), 400
+
+def dead_letter_filters(source):
+    """Dead-letter filters from query arguments or a JSON body"""
+    error_classes = source.get('errorClasses') or source.get('errorClass')
+    if isinstance(error_classes, str):
+        error_classes = error_classes.split(',')
+    if error_classes:
+        error_classes = [c.strip().lower() for c in error_classes if c.strip()]
+    retryable = source.get('retryable')
+    if isinstance(retryable, str):
+        retryable = retryable.lower() in ('1', 'true', 'yes')
+    return {
+        'campaignId': source.get('campaignId'),
+        'errorClasses': error_classes,
+        'retryable': retryable,
+        'ids': source.get('ids')
+    }
+
+@app.route('/dead-letters', methods=['GET'])
+def get_dead_letters():
+    """Failed sends, oldest first, filtered by campaignId, errorClass and retryable"""
+    try:
+        filters = dead_letter_filters(request.args)
+        limit = min(int(request.args.get('limit', 100)), MAX_DEAD_LETTERS_PAGE)
+        failures = dead_letters.list(filters, after_id=int(request.args.get('cursor', 0)), limit=limit)
+        return jsonify({
+            "failures": failures,
+            "nextCursor": failures[-1]['id'] if len(failures) == limit else None,
+            **dead_letters.counts(filters)
+        })
+    except Exception as e:
+        logger.error(f"Error listing dead letters: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/dead-letters/redrive', methods=['POST'])
+def redrive_dead_letters():
+    """Send the retryable failures again, in a running campaign (targetCampaignId) or a new one
+
+    A new campaign takes the same settings as /send-emails. Each failure is
+    re-driven once; recipients suppressed since are left out.
+    """
+    try:
+        data = request.json or {}
+        filters = dead_letter_filters(data)
+        limit = int(data['limit']) if data.get('limit') else None
+        target_id = data.get('targetCampaignId')
+        if target_id:
+            campaign = find_campaign(target_id)
+            if campaign is None:
+                return jsonify({"error": f"Campaign {target_id} not found"}), 404
+            claimed = dead_letters.claim(target_id, filters, limit)
+            if not claimed:
+                return jsonify({"error": "No retryable failures to re-drive"}), 400
+            contacts = [row for row in dead_letters.redrive_contacts(target_id) if row[0] not in suppression_list]
+            if not campaign.requeue(contacts):
+                dead_letters.release(target_id)
+                return jsonify({"error": f"Campaign {target_id} is no longer running"}), 400
+            logger.info(f"Re-driving {len(contacts)} failed recipients into campaign {target_id}")
+            return jsonify({"message": "Failures re-driven", "campaignId": target_id,
+                            "claimed": claimed, "queued": len(contacts)})
+
+        campaign_id = str(uuid.uuid4())
+        claimed = dead_letters.claim(campaign_id, filters, limit)
+        if not claimed:
+            return jsonify({"error": "No retryable failures to re-drive"}), 400
+        response = start_campaign({**data, 'redrive': True}, campaign_id=campaign_id)
+        if isinstance(response, tuple):
+            # The campaign didn't start, so the failures stay available
+            dead_letters.release(campaign_id)
+            return response
+        logger.info(f"Re-driving {claimed} failures in new campaign {campaign_id}")
+        return response
+    except Exception as e:
+        logger.error(f"Error re-driving dead letters: {str(e)}")
         return jsonify({"error": str(e)}), 400
 
 if __name__ == '__main__':
@@ -0,0 +1,288 @@
+"""Persistent, per-account SMTP connection pooling."""
+import smtplib
+import socket
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from message_builder import CRLF, WireMessage, quote_data
+
+logger = logging.getLogger(__name__)
+
+# Response codes that mean the server is dropping the session
+SESSION_CLOSING_CODES = (421,)
+
+
+class SplicingDataMixin:
+    """smtplib DATA that also takes a WireMessage, writing its shared segments to the socket as they are
+
+    sendmail() hands its message to data() unchanged, so everything else
+    (SIZE, refused senders and recipients, RSET) is smtplib's own.
+    """
+
+    def data(self, msg):
+        if not isinstance(msg, WireMessage):
+            return super().data(msg)
+        self.putcmd('data')
+        code, repl = self.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, repl)
+        self.send(quote_data(msg.head))
+        for segment in msg.segments:
+            self.send(segment)
+        self.send(b'.' + CRLF)
+        return self.getreply()
+
+
+class SplicingSMTP(SplicingDataMixin, smtplib.SMTP):
+    pass
+
+
+class SplicingSMTP_SSL(SplicingDataMixin, smtplib.SMTP_SSL):
+    pass
+
+
+class PooledSession:
+    """An authenticated SMTP session plus the bookkeeping the pool needs"""
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.messages_sent = 0
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except Exception:
+            try:
+                self.smtp.close()
+            except Exception:
+                pass
+
+
+class SMTPConnectionPool:
+    """Keeps authenticated SMTP sessions for one account open across messages"""
+
+    def __init__(self, account, max_sessions=5, max_messages=100, max_idle=60, timeout=30):
+        self.account = account
+        self.max_sessions = max(1, int(max_sessions))
+        self.max_messages = max(1, int(max_messages))
+        self.max_idle = float(max_idle)
+        self.timeout = timeout
+        self._idle = []
+        self._open = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        """Open, secure and authenticate a new session"""
+        host = self.account['host']
+        port = int(self.account['port'])
+        if self.account.get('use_ssl', False):
+            server = SplicingSMTP_SSL(host, port, timeout=self.timeout)
+        else:
+            server = SplicingSMTP(host, port, timeout=self.timeout)
+            # Plain relays (e.g. a local MTA on port 25) may opt out of STARTTLS
+            if self.account.get('starttls', True):
+                server.starttls()
+        try:
+            # A message goes out in a few writes; don't hold the last one back waiting for an ACK
+            server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            server.login(self.account['username'], self.account['password'])
+        except Exception:
+            server.close()
+            raise
+        logger.debug(f"Opened SMTP session for {self.account['email']}")
+        return PooledSession(server)
+
+    def _is_retired(self, session):
+        if session.messages_sent >= self.max_messages:
+            return True
+        return time.monotonic() - session.last_used > self.max_idle
+
+    def _is_healthy(self, session):
+        """Check an idle session with NOOP before handing it out again"""
+        try:
+            code = session.smtp.noop()[0]
+        except (smtplib.SMTPException, OSError):
+            return False
+        return code == 250
+
+    def _prune_idle(self):
+        """Take idle sessions that outlived max_idle out of the pool (lock held)"""
+        now = time.monotonic()
+        expired = [s for s in self._idle if now - s.last_used > self.max_idle]
+        if expired:
+            self._idle = [s for s in self._idle if now - s.last_used <= self.max_idle]
+            self._open -= len(expired)
+            self._cond.notify(len(expired))
+        return expired
+
+    def acquire(self):
+        """Get a healthy session, opening one if the account is under its cap"""
+        while True:
+            with self._cond:
+                expired = self._prune_idle()
+                while True:
+                    if self._closed:
+                        raise smtplib.SMTPException("SMTP pool is closed")
+                    if self._idle:
+                        session = self._idle.pop()
+                        break
+                    if self._open < self.max_sessions:
+                        self._open += 1
+                        session = None
+                        break
+                    self._cond.wait()
+
+            for stale in expired:
+                stale.close()
+
+            if session is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._forget()
+                    raise
+
+            if not self._is_retired(session) and self._is_healthy(session):
+                return session
+
+            session.close()
+            self._forget()
+
+    def release(self, session, discard=False):
+        """Return a session to the pool, or close it if it is spent or broken"""
+        session.last_used = time.monotonic()
+        if discard or self._closed or session.messages_sent >= self.max_messages:
+            session.close()
+            self._forget()
+            return
+        with self._cond:
+            self._idle.append(session)
+            self._cond.notify()
+
+    def _forget(self):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def session(self):
+        session = self.acquire()
+        discard = False
+        try:
+            yield session
+        except smtplib.SMTPServerDisconnected:
+            discard = True
+            raise
+        except smtplib.SMTPException as e:
+            # Checked before OSError, which SMTPException derives from
+            if getattr(e, 'smtp_code', None) in SESSION_CLOSING_CODES:
+                discard = True
+            else:
+                # Clear the failed transaction so the session can be reused
+                try:
+                    session.smtp.rset()
+                except OSError:
+                    discard = True
+            raise
+        except OSError:
+            discard = True
+            raise
+        except Exception:
+            discard = True
+            raise
+        finally:
+            self.release(session, discard=discard)
+
+    def _run(self, send):
+        """Run a send on a pooled session, reconnecting once if it was dropped"""
+        try:
+            with self.session() as session:
+                result = send(session.smtp)
+                session.messages_sent += 1
+                return result
+        except smtplib.SMTPServerDisconnected:
+            logger.info(f"SMTP session for {self.account['email']} dropped, reconnecting")
+        with self.session() as session:
+            result = send(session.smtp)
+            session.messages_sent += 1
+            return result
+
+    def send_message(self, msg):
+        return self._run(lambda smtp: smtp.send_message(msg))
+
+    def sendmail(self, from_addr, to_addrs, data):
+        return self._run(lambda smtp: smtp.sendmail(from_addr, to_addrs, data))
+
+    def check(self):
+        """Make sure the account can connect and authenticate"""
+        with self.session():
+            pass
+
+    def warm(self, count):
+        """Open sessions until `count` (at most max_sessions) are idle and ready
+
+        Raises if the account can't connect or authenticate.
+        """
+        sessions = []
+        try:
+            for _ in range(max(1, min(count, self.max_sessions))):
+                sessions.append(self.acquire())
+        finally:
+            for session in sessions:
+                self.release(session)
+        return len(sessions)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for session in idle:
+            session.close()
+            self._forget()
+
+
+class SMTPPoolManager:
+    """Registry of connection pools keyed by account id"""
+
+    def __init__(self, **pool_options):
+        self.pool_options = pool_options
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fingerprint(account):
+        return (account['host'], str(account['port']), account['username'],
+                account['password'], bool(account.get('use_ssl', False)))
+
+    def get(self, account):
+        """Get the pool for an account, rebuilding it if its settings changed"""
+        fingerprint = self._fingerprint(account)
+        stale = None
+        with self._lock:
+            entry = self._pools.get(account['id'])
+            if entry and entry[0] == fingerprint:
+                return entry[1]
+            if entry:
+                stale = entry[1]
+            pool = SMTPConnectionPool(account, **self.pool_options)
+            self._pools[account['id']] = (fingerprint, pool)
+        if stale:
+            stale.close()
+        return pool
+
+    def discard(self, account_id):
+        with self._lock:
+            entry = self._pools.pop(account_id, None)
+        if entry:
+            entry[1].close()
+
+    def close_all(self):
+        with self._lock:
+            entries, self._pools = list(self._pools.values()), {}
+        for _, pool in entries:
+            pool.close()
@@ -0,0 +1,180 @@
+"""Global suppression list: addresses that must not be sent to again."""
+import contextlib
+import itertools
+import logging
+import math
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings, sized for `capacity` entries
+
+    Positions come from the string's own hash (cached on the string and
+    randomized per process), so a filter is only valid in the process that
+    built it.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1, int(capacity))
+        self.size = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def add(self, value):
+        # Double hashing: k positions from the two halves of one 64-bit hash
+        h = hash(value)
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) & 0xFFFFFFFF | 1
+        bits = self._bits
+        size = self.size
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % size
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        h = hash(value)
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) & 0xFFFFFFFF | 1
+        bits = self._bits
+        size = self.size
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class SuppressionList:
+    """Addresses never to be sent to, kept in SQLite and mirrored in a Bloom filter
+
+    Nearly every lookup is for an address that isn't suppressed, and the
+    filter answers those from memory at about 10 bits per entry; the few
+    that may be suppressed are confirmed with one primary-key lookup. A
+    removed address stays set in the filter and only costs that lookup
+    until the filter is rebuilt, which happens whenever the list outgrows
+    it. The first filter is built on a background thread; until it is ready
+    every lookup goes to the database. Addresses are expected in normalized
+    form.
+    """
+
+    def __init__(self, path, error_rate=0.01, min_capacity=100000, batch_size=5000):
+        self.path = path
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        with self._write() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS suppressed ('
+                         'email TEXT PRIMARY KEY, reason TEXT, added_at REAL) WITHOUT ROWID')
+        self._count = self._conn.execute('SELECT COUNT(*) FROM suppressed').fetchone()[0]
+        self._bloom = None
+        self.ready = threading.Event()
+        thread = threading.Thread(target=self._build)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _write(self):
+        """A write transaction; committed on success, rolled back on error"""
+        with self._write_lock:
+            conn = self._conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _build(self):
+        try:
+            # Writers wait for the filter so none of their additions are missed
+            with self._write_lock:
+                self._rebuild()
+        except Exception as e:
+            logger.error(f"Error building suppression filter: {e}")
+        finally:
+            self.ready.set()
+
+    def _rebuild(self):
+        """Build a filter with room for twice the current list (write lock held)"""
+        started = time.monotonic()
+        bloom = BloomFilter(max(self.min_capacity, self._count * 2), self.error_rate)
+        for (email,) in self._conn.execute('SELECT email FROM suppressed'):
+            bloom.add(email)
+        self._bloom = bloom
+        logger.info(f"Suppression filter built for {self._count} addresses in {time.monotonic() - started:.1f}s")
+
+    def __contains__(self, email):
+        bloom = self._bloom
+        if bloom is not None and email not in bloom:
+            return False
+        return self._conn.execute('SELECT 1 FROM suppressed WHERE email = ?', (email,)).fetchone() is not None
+
+    def __len__(self):
+        return self._count
+
+    def add(self, emails, reason='manual'):
+        """Suppress addresses; returns how many weren't suppressed already"""
+        added = 0
+        emails = iter(emails)
+        with self._write() as conn:
+            bloom = self._bloom
+            while True:
+                batch = list(itertools.islice(emails, self.batch_size))
+                if not batch:
+                    break
+                now = time.time()
+                before = conn.total_changes
+                conn.executemany('INSERT OR IGNORE INTO suppressed (email, reason, added_at) VALUES (?, ?, ?)',
+                                 [(email, reason, now) for email in batch])
+                added += conn.total_changes - before
+                if bloom is not None:
+                    for email in batch:
+                        bloom.add(email)
+            self._count += added
+            if bloom is not None and self._count > bloom.capacity:
+                # Past its capacity the filter lets more lookups through to the database
+                self._rebuild()
+        return added
+
+    def remove(self, emails):
+        """Stop suppressing addresses; returns how many were suppressed"""
+        removed = 0
+        emails = iter(emails)
+        with self._write() as conn:
+            while True:
+                batch = list(itertools.islice(emails, self.batch_size))
+                if not batch:
+                    break
+                before = conn.total_changes
+                conn.executemany('DELETE FROM suppressed WHERE email = ?', [(email,) for email in batch])
+                removed += conn.total_changes - before
+            self._count -= removed
+        return removed
+
+    def entries(self, batch_size=1000):
+        """Lazily yield (email, reason, added_at) in address order, in short queries"""
+        after = ''
+        while True:
+            rows = self._conn.execute('SELECT email, reason, added_at FROM suppressed WHERE email > ? '
+                                      'ORDER BY email LIMIT ?', (after, batch_size)).fetchall()
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
@@ -0,0 +1,175 @@
+"""Email templates compiled once into segment plans and rendered per contact.
+
+Placeholders use the same brackets as [NAME] and may name any contacts.csv
+column (case-insensitive, spaces as underscores):
+
+    [first_name]               the column value
+    [company|your company]     a default for a missing or empty value
+    [IF company]...[ELSE]...[ENDIF]   kept when the value is non-empty
+    [IF NOT company]...[ENDIF]
+
+A placeholder naming a column the contact doesn't have is left as written,
+so brackets that were never meant as placeholders still come out unchanged.
+Subjects are rendered the same way as bodies.
+"""
+import re
+import threading
+
+TOKEN = re.compile(r'\[(?:(IF(?: NOT)?) +([^\]|]+)|(ELSE|ENDIF)|([A-Za-z_][\w ]*?)(?:\|([^\]]*))?)\]')
+
+
+class TemplateError(ValueError):
+    """Raised for a template whose conditionals don't balance"""
+
+
+def field_key(column):
+    """Normalized lookup key for a column name or placeholder"""
+    return column.strip().lower().replace(' ', '_')
+
+
+def compile_text(text):
+    """Segment plan for one string
+
+    A plan is a list of literal strings, (key, default, raw) placeholders and
+    (key, negate, then_plan, else_plan) conditionals.
+    """
+    root = []
+    stack = []  # (plan being built, conditional it belongs to)
+    plan = root
+    position = 0
+    for match in TOKEN.finditer(text):
+        if match.start() > position:
+            plan.append(text[position:match.start()])
+        position = match.end()
+        condition, condition_key, keyword, key, default = match.groups()
+        if condition:
+            conditional = (field_key(condition_key), condition == 'IF NOT', [], [])
+            plan.append(conditional)
+            stack.append((plan, conditional))
+            plan = conditional[2]
+        elif keyword == 'ELSE':
+            if not stack or plan is not stack[-1][1][2]:
+                raise TemplateError("[ELSE] without a matching [IF ...]")
+            plan = stack[-1][1][3]
+        elif keyword == 'ENDIF':
+            if not stack:
+                raise TemplateError("[ENDIF] without a matching [IF ...]")
+            plan = stack.pop()[0]
+        else:
+            plan.append((field_key(key), default, match.group(0)))
+    if stack:
+        raise TemplateError("[IF ...] without a matching [ENDIF]")
+    if position < len(text):
+        plan.append(text[position:])
+    return _merge_literals(root)
+
+
+def _merge_literals(plan):
+    merged = []
+    for segment in plan:
+        if segment.__class__ is str and merged and merged[-1].__class__ is str:
+            merged[-1] += segment
+        else:
+            merged.append(segment)
+    return merged
+
+
+def field_text(fields, key):
+    """A contact's value as text; None for a column the contact doesn't have
+
+    Contacts stored before values were kept as text may hold null or numbers.
+    """
+    value = fields.get(key)
+    if value.__class__ is str:
+        return value
+    if value is None:
+        return '' if key in fields else None
+    return str(value)
+
+
+def render_plan(plan, fields, out):
+    """Append the rendered pieces of a plan to `out`"""
+    for segment in plan:
+        if segment.__class__ is str:
+            out.append(segment)
+        elif len(segment) == 3:
+            key, default, raw = segment
+            value = field_text(fields, key)
+            if value:
+                out.append(value)
+            elif default is not None:
+                out.append(default)
+            elif value is None:
+                out.append(raw)
+        else:
+            key, negate, then_plan, else_plan = segment
+            value = field_text(fields, key)
+            if bool(value and value.strip()) != negate:
+                render_plan(then_plan, fields, out)
+            else:
+                render_plan(else_plan, fields, out)
+
+
+def _renderer(plan):
+    """Fastest render function for a plan"""
+    if all(segment.__class__ is str for segment in plan):
+        text = ''.join(plan)
+        return lambda fields: text
+
+    def render(fields):
+        out = []
+        render_plan(plan, fields, out)
+        return ''.join(out)
+    return render
+
+
+class CompiledTemplate:
+    """Subject and body of one template, compiled"""
+
+    __slots__ = ('template_id', 'render_subject', 'render_content')
+
+    def __init__(self, template):
+        self.template_id = template.get('id')
+        self.render_subject = _renderer(compile_text(template.get('subject', '')))
+        self.render_content = _renderer(compile_text(template.get('content', '')))
+
+    def render(self, fields):
+        """(subject, body) for one contact's fields"""
+        return self.render_subject(fields), self.render_content(fields)
+
+    def render_batch(self, contacts_fields):
+        """(subject, body) for each contact in one call"""
+        render_subject, render_content = self.render_subject, self.render_content
+        return [(render_subject(fields), render_content(fields)) for fields in contacts_fields]
+
+
+class TemplateCache:
+    """Compiled templates by id, built on first use
+
+    `lookup(template_id)` returns the template dict to use for an id (with
+    any fallback applied). Call invalidate() whenever templates change.
+    """
+
+    def __init__(self, lookup):
+        self.lookup = lookup
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    def get(self, template_id):
+        """The compiled template for an id, or None if there is no template"""
+        compiled_templates = self._compiled
+        compiled = compiled_templates.get(template_id)
+        if compiled is not None:
+            return compiled
+        template = self.lookup(template_id)
+        if not template:
+            return None
+        compiled = CompiledTemplate(template)
+        with self._lock:
+            # If templates were saved meanwhile this lands in the discarded dict
+            compiled_templates[template_id] = compiled
+        return compiled
+
+    def invalidate(self):
+        with self._lock:
+            self._compiled = {}
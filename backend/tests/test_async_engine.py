@@ -0,0 +1,133 @@
+import asyncio
+import smtplib
+import threading
+import time
+import types
+
+import pytest
+
+from account_scheduler import AccountScheduler
+from async_engine import AsyncCampaignRunner, AsyncSMTPPool
+from rate_limit import AccountRateLimiter
+
+
+class StrictSink:
+    """SMTP server that rejects the first DATA and refuses MAIL inside an open transaction"""
+
+    def __init__(self):
+        self.connections = 0
+        self.delivered = []
+        self.rejected_data = False
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        writer.write(b'220 sink\r\n')
+        in_transaction = False
+        recipient = None
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line[:4].upper()
+            if command == b'EHLO':
+                writer.write(b'250-sink\r\n250 AUTH PLAIN\r\n')
+            elif command == b'AUTH':
+                writer.write(b'235 ok\r\n')
+            elif command == b'MAIL':
+                if in_transaction:
+                    writer.write(b'503 nested MAIL\r\n')
+                else:
+                    in_transaction = True
+                    writer.write(b'250 ok\r\n')
+            elif command == b'RCPT':
+                recipient = line.split(b'<')[1].split(b'>')[0].decode()
+                writer.write(b'250 ok\r\n')
+            elif command == b'DATA':
+                if not self.rejected_data:
+                    self.rejected_data = True
+                    writer.write(b'554 no thanks\r\n')
+                else:
+                    writer.write(b'354 go\r\n')
+                    await writer.drain()
+                    while await reader.readline() != b'.\r\n':
+                        pass
+                    in_transaction = False
+                    self.delivered.append(recipient)
+                    writer.write(b'250 ok\r\n')
+            elif command == b'RSET':
+                in_transaction = False
+                writer.write(b'250 ok\r\n')
+            elif command == b'QUIT':
+                writer.write(b'221 bye\r\n')
+                await writer.drain()
+                break
+            else:
+                writer.write(b'250 ok\r\n')
+            await writer.drain()
+        writer.close()
+
+
+def test_rejected_data_leaves_session_usable():
+    async def run():
+        sink = StrictSink()
+        server = await asyncio.start_server(sink.handle, '127.0.0.1', 0)
+        account = {'email': 'me@example.com', 'host': '127.0.0.1', 'port': server.sockets[0].getsockname()[1],
+                   'starttls': False, 'username': 'me@example.com', 'password': 'secret'}
+        pool = AsyncSMTPPool(account, max_sessions=1, timeout=5)
+        with pytest.raises(smtplib.SMTPDataError) as rejected:
+            await pool.sendmail('me@example.com', 'first@example.com', b'Subject: 1\r\n\r\nbody\r\n')
+        assert rejected.value.smtp_code == 554
+        await pool.sendmail('me@example.com', 'second@example.com', b'Subject: 2\r\n\r\nbody\r\n')
+        await pool.close()
+        server.close()
+        await server.wait_closed()
+        return sink
+
+    sink = asyncio.run(run())
+    assert sink.delivered == ['second@example.com']
+    assert sink.connections == 1
+
+
+class CountingScheduler(AccountScheduler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.attempts = 0
+
+    def try_acquire(self, avoid=None):
+        self.attempts += 1
+        return super().try_acquire(avoid)
+
+
+def waiting_acquire(scheduler, free):
+    """Acquire once to use up the account, then wait for a second send while `free` runs on another thread"""
+    runner = AsyncCampaignRunner(types.SimpleNamespace(account_scheduler=scheduler), 1)
+
+    async def run():
+        with runner._watch_capacity():
+            first = await runner._acquire_account(None)
+            scheduler.attempts = 0
+            threading.Timer(0.3, free, args=(first,)).start()
+            started = time.monotonic()
+            await runner._acquire_account(None)
+            return time.monotonic() - started
+
+    return asyncio.run(run())
+
+
+def test_waiting_sender_wakes_when_a_send_is_released():
+    account = {'id': 'a', 'email': 'a@example.com'}
+    scheduler = CountingScheduler([account], AccountRateLimiter(), max_concurrency=1, initial_concurrency=1)
+    waited = waiting_acquire(scheduler, lambda first: scheduler.release(first, success=True))
+    assert 0.25 < waited < 0.6
+    # Woken by the release rather than polling for it
+    assert scheduler.attempts <= 3
+
+
+def test_waiting_sender_wakes_when_the_rate_limit_is_raised():
+    account = {'id': 'a', 'email': 'a@example.com'}
+    rate_limiter = AccountRateLimiter()
+    rate_limiter.set_limit('a', 1 / 3600)
+    scheduler = CountingScheduler([account], rate_limiter, max_concurrency=5)
+    waited = waiting_acquire(scheduler, lambda first: rate_limiter.set_limit('a', 1000))
+    assert 0.25 < waited < 0.6
+    assert scheduler.attempts <= 4
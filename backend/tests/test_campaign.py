@@ -0,0 +1,100 @@
+import queue
+import threading
+import time
+from concurrent import futures
+
+from account_scheduler import AccountScheduler
+from attachments import AttachmentSnapshot
+from campaign import DOMAIN_DEFER_DELAY, Campaign
+from rate_limit import AccountRateLimiter
+from domain_scheduler import DomainScheduler
+
+
+class NoContacts:
+    done = threading.Event()
+
+    def get_nowait(self):
+        raise queue.Empty
+
+    def get(self, timeout):
+        return None
+
+    def exhausted(self):
+        return True
+
+
+def make_campaign(concurrency):
+    domains = DomainScheduler(NoContacts(), concurrency=concurrency)
+    campaign = Campaign(domains, None, AttachmentSnapshot(), None, 0, {'total': 0, 'remaining': 0}, threading.Lock(), {}, {},
+                        domains=domains)
+    return campaign, domains
+
+
+def test_retries_wait_for_their_domain_cap():
+    campaign, domains = make_campaign(concurrency=1)
+    campaign.requeue([('a@example.com', {}, 't'), ('b@example.com', {}, 't'), ('c@other.com', {}, 't')])
+
+    first = campaign.take_job()
+    assert first[0] == 'a@example.com'
+    # example.com is at its cap, so its retry is deferred and the other domain goes first
+    second = campaign.take_job()
+    assert second[0] == 'c@other.com'
+    assert campaign.take_job() is None
+    assert not campaign.is_drained()
+
+    domains.release(first[0])
+    time.sleep(DOMAIN_DEFER_DELAY)
+    assert campaign.take_job()[0] == 'b@example.com'
+
+
+def test_retries_count_against_domain_cap():
+    campaign, domains = make_campaign(concurrency=2)
+    campaign.requeue([('a@example.com', {}, 't'), ('b@example.com', {}, 't')])
+    assert campaign.take_job()[0] == 'a@example.com'
+    assert campaign.take_job()[0] == 'b@example.com'
+    assert domains.try_start('c@example.com') is False
+
+
+class HeldBatches:
+    """Batch sender whose batches go out only when the test says so"""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, account, encoded_message):
+        future = futures.Future()
+        self.submitted.append(future)
+        return future
+
+
+class Template:
+    template_id = 't'
+
+    def render(self, fields):
+        return 'Hello', 'Body'
+
+
+def test_batched_gmail_sends_dont_hold_the_worker():
+    account = {'id': 'g', 'type': 'gmail', 'email': 'me@gmail.com'}
+    scheduler = AccountScheduler([account], AccountRateLimiter(), max_concurrency=10, initial_concurrency=10)
+    batcher = HeldBatches()
+    status = {'total': 0, 'remaining': 0, 'errors': []}
+    campaign = Campaign(NoContacts(), lambda template_id: Template(), AttachmentSnapshot(), scheduler, 0,
+                        status, threading.Lock(), {}, None, gmail_batcher=batcher)
+    campaign.requeue([(f'user{n}@example.com', {}, 't') for n in range(3)])
+
+    # One worker queues every message without waiting for a batch to go out
+    for _ in range(3):
+        campaign.process(campaign.take_job())
+    assert len(batcher.submitted) == 3
+    assert campaign.in_flight == 3
+    assert not campaign.is_drained()
+
+    batcher.submitted[0].set_result({'id': '1'})
+    batcher.submitted[1].set_exception(RuntimeError('Invalid To header'))
+    batcher.submitted[2].set_result({'id': '3'})
+    assert campaign.in_flight == 0
+    assert status['remaining'] == 0
+    assert len(status['errors']) == 1
+    assert [state['sent'] for state in scheduler.stats()] == [2]
+    assert campaign.is_drained()
@@ -0,0 +1,36 @@
+from contact_import import ContactImport, HashIndex
+
+
+class CollidingIndex(HashIndex):
+    """Every string hashes alike, as two addresses occasionally do"""
+
+    @staticmethod
+    def _hash(value):
+        return 42
+
+
+def test_hash_index_tells_colliding_strings_apart():
+    index = CollidingIndex(capacity=4)
+    addresses = [f'user{n}@example.com' for n in range(20)]
+    assert all(index.add(address) for address in addresses)
+    assert not any(index.add(address) for address in addresses)
+    # A prefix of a stored string is a different string
+    assert index.add('user1@example.co')
+    assert len(index) == 21
+
+
+def test_hash_index_survives_growth():
+    index = HashIndex(capacity=8)
+    addresses = [f'user{n}@example.com' for n in range(1000)]
+    assert all(index.add(address) for address in addresses)
+    assert not any(index.add(address) for address in addresses)
+    assert len(index) == 1000
+
+
+def test_colliding_address_is_not_dropped_as_duplicate():
+    contact_import = ContactImport()
+    contact_import._seen = CollidingIndex()
+    rows = [(email, '', 't', None) for email in ('a@example.com', 'b@example.com', ' A@Example.com ')]
+    accepted = [row[0] for row in contact_import.filter(rows)]
+    assert accepted == ['a@example.com', 'b@example.com']
+    assert contact_import.counts()['duplicates'] == 1
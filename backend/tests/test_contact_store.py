@@ -0,0 +1,57 @@
+import threading
+
+import pytest
+
+from contact_store import ContactStore
+
+
+def make_store(tmp_path, count):
+    store = ContactStore(str(tmp_path / 'contacts.db'))
+    store.replace((f'user{i}@example.com', f'User {i}', 'default', {}) for i in range(count))
+    return store
+
+
+def test_campaign_contacts_continue_on_another_thread(tmp_path):
+    # start_campaign reads the first contact on the request thread; the producer thread reads the rest
+    store = make_store(tmp_path, 2500)
+    rows = store.campaign_contacts()
+    first = next(rows)
+    rest = []
+    errors = []
+
+    def consume():
+        try:
+            rest.extend(rows)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=consume)
+    thread.start()
+    thread.join()
+    assert not errors
+    assert first[0] == 'user0@example.com'
+    assert len(rest) == 2499
+    assert rest[-1][0] == 'user2499@example.com'
+
+
+def test_iter_rows_pages_across_batches(tmp_path):
+    store = make_store(tmp_path, 25)
+    ids = [row[0] for row in store.iter_rows(batch_size=4)]
+    assert ids == list(range(1, 26))
+    assert [row[0] for row in store.iter_rows(batch_size=4, after_id=5, offset=2, limit=7)] == list(range(8, 15))
+
+
+def test_field_values_are_stored_as_text(tmp_path):
+    store = make_store(tmp_path, 0)
+    contact_id, = store.add([('a@example.com', None, 'default', {'company': None, 'seats': 12, 'vip': True})])
+    assert store.get(contact_id)['fields'] == {'company': '', 'seats': '12', 'vip': 'True'}
+    store.update(contact_id, {'name': 7, 'fields': {'seats': 0}})
+    contact = store.get(contact_id)
+    assert contact['name'] == '7'
+    assert contact['fields'] == {'seats': '0'}
+
+
+def test_fields_must_be_an_object(tmp_path):
+    store = make_store(tmp_path, 0)
+    with pytest.raises(ValueError):
+        store.add([('a@example.com', '', 'default', ['acme'])])
@@ -0,0 +1,183 @@
+import base64
+import email
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('googleapiclient.discovery')
+httplib2 = pytest.importorskip('httplib2')
+
+from googleapiclient.discovery import build  # noqa: E402
+from googleapiclient.errors import HttpError  # noqa: E402
+
+from gmail_service import GmailBatchSender, GmailServiceCache  # noqa: E402
+
+
+class FakeCredentials:
+    valid = True
+    refresh_token = None
+
+    def __init__(self, token):
+        self.token = token
+
+
+class FakeBuild:
+    """Stands in for discovery: records every client built and checks clients aren't shared"""
+
+    def __init__(self):
+        self.built = []
+        self.lock = threading.Lock()
+
+    def __call__(self, credentials):
+        client = {'credentials': credentials, 'in_use': threading.Lock()}
+        with self.lock:
+            self.built.append(client)
+        return client
+
+
+def use(cache, account, credentials=None):
+    with cache.service(account, credentials) as client:
+        # A client is never checked out by two threads at once
+        assert client['in_use'].acquire(blocking=False)
+        client['in_use'].release()
+        return client
+
+
+def test_one_build_per_account_across_threads():
+    build = FakeBuild()
+    cache = GmailServiceCache(build)
+    accounts = [{'id': account_id} for account_id in ('a', 'b')]
+    credentials = {account['id']: FakeCredentials(account['id']) for account in accounts}
+
+    # Threads taking turns share the one client of each account
+    for _ in range(20):
+        for account in accounts:
+            thread = threading.Thread(target=use, args=(cache, account, credentials[account['id']]))
+            thread.start()
+            thread.join()
+    assert len(build.built) == 2
+    assert cache.stats()['builds'] == 2
+    assert cache.stats()['reuses'] == 38
+
+
+def test_concurrent_threads_build_only_for_overlapping_sends():
+    build = FakeBuild()
+    cache = GmailServiceCache(build)
+    account = {'id': 'a'}
+    credentials = FakeCredentials('a')
+    threads = [threading.Thread(target=lambda: [use(cache, account, credentials) for _ in range(50)])
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    # At most one client per thread sending at the same time, reused for everything else
+    assert 1 <= stats['builds'] <= 8
+    assert stats['builds'] + stats['reuses'] == 400
+    assert stats['idleClients'] == stats['builds']
+
+
+def test_client_rebuilt_after_credentials_change():
+    build = FakeBuild()
+    cache = GmailServiceCache(build)
+    account = {'id': 'a'}
+    old, new = FakeCredentials('old'), FakeCredentials('new')
+    first = use(cache, account, old)
+    assert use(cache, account, old) is first
+    # Re-authorizing the account invalidates its cached clients
+    cache.invalidate('a')
+    rebuilt = use(cache, account, new)
+    assert rebuilt is not first
+    assert rebuilt['credentials'] is new
+    assert use(cache, account, new) is rebuilt
+    assert cache.stats()['builds'] == 2
+
+
+class FakeBatchEndpoint(BaseHTTPRequestHandler):
+    """Gmail's multipart batch endpoint: rejects messages whose body says "reject", sends the rest"""
+
+    batches = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        request = email.message_from_bytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+        boundary = 'fake-batch-response'
+        parts = []
+        for part in request.get_payload():
+            # Each part is a serialized HTTP request whose JSON body is its last line
+            payload = json.loads(part.get_payload().strip().splitlines()[-1])
+            message = base64.urlsafe_b64decode(payload['raw'])
+            if b'reject' in message:
+                status, reply = '400 Bad Request', {'error': {'code': 400, 'message': 'Invalid To header'}}
+            else:
+                status, reply = '200 OK', {'id': f'sent-{len(parts)}', 'labelIds': ['SENT']}
+            content_id = part['Content-ID'][1:-1]
+            parts.append(f'--{boundary}\r\nContent-Type: application/http\r\n'
+                         f'Content-ID: <response-{content_id}>\r\n\r\n'
+                         f'HTTP/1.1 {status}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n'
+                         f'{json.dumps(reply)}\r\n')
+        self.batches.append(len(parts))
+        response = (''.join(parts) + f'--{boundary}--\r\n').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/mixed; boundary={boundary}')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def batch_endpoint():
+    FakeBatchEndpoint.batches = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBatchEndpoint)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/batch/gmail/v1'
+    server.shutdown()
+
+
+def batch_sender(batch_uri, **options):
+    cache = GmailServiceCache(lambda credentials: build('gmail', 'v1', http=httplib2.Http(), static_discovery=True))
+    account = {'id': 'a', 'email': 'me@example.com'}
+    cache.credentials(account, FakeCredentials('a'))
+    return GmailBatchSender(cache, batch_uri=batch_uri, **options), account, cache
+
+
+def encoded(text):
+    return base64.urlsafe_b64encode(f'To: x@example.com\r\n\r\n{text}'.encode()).decode()
+
+
+def test_queued_messages_go_out_together_with_their_own_results(batch_endpoint):
+    sender, account, cache = batch_sender(batch_endpoint, max_batch=50, linger=0.2)
+    texts = [f'reject {n}' if n % 7 == 3 else f'hello {n}' for n in range(30)]
+    # Submitted from one thread: nothing waits for a batch to go out
+    results = [sender.submit(account, encoded(text)) for text in texts]
+    for text, future in zip(texts, results):
+        if text.startswith('reject'):
+            assert isinstance(future.exception(timeout=5), HttpError)
+            assert future.exception().resp.status == 400
+        else:
+            assert future.result(timeout=5)['labelIds'] == ['SENT']
+    assert FakeBatchEndpoint.batches == [30]
+    assert cache.stats()['builds'] == 1
+
+
+def test_batches_hold_at_most_max_batch(batch_endpoint):
+    sender, account, _ = batch_sender(batch_endpoint, max_batch=10, linger=0.2)
+    results = [sender.submit(account, encoded(f'hello {n}')) for n in range(25)]
+    assert all(future.result(timeout=5) for future in results)
+    assert FakeBatchEndpoint.batches == [10, 10, 5]
+    assert sender.batches == 3
+
+
+def test_idle_dispatcher_exits_and_restarts(batch_endpoint):
+    sender, account, _ = batch_sender(batch_endpoint, max_batch=10, linger=0, idle_timeout=0.05)
+    assert sender.submit(account, encoded('first')).result(timeout=5)
+    while sender._queues:
+        threading.Event().wait(0.01)
+    assert sender.submit(account, encoded('second')).result(timeout=5)
+    assert FakeBatchEndpoint.batches == [1, 1]
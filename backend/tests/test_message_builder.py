@@ -0,0 +1,104 @@
+import base64
+import email
+import itertools
+import smtplib
+from email.header import decode_header, make_header
+
+import pytest
+
+from attachments import AttachmentSnapshot, EncodedAttachment
+from message_builder import POLICY, MessageBuilder, compose_message, quote_data
+from smtp_pool import SplicingSMTP
+
+SUBJECTS = ['Hello', 'Héllo wörld 😀', 'x' * 200, 'Re: ' + 'long words ' * 15, '']
+BODIES = ['Hi Bob,\n\nthanks.', 'Line\r\nCRLF\rCR\nLF\n', 'Ünïcode body ✓\n' * 30, '',
+          '.leading dot\n.\n..two\n', 'a' * 2000]
+SENDERS = [None, 'me@example.com']
+
+
+def encoded_attachment(filename, data, mime_type='application/octet-stream'):
+    return EncodedAttachment(filename, memoryview(base64.encodebytes(data).replace(b'\n', b'\r\n')), len(data),
+                             mime_type)
+
+
+ATTACHMENT_SETS = [
+    (),
+    (encoded_attachment('a.pdf', bytes(range(256)) * 20, 'application/pdf'),),
+    (encoded_attachment('r.txt', b'hello\n' * 100, 'text/plain'),
+     encoded_attachment('naïve file.bin', b'\x00.\r\n' * 19)),
+]
+
+
+def parsed(raw):
+    """Headers and decoded parts of a serialized message"""
+    message = email.message_from_bytes(raw)
+    headers = {name: str(make_header(decode_header(message[name]))) if message[name] else None
+               for name in ('From', 'To', 'Subject')}
+    parts = []
+    for part in message.walk():
+        if part.is_multipart():
+            continue
+        payload = part.get_payload(decode=True)
+        if part.get_content_maintype() == 'text' and not part.get_filename():
+            payload = payload.decode(part.get_content_charset()).replace('\r\n', '\n')
+        parts.append((part.get_content_type(), part.get_filename(), payload))
+    return headers, parts, message.defects
+
+
+@pytest.mark.parametrize('subject,body,attachments,sender',
+                         list(itertools.product(SUBJECTS, BODIES, ATTACHMENT_SETS, SENDERS)))
+def test_build_matches_email_package(subject, body, attachments, sender):
+    snapshot = AttachmentSnapshot({'t': attachments})
+    wire = MessageBuilder(snapshot).build('to@example.com', subject, body, sender, 't')
+    raw = bytes(wire)
+    reference = compose_message('to@example.com', subject, body, snapshot, sender, 't').as_bytes(policy=POLICY)
+
+    assert b'\n' not in raw.replace(b'\r\n', b''), 'bare line ending'
+    headers, parts, defects = parsed(raw)
+    reference_headers, reference_parts, _ = parsed(reference)
+    assert headers == reference_headers
+    assert parts == reference_parts
+    assert not defects
+    # Segments go into DATA as they are
+    assert quote_data(raw) == quote_data(wire.head) + b''.join(wire.segments)
+
+
+def test_body_containing_the_boundary_gets_another_one():
+    snapshot = AttachmentSnapshot(default=ATTACHMENT_SETS[1])
+    builder = MessageBuilder(snapshot)
+    body = f'oops --{builder.boundary} inside'
+    headers, parts, defects = parsed(bytes(builder.build('to@example.com', 's', body)))
+    assert parts[0][2] == body
+    assert parts[1][1] == 'a.pdf'
+    assert not defects
+
+
+class RecordingSMTP(SplicingSMTP):
+    """An unconnected session that records what DATA writes to the socket"""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+        self.replies = iter([(354, b'go'), (250, b'ok')])
+
+    def putcmd(self, cmd, args=''):
+        pass
+
+    def getreply(self):
+        return next(self.replies)
+
+    def send(self, s):
+        self.sent.append(bytes(s))
+
+
+@pytest.mark.parametrize('body', ['.leading dot\n.\n..two\nend', 'no final newline', '.'])
+def test_spliced_data_is_dot_stuffed_like_smtplib(body):
+    snapshot = AttachmentSnapshot({'t': ATTACHMENT_SETS[2]})
+    wire = MessageBuilder(snapshot).build('to@example.com', 'Dots', body, 'me@example.com', 't')
+    spliced = RecordingSMTP()
+    stock = RecordingSMTP()
+    assert spliced.data(wire) == (250, b'ok')
+    smtplib.SMTP.data(stock, bytes(wire))
+    assert b''.join(spliced.sent) == b''.join(stock.sent)
+    assert b'\r\n.leading dot\r\n' not in b''.join(spliced.sent)
+    assert b''.join(spliced.sent).endswith(b'\r\n.\r\n')
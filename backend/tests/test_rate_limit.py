@@ -0,0 +1,43 @@
+from account_scheduler import AccountScheduler
+from rate_limit import AccountRateLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_campaigns_on_one_account_share_its_tokens():
+    limiter = AccountRateLimiter()
+    account = {'id': 'a', 'email': 'a@example.com', 'type': 'smtp'}
+    limiter.set_limit('a', 1.0, burst=2)
+    first = AccountScheduler([account], limiter, max_concurrency=10, initial_concurrency=10)
+    assert first.try_acquire()[0] is account
+    # A second campaign starting on the account doesn't get a fresh bucket
+    limiter.set_limit('a', 1.0, burst=2)
+    second = AccountScheduler([account], limiter, max_concurrency=10, initial_concurrency=10)
+    assert second.try_acquire()[0] is account
+    assert first.try_acquire()[0] is None
+    assert second.try_acquire()[0] is None
+
+
+def test_limit_is_the_configured_rate_while_backing_off():
+    limiter = AccountRateLimiter()
+    limiter.set_limit('a', 10.0)
+    limiter.set_rate('a', 2.5)
+    assert limiter.limit('a') == 10.0
+    limiter.set_limit('a', None)
+    assert limiter.limit('a') is None
+    assert limiter.try_acquire('a') == 0.0
+
+
+def test_bucket_refills_at_its_rate():
+    clock = Clock()
+    bucket = TokenBucket(2.0, burst=1, clock=clock)
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == 0.5
+    clock.now = 0.5
+    assert bucket.try_acquire() == 0.0
@@ -0,0 +1,77 @@
+import os
+import queue
+
+import render_pool
+from attachments import AttachmentSnapshot
+from render_pool import RenderStage
+
+
+class ListContacts:
+    """Contact source handing out a fixed list, like a ContactProducer"""
+
+    def __init__(self, contacts):
+        self.items = queue.Queue()
+        for contact in contacts:
+            self.items.put(contact)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get(self, timeout):
+        try:
+            return self.items.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def exhausted(self):
+        return self.items.empty()
+
+
+def die(contacts):
+    os._exit(1)
+
+
+def make_stage(contacts):
+    templates = {'t': {'id': 't', 'subject': 'Hi', 'content': 'Hello [name]'}}
+    return RenderStage(ListContacts(contacts), templates, templates['t'], AttachmentSnapshot(), processes=1,
+                       batch_size=5, max_pending=2)
+
+
+def handed_out(stage):
+    thread = stage.start()
+    thread.join(timeout=30)
+    assert stage.done.is_set()
+    items = []
+    while not stage.exhausted():
+        items.append(stage.get_nowait())
+    return items
+
+
+def test_contacts_pass_through_after_worker_dies(monkeypatch):
+    monkeypatch.setattr(render_pool, 'render_batch', die)
+    contacts = [(f'user{i}@example.com', {'name': str(i)}, 't') for i in range(40)]
+    # Unrendered contacts, for the senders to render inline
+    assert sorted(handed_out(make_stage(contacts))) == sorted(contacts)
+
+
+def test_contacts_pass_through_after_an_unexpected_error():
+    contacts = [(f'user{i}@example.com', {'name': str(i)}, 't') for i in range(40)]
+    stage = make_stage(contacts)
+    collect = stage._collect
+    calls = []
+
+    def fail_once(batch, future):
+        calls.append(batch)
+        if len(calls) == 2:
+            raise RuntimeError('boom')
+        collect(batch, future)
+
+    stage._collect = fail_once
+    items = handed_out(stage)
+    # Every contact exactly once, rendered or not
+    assert sorted(item[:3] for item in items) == sorted(contacts)
+    assert any(len(item) == 4 for item in items)
+    assert any(len(item) == 3 for item in items)
@@ -0,0 +1,61 @@
+import smtplib
+
+import pytest
+
+from smtp_pool import SMTPConnectionPool
+
+
+class FakeSMTP:
+    def __init__(self):
+        self.resets = 0
+        self.closed = False
+
+    def rset(self):
+        self.resets += 1
+
+    def noop(self):
+        return 250, b'ok'
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(SMTPConnectionPool):
+    def __init__(self):
+        super().__init__({'email': 'sender@example.com'})
+        self.opened = []
+
+    def _connect(self):
+        from smtp_pool import PooledSession
+        smtp = FakeSMTP()
+        self.opened.append(smtp)
+        return PooledSession(smtp)
+
+
+def fail(pool, error):
+    with pytest.raises(type(error)):
+        with pool.session():
+            raise error
+
+
+def test_refused_recipient_resets_and_keeps_session():
+    pool = FakePool()
+    fail(pool, smtplib.SMTPRecipientsRefused({'to@example.com': (550, b'no such user')}))
+    fail(pool, smtplib.SMTPDataError(451, b'try later'))
+    with pool.session():
+        pass
+    assert len(pool.opened) == 1
+    assert pool.opened[0].resets == 2
+    assert not pool.opened[0].closed
+
+
+def test_closing_reply_and_disconnect_discard_session():
+    pool = FakePool()
+    fail(pool, smtplib.SMTPDataError(421, b'closing'))
+    fail(pool, smtplib.SMTPServerDisconnected('gone'))
+    fail(pool, ConnectionResetError())
+    assert len(pool.opened) == 3
+    assert all(smtp.closed for smtp in pool.opened)
@@ -0,0 +1,17 @@
+from templating import CompiledTemplate
+
+
+def render(content, fields):
+    return CompiledTemplate({'id': 't', 'subject': '', 'content': content}).render(fields)[1]
+
+
+def test_placeholders_and_conditionals():
+    content = 'Hi [name|there], [IF company]from [company][ELSE]no company[ENDIF] [missing]'
+    assert render(content, {'name': 'Ann', 'company': 'Acme'}) == 'Hi Ann, from Acme [missing]'
+    assert render(content, {'name': '', 'company': '  '}) == 'Hi there, no company [missing]'
+
+
+def test_null_and_number_values():
+    content = '[IF company]at [company][ELSE]-[ENDIF] [seats] [IF NOT vip]regular[ENDIF] [company|none]'
+    assert render(content, {'company': None, 'seats': 12, 'vip': None}) == '- 12 regular none'
+    assert render(content, {'company': 0, 'seats': 0.5, 'vip': False}) == 'at 0 0.5  0'
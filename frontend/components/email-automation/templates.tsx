@@ -189,7 +189,7 @@ export default function TemplatesTab({ templates, setTemplates }: TemplatesTabPr
       <CardHeader>
         <CardTitle>Email Templates</CardTitle>
         <CardDescription>
-          Create and manage your email templates. Use [NAME] as a placeholder for the recipient's name.
+          Create and manage your email templates. Use [NAME] for the recipient's name, or any contacts column such as [company|default] and [IF company]...[ENDIF], in the subject or body.
         </CardDescription>
       </CardHeader>
       <CardContent>